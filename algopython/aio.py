@@ -0,0 +1,262 @@
+"""asyncio versions of the algopython commands.
+
+The coroutines share the connection opened by algopython_init(). Replies come from the
+reader thread as concurrent Futures, and completion edges come from the status poller
+through status_edge_listeners, so any number of concurrent awaits needs no extra threads.
+
+Cancelling a move/light/playSound task sends the matching stop command.
+"""
+import asyncio
+import threading
+import time
+
+from . import algopython as core
+
+__all__ = ['algopython_init', 'move', 'light', 'playSound', 'wait', 'moveStop', 'wait_sensor',
+           'lightStop', 'soundStop', 'rotations', 'get_sensor_value', 'FOREVER']
+
+FOREVER = core.FOREVER
+
+# status field -> list of (loop, asyncio.Future) woken on the next busy -> idle edge
+_edge_waiters = {field: [] for field in core.STATUS_EDGE_FIELDS}
+_edge_waiters_lock = threading.Lock()
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
+
+
+def _on_status_edge(field):
+    with _edge_waiters_lock:
+        waiters = _edge_waiters[field]
+        _edge_waiters[field] = []
+    for loop, future in waiters:
+        if not loop.is_closed():
+            loop.call_soon_threadsafe(_resolve, future)
+
+
+core.status_edge_listeners.append(_on_status_edge)
+
+
+async def _wait_field_idle(field, since):
+    loop = asyncio.get_running_loop()
+    while core.status_idle_edges[field] <= since[field]:
+        future = loop.create_future()
+        with _edge_waiters_lock:
+            _edge_waiters[field].append((loop, future))
+        # The edge may have landed between the check and registering.
+        if core.status_idle_edges[field] > since[field]:
+            break
+        await future
+
+
+async def _wait_for_idle(fields, since, timeout=None):
+    with core.watching_status():
+        try:
+            await asyncio.wait_for(asyncio.gather(*(_wait_field_idle(f, since) for f in fields)), timeout)
+        except asyncio.TimeoutError:
+            return False
+    return True
+
+
+def _settle(waiter, reply_future):
+    if waiter.done():
+        return
+    if reply_future.cancelled():
+        waiter.set_result(None)     # given up on outside this task: no reply
+    elif reply_future.exception() is not None:
+        waiter.set_exception(reply_future.exception())
+    else:
+        waiter.set_result(reply_future.result())
+
+
+def _reply_waiter(reply_future):
+    """An asyncio future for the reply. Unlike asyncio.wrap_future(), a reply Future
+    cancelled by another thread resolves it to None instead of cancelling the task."""
+    loop = asyncio.get_running_loop()
+    waiter = loop.create_future()
+
+    def done(_):
+        try:
+            loop.call_soon_threadsafe(_settle, waiter, reply_future)
+        except RuntimeError:
+            pass        # the loop is closed
+
+    reply_future.add_done_callback(done)
+    return waiter
+
+
+async def _submit(cmd, payload, packet, timeout):
+    """submit_packet() without blocking the event loop while the v2 window is full.
+
+    Returns None if no slot came free within `timeout` seconds; nothing was sent then.
+    """
+    loop = asyncio.get_running_loop()
+    give_up_at = loop.time() + timeout
+    while True:
+        reply_future = core.submit_packet(cmd, payload, packet, block=False)
+        if reply_future is not None:
+            return reply_future
+        remaining = give_up_at - loop.time()
+        if remaining <= 0:
+            return None
+        try:
+            await asyncio.wait_for(_reply_waiter(core.window_slot_free()), remaining)
+        except asyncio.TimeoutError:
+            return None
+
+
+async def _request(cmd, payload, retries=None, timeout=None):
+    """Send one frame and await its reply payload, retrying like send_packet().
+
+    Without `timeout` each attempt waits the adaptive retransmission timeout, and without
+    `retries` attempts continue for up to SEND_DEADLINE seconds. Stops take the same stop
+    path as send_packet(): short timeouts, STOP_RETRIES retries, and commands sent before
+    them are not retried.
+    """
+    if core.ser is None:
+        loop = asyncio.get_running_loop()
+        if not await loop.run_in_executor(None, core.ensure_connection):
+            print("[Error] Serial port is not initialized.")
+            return None
+    stop = core.command_priority(cmd) == core.PRIORITY_STOP
+    if stop:
+        core.begin_stop()
+        retries = max(retries or 0, core.STOP_RETRIES)
+    generation = core.stop_generation
+    packet = core.build_packet(cmd, payload)
+    reply_cmd = core.CMD_REPLY_MAP.get(cmd)
+    give_up_at = time.monotonic() + core.SEND_DEADLINE
+    attempt = 0
+    while True:
+        if attempt:
+            if not stop and cmd not in core.POLL_COMMANDS and core.stop_generation != generation:
+                # A stop went out meanwhile; re-sending could undo it.
+                return None
+            core.link_stats.record_retry(cmd)
+        if reply_cmd is None:
+            core.submit_packet(cmd, payload, packet)
+            return True
+        attempt_timeout = core.retransmit_timeout(cmd, attempt) if timeout is None else timeout
+        if stop:
+            attempt_timeout = min(attempt_timeout, core.STOP_REPLY_TIMEOUT)
+        if retries is None:
+            attempt_timeout = max(0.0, min(attempt_timeout, give_up_at - time.monotonic()))
+        reply_future = await _submit(cmd, payload, packet, attempt_timeout)
+        if reply_future is not None:
+            reply_future.retransmission = attempt > 0
+            try:
+                reply = await asyncio.wait_for(_reply_waiter(reply_future), attempt_timeout)
+            except asyncio.TimeoutError:
+                reply = None
+            finally:
+                core.cancel_reply(reply_cmd, reply_future)
+            if reply is not None:
+                return reply
+        attempt += 1
+        if retries is not None and attempt > retries:
+            break
+        if retries is None and time.monotonic() >= give_up_at:
+            break
+    core.link_stats.record_failure(cmd)
+    print(f"[Fail] No reply for CMD 0x{cmd:02X} after {attempt} tries.")
+    return None
+
+
+async def _send_stop(cmd, payload):
+    # The task is being cancelled; still wait for the acknowledgement so the stop is
+    # retried if lost and its reply can't be taken for a later stop's.
+    if core.ser is not None:
+        await _request(cmd, payload)
+
+
+async def _run_until_idle(cmd, payload, fields, is_blocking, timeout, stop_cmd, stop_payload):
+    since = core.status_edge_snapshot()
+    try:
+        await _request(cmd, payload)
+        if not is_blocking:
+            return None
+        return await _wait_for_idle(fields, since, timeout)
+    except asyncio.CancelledError:
+        if stop_cmd is not None:
+            await _send_stop(stop_cmd, stop_payload)
+        raise
+
+
+async def algopython_init(port: str = None, connection=None, timeout: float = 5.0):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, core.algopython_init, port, connection, timeout)
+
+
+async def move(port: str, duration: float, power: int, direction: int, is_blocking=True, timeout: float = None):
+    motor_port, payload, forever = core.build_move_payload(port, duration, power, direction)
+    return await _run_until_idle(core.ALGOPYTHON_CMD_MOVE_REQ, payload, core.motor_status_fields(motor_port),
+                                 is_blocking and not forever, timeout,
+                                 core.ALGOPYTHON_CMD_MOVE_STOP_REQ, bytes([motor_port]))
+
+
+async def rotations(port: str, rotations: float, power: float, direction: int, timeout: float = None):
+    port_mask, duration = core.rotations_to_duration(port, rotations, power, direction)
+    return await move(port_mask, duration, int(power), direction, timeout=timeout)
+
+
+async def moveStop(stop_port: str):
+    return await _request(core.ALGOPYTHON_CMD_MOVE_STOP_REQ, bytes([core.motor_mask(stop_port)]))
+
+
+async def light(port: int, duration: float, power: int, color, is_blocking=True, timeout: float = None):
+    payload, forever = core.build_light_payload(port, duration, power, color)
+    return await _run_until_idle(core.ALGOPYTHON_CMD_LIGHT_REQ, payload, ['led1' if port == 1 else 'led2'],
+                                 is_blocking and not forever, timeout,
+                                 core.ALGOPYTHON_CMD_LIGHT_STOP_REQ, bytes([port]))
+
+
+async def lightStop(stop_port: int):
+    if stop_port not in (1, 2):
+        raise ValueError("LED port must be 1 or 2")
+    return await _request(core.ALGOPYTHON_CMD_LIGHT_STOP_REQ, bytes([stop_port]))
+
+
+async def playSound(sound_id: int, volume: int, is_blocking=True, timeout: float = None):
+    payload = core.build_sound_payload(sound_id, volume)
+    return await _run_until_idle(core.ALGOPYTHON_CMD_PLAY_SOUND_REQ, payload, ['sound'],
+                                 is_blocking, timeout,
+                                 core.ALGOPYTHON_CMD_SOUND_STOP_REQ, b"")
+
+
+async def soundStop():
+    return await _request(core.ALGOPYTHON_CMD_SOUND_STOP_REQ, b"")
+
+
+async def wait_sensor(sensor_port: int, min: int, max: int, timeout: float = None):
+    payload = core.build_wait_sensor_payload(sensor_port, min, max)
+    return await _run_until_idle(core.ALGOPYTHON_CMD_WAIT_SENSOR_REQ, payload,
+                                 ['sensor1' if sensor_port == 1 else 'sensor2'],
+                                 True, timeout, None, None)
+
+
+async def get_sensor_value(sensor_port: int):
+    if sensor_port not in (1, 2):
+        raise ValueError("Port must be 1 or 2")
+    stream = core.sensor_stream
+    if stream is not None and sensor_port in stream.rings:
+        # Streaming already polls this sensor; don't compete with it for replies.
+        ring = stream.rings[sensor_port]
+        give_up_at = time.monotonic() + 1.0
+        while not ring.count and time.monotonic() < give_up_at:
+            await asyncio.sleep(0.005)
+        sample = ring.latest()
+        return None if sample is None else sample[1]
+    for _ in range(3):
+        reply = await _request(core.ALGOPYTHON_CMD_GET_SENSOR_REQ, bytes([sensor_port]))
+        if not reply:
+            return None
+        # v1 replies are matched by opcode only: this may answer another port's request.
+        if reply[0] == sensor_port:
+            return reply[-1]
+    return None
+
+
+async def wait(duration: float):
+    await asyncio.sleep(max(0.01, min(duration, 10.0)))
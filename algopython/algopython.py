@@ -1,22 +1,26 @@
 import serial.tools.list_ports
-import os
+import binascii
 import threading
 import queue
 import time
 import serial
 import math
+import collections
+import concurrent.futures
+import contextlib
+import functools
+import array
+import itertools
+import json
+import os
+import selectors
 
 __all__ = ['move', 'light', 'playSound', 'wait', 'listAvailableSounds','moveStop','wait_sensor',
-           'lightStop','soundStop','rotations','get_sensor_value','FOREVER']
-
-ser = serial.Serial('/dev/ttyUSB0', 115200, timeout=2)
-
-ser = None
-serial_lock = threading.Lock()
-serial_command_queue = queue.Queue()
-serial_worker_running = False
-status_thread = None
-status_thread_running = False
+           'lightStop','soundStop','rotations','get_sensor_value','FOREVER',
+           'batch','send_many','subscribe_status','unsubscribe_status','set_polling_policy',
+           'set_status_printing','get_link_stats','reset_link_stats','get_rtt_estimates','get_status_history','Robot','Fleet','default_robot',
+           'start_sensor_stream','stop_sensor_stream','start_recording','stop_recording',
+           'start_tracing','stop_tracing']
 
 CMD_REPLY_MAP = {
     0x10: 0x80,  # MOVE_REQ         -> MOVE_REP
@@ -29,44 +33,41 @@ CMD_REPLY_MAP = {
     0x17: 0x87,  # WAIT_SENSOR_REQ  -> WAIT_SENSOR_REP
     0x18: 0x88,  # GET_SENSOR_REQ   -> GET_SENSOR_REP
     0x19: 0x89,  # GET_STATUS_REQ   -> GET_STATUS_REP
+    0x1A: 0x8A,  # HELLO_REQ        -> HELLO_REP (protocol negotiation)
 }
 
+# Priority lanes, lowest value first. Stops jump every queue, write ahead of waiting
+# writers and end the retries of commands started before them; the poller's own status
+# polls are preempted outright. Reads a caller is waiting for are left alone.
+PRIORITY_STOP = 0
+PRIORITY_COMMAND = 1
+PRIORITY_POLL = 2
+
+STOP_COMMANDS = frozenset((0x13, 0x14, 0x15))      # MOVE_STOP, LIGHT_STOP, SOUND_STOP
+POLL_COMMANDS = frozenset((0x18, 0x19))            # GET_SENSOR, GET_STATUS
+
+STOP_REPLY_TIMEOUT = 0.25   # per attempt, so a lost stop is re-sent quickly
+STOP_RETRIES = 4
+STOP_LATENCY_BOUND = STOP_REPLY_TIMEOUT * (STOP_RETRIES + 1)   # acknowledged or given up on by then
+
+def command_priority(cmd):
+    if cmd in STOP_COMMANDS:
+        return PRIORITY_STOP
+    if cmd in POLL_COMMANDS:
+        return PRIORITY_POLL
+    return PRIORITY_COMMAND
+
 class SerialCommand:
-    def __init__(self, cmd, payload, expect_reply=True):
+    def __init__(self, cmd, payload, expect_reply=True, priority=None, background=False):
+        self.queued_at = time.perf_counter()
         self.cmd = cmd
         self.payload = payload
         self.expect_reply = expect_reply
+        self.priority = command_priority(cmd) if priority is None else priority
+        self.background = background        # the poller's own status poll
         self.response = None
         self.done = threading.Event()
 
-def start_serial_worker():
-    global serial_worker_running
-    if not serial_worker_running:
-        serial_worker_running = True
-        threading.Thread(target=serial_worker_loop, daemon=True).start()
-
-def serial_worker_loop():
-    global ser
-    while serial_worker_running:
-        try:
-            command = serial_command_queue.get(timeout=0.1)
-        except queue.Empty:
-            continue
-        with serial_lock:
-            result = send_packet(
-                command.cmd,
-                command.payload,
-                wait_done=True,
-                verbose=True
-            )
-            command.response = result
-            command.done.set()
-
-def stop_status_monitor():
-    global status_thread_running
-    status_thread_running = False
-    print("Status monitor stopped.")
-
 class DeviceStatus:
     def __init__(self):
         # Motors
@@ -87,135 +88,338 @@ class DeviceStatus:
         self.sensor1_value = 0.0
         self.sensor2_value = 0.0
 
+STATUS_FIELDS = ('motor1', 'motor2', 'motor3', 'led1', 'led2', 'sound',
+                 'sensor1', 'sensor2', 'sensor1_value', 'sensor2_value')
 
-g_algopython_system_status = DeviceStatus()
-
-def serial_thread_task():
-    last_status_time = time.time()
-    while True:
-        # Check if it's time to fetch the brain status (every 10ms)
-        now = time.time()
+# Status fields that go busy -> idle when an actuator finishes or a sensor wait fires.
+STATUS_EDGE_FIELDS = ('motor1', 'motor2', 'motor3', 'led1', 'led2', 'sound', 'sensor1', 'sensor2')
 
-        # if (now - last_status_time) >= 1:  # 10ms = 0.01 seconds
-        if (now - last_status_time) >= 0.05:  # 10ms = 0.01 seconds
-            serial_get_brain_status()
-            last_status_time = now
-
-        # Process queued commands (non-blocking)
-        try:
-            command = serial_command_queue.get_nowait()
-            serial_send_next_command(command)
-        except queue.Empty:
-            pass
-
-        # Short sleep to avoid busy-loop hogging CPU
-        time.sleep(0.001)  # 1ms pause
+# --------------------------------------------------------------------------------------------------------------
+#-----------------Status polling--------------------------------------------------------------------------------
+class PollingPolicy:
+    """How often the status poller sends GET_STATUS.
+
+    While an actuator is busy or someone waits on a status edge the poller runs every
+    `fast_interval` seconds. Once everything is idle the interval grows by `backoff` per
+    poll up to `idle_interval`. Every command acknowledgement triggers an immediate poll.
+    """
+
+    def __init__(self, fast_interval=0.01, idle_interval=0.5, backoff=2.0):
+        if not (0 < fast_interval <= idle_interval):
+            raise ValueError("Intervals must satisfy 0 < fast_interval <= idle_interval")
+        if backoff < 1:
+            raise ValueError("Backoff must be at least 1")
+        self.fast_interval = fast_interval
+        self.idle_interval = idle_interval
+        self.backoff = backoff
+
+    def next_interval(self, interval, active):
+        if active:
+            return self.fast_interval
+        return min(self.idle_interval, interval * self.backoff)
 
 
-def serial_thread_start():
-    threading.Thread(target=serial_thread_task, daemon=True).start()
+# --------------------------------------------------------------------------------------------------------------
+#-----------------Port discovery--------------------------------------------------------------------------------
+# Every USB serial port is probed at the same time with a GET_STATUS handshake, so discovery
+# takes about one probe timeout however many adapters are attached. Ports that answered are
+# remembered by VID:PID:serial number, and on the next start those are probed first.
+PORT_CACHE_PATH = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+                               "algopython", "ports.json")
+PROBE_TIMEOUT = 1.0
+PROBE_ATTEMPT_TIMEOUT = 0.1
+
+def candidate_ports():
+    """ListPortInfo of every serial port that could be a brain board."""
+    return [p for p in serial.tools.list_ports.comports()
+            if p.vid is not None or "USB" in p.description or "CP210" in p.description or "ttyUSB" in p.device]
+
+def port_identity(info):
+    """Stable key of a USB adapter across reboots and re-plugging, or None if unknown."""
+    if info.vid is None:
+        return None
+    return f"{info.vid:04X}:{info.pid:04X}:{info.serial_number or ''}"
 
-def serial_send_next_command(command):
-    result = send_packet(
-            command.cmd,
-            command.payload,
-            wait_done=command.expect_reply,
-            verbose=True
-            )
-    command.response = result
-    command.done.set()
-
-def serial_get_brain_status():
-    global g_algopython_system_status
-    response = serial_send_command(0x19, b"", expect_reply=True)
-
-    if not response or len(response) < 10:
-        return "?, ?, ?, ?, ?, ?, ?, ?, ?, ?"
-
-    g_algopython_system_status.motor1 = response[0]
-    g_algopython_system_status.motor2 = response[1]
-    g_algopython_system_status.motor3 = response[2]
-    g_algopython_system_status.led1 = bool(response[3])
-    g_algopython_system_status.led2 = bool(response[4])
-    g_algopython_system_status.sound = bool(response[5])
-    g_algopython_system_status.sensor1 = bool(response[6])
-    g_algopython_system_status.sensor2 = bool(response[7])
-    g_algopython_system_status.sensor1_value = response[8]
-    g_algopython_system_status.sensor2_value = response[9]
-
-    s = g_algopython_system_status
-    print(
-        f"Motors: {s.motor1}, {s.motor2}, {s.motor3} | "
-        f"LEDs: {int(s.led1)}, {int(s.led2)} | "
-        f"Sound: {int(s.sound)} | "
-        f"Sensors: Trig1={int(s.sensor1)}, Trig2={int(s.sensor2)}, "
-        f"Value1={s.sensor1_value}, Value2={s.sensor2_value}"
-    )
-def serial_queue_command(cmd, payload, expect_reply=True):
-    command = SerialCommand(cmd, payload, expect_reply)
-    serial_command_queue.put(command)
-    command.done.wait()
-    return command.response
-
-def serial_send_command(cmd, payload, expect_reply=True):
-    command = SerialCommand(cmd, payload, expect_reply)
-    serial_tx_command(command)
-    command.done.wait()
-    return command.response
-
-def serial_tx_command(command):
-    result = send_packet(
-            command.cmd,
-            command.payload,
-            wait_done=command.expect_reply,
-            verbose=True
-            )
-    command.response = result
-    command.done.set()
-
-def serial_send_next_command(command):
-    result = send_packet(
-            command.cmd,
-            command.payload,
-            wait_done=command.expect_reply,
-            verbose=True
-            )
-    command.response = result
-    command.done.set()
-
-
-def algopython_init(port: str = None):
-    time.sleep(2) # Allow time for the system to start up and establish the serial connection
-    os.system('cls' if os.name == 'nt' else 'clear')
-    global ser
-    if not port:
-        port = find_usb_serial_port()
-        if not port:
-            print("USB port not found. Please connect the device and try again.")
-            return False
+def load_port_cache(path=None):
+    try:
+        with open(path or PORT_CACHE_PATH) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return cache if isinstance(cache, dict) else {}
+
+def save_port_cache(cache, path=None):
+    # The cache only speeds up the next start; never fail a connection over it.
+    path = path or PORT_CACHE_PATH
     try:
-        ser = serial.Serial(
-            port=port,
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(cache, f, indent=2)
+        os.replace(tmp, path)
+    except OSError:
+        pass
+
+def probe_port(device, timeout: float = PROBE_TIMEOUT, attempt_timeout: float = PROBE_ATTEMPT_TIMEOUT):
+    """Open `device` and send GET_STATUS until a brain answers.
+
+    Returns the open port, ready to hand to Robot(connection=...), or None.
+    """
+    try:
+        connection = serial.Serial(
+            port=device,
             baudrate=115200,
             parity=serial.PARITY_NONE,
             stopbits=serial.STOPBITS_ONE,
             bytesize=serial.EIGHTBITS,
-            timeout=0.5
+            timeout=attempt_timeout,
+            write_timeout=attempt_timeout
         )
-        print(f"Serial port: {port}")
-        serial_thread_start();
-        time.sleep(2)
-        return True
-    except serial.SerialException as e:
-        print(f"\nError when opening port: {port}: {e}\n")
-        return False
+    except (serial.SerialException, OSError, ValueError):
+        return None
+    request = build_packet(ALGOPYTHON_CMD_GET_STATUS_REQ, b"")
+    decoder = FrameDecoder()
+    deadline = time.monotonic() + timeout
+    try:
+        while time.monotonic() < deadline:
+            connection.write(request)
+            attempt_end = min(deadline, time.monotonic() + attempt_timeout)
+            while time.monotonic() < attempt_end:
+                data = connection.read(connection.in_waiting or 1)
+                for cmd, payload, _ in decoder.feed(data):
+                    if cmd == ALGOPYTHON_CMD_GET_STATUS_REP and len(payload) >= 10:
+                        connection.timeout = 0.5
+                        connection.write_timeout = None
+                        return connection
+    except (serial.SerialException, OSError):
+        pass
+    connection.close()
+    return None
+
+def probe_ports(ports, timeout: float = PROBE_TIMEOUT, first_only: bool = False):
+    """Probe ListPortInfos concurrently; returns [(info, open port)] of the brains found.
+
+    With first_only=True it returns as soon as one brain answers and closes the ports of
+    any others that answer later.
+    """
+    if not ports:
+        return []
+    found = []
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=len(ports), thread_name_prefix="algopython-probe")
+    futures = {pool.submit(probe_port, info.device, timeout): info for info in ports}
+    for future in concurrent.futures.as_completed(futures):
+        connection = future.result()
+        if connection is None:
+            continue
+        found.append((futures[future], connection))
+        if first_only:
+            break
+    if first_only and found:
+        winner = found[0][1]
+
+        def close_unused(future):
+            connection = future.result()
+            if connection is not None and connection is not winner:
+                connection.close()
+
+        for future in futures:
+            future.add_done_callback(close_unused)
+    pool.shutdown(wait=not first_only)
+    return sorted(found, key=lambda item: ports.index(item[0]))
+
+def remember_ports(found, path=None):
+    cache = load_port_cache(path)
+    for info, _ in found:
+        identity = port_identity(info)
+        if identity is not None:
+            cache[identity] = {"device": info.device, "description": info.description, "last_seen": time.time()}
+    save_port_cache(cache, path)
+
+def discover_brains(timeout: float = PROBE_TIMEOUT, first_only: bool = False):
+    """[(device, open port)] for the brains attached, cached adapters tried first."""
+    ports = candidate_ports()
+    cache = load_port_cache()
+    known = [p for p in ports if port_identity(p) in cache]
+    if first_only and known:
+        found = probe_ports(known, timeout, first_only=True)
+        if found:
+            remember_ports(found)
+            return [(info.device, connection) for info, connection in found]
+    found = probe_ports(ports, timeout, first_only)
+    remember_ports(found)
+    return [(info.device, connection) for info, connection in found]
+
+def find_usb_serial_ports():
+    """Devices of every attached brain that answers a handshake."""
+    brains = discover_brains()
+    for _, connection in brains:
+        connection.close()
+    return [device for device, _ in brains]
 
 def find_usb_serial_port():
-    ports = serial.tools.list_ports.comports()
-    for p in ports:
-        if "USB" in p.description or "CP210" in p.description or "ttyUSB" in p.device:
-            return p.device
-    return None
+    brains = discover_brains(first_only=True)
+    for _, connection in brains:
+        connection.close()
+    return brains[0][0] if brains else None
+
+def selectable_fd(port):
+    """File descriptor a selector can wait on for `port`, or None (Windows, simulated ports)."""
+    if port is None or os.name != 'posix' or not hasattr(port, 'fileno'):
+        return None
+    try:
+        return port.fileno()
+    except (OSError, ValueError, serial.SerialException):
+        return None
+
+# Protocol v1 frames: 0xA5, cmd, len, payload, checksum. Replies are matched to requests
+# by opcode only. Protocol v2 frames: 0xA6, cmd, seq, len, payload, CRC-16 (big endian)
+# over everything before it; a reply carries its request's sequence number, so several
+# requests with the same opcode can be in flight and answered in any order. v2 is offered
+# with a v1 HELLO at connect time; a brain that agrees still accepts v1 frames.
+FRAME_SYNC = 0xA5
+FRAME_SYNC_V2 = 0xA6
+FRAME_MAX_LENGTH = 4 + 255 + 2  # v2: sync, cmd, seq, len, payload, CRC-16 (v1 frames are 2 bytes shorter)
+# The brain writes a frame in one go, so a partial frame that has seen no bytes for this
+# long started at a stray sync byte. Generous enough for USB-serial latency timers (16 ms).
+FRAME_IDLE_GAP = 0.05
+
+PROTOCOL_V1 = 1
+PROTOCOL_V2 = 2
+PROTOCOL_WINDOW = 64            # v2 requests the host keeps in flight at most
+
+def crc16(data) -> int:
+    """CRC-16/CCITT-FALSE (polynomial 0x1021, initial value 0xFFFF) of a v2 frame.
+
+    binascii.crc_hqx is the table-driven implementation of this CRC.
+    """
+    return binascii.crc_hqx(data, 0xFFFF)
+
+class FrameDecoder:
+    """Incremental v1/v2 frame decoder over a preallocated buffer.
+
+    feed() copies incoming bytes into the buffer once and yields (cmd, payload, seq) for
+    every frame whose checksum matches; seq is None for v1 frames. `payload` is a
+    memoryview into the decoder's buffer and is only valid until the generator is
+    resumed; copy it if you need to keep it.
+
+    v2 frames are only looked for once `protocol` is PROTOCOL_V2, which
+    Robot.negotiate_protocol() sets: a v1 link doesn't pay for the second scan, and a stray
+    v2 sync byte can't hold back its replies.
+
+    A partial frame that receives no bytes for `idle_gap` seconds is dropped (see
+    expire()), so a stray sync byte followed by a large length byte can't hold back the
+    valid frames behind it.
+    """
+
+    def __init__(self, capacity=4096, idle_gap=FRAME_IDLE_GAP, protocol=PROTOCOL_V1):
+        if capacity < 2 * FRAME_MAX_LENGTH:
+            raise ValueError(f"Capacity must be at least {2 * FRAME_MAX_LENGTH} bytes")
+        self._buf = bytearray(capacity)
+        self._view = memoryview(self._buf)
+        self._start = 0
+        self._end = 0
+        self.idle_gap = idle_gap
+        self.protocol = protocol
+        self._last_feed = 0.0
+        self.discarded_bytes = 0
+        self.bad_checksums = 0
+        self.stale_frames = 0
+
+    def reset(self):
+        self._start = 0
+        self._end = 0
+
+    def buffered(self):
+        return self._end - self._start
+
+    def feed(self, data, now=None):
+        """Decode `data` received at `now` (time.monotonic() by default)."""
+        if now is None:
+            now = time.monotonic()
+        if self._end != self._start:
+            yield from self.expire(now)
+        self._last_feed = now
+        data = memoryview(data)
+        capacity = len(self._buf)
+        offset = 0
+        while offset < len(data):
+            if self._end == capacity:
+                # Only a partial frame (< FRAME_MAX_LENGTH bytes) is left, move it to the front.
+                pending = self._end - self._start
+                self._buf[:pending] = bytes(self._view[self._start:self._end])
+                self._start = 0
+                self._end = pending
+            chunk = min(len(data) - offset, capacity - self._end)
+            self._buf[self._end:self._end + chunk] = data[offset:offset + chunk]
+            self._end += chunk
+            offset += chunk
+            yield from self._decode()
+
+    def expire(self, now=None):
+        """Drop a partial frame that has been idle for longer than idle_gap.
+
+        The bytes after its sync byte are decoded again, yielding any frames among them.
+        """
+        if now is None:
+            now = time.monotonic()
+        if now - self._last_feed <= self.idle_gap:
+            return
+        while self._end != self._start:
+            self.stale_frames += 1
+            self.discarded_bytes += 1
+            self._start += 1
+            yield from self._decode()
+
+    def _decode(self):
+        buf = self._buf
+        view = self._view
+        start = self._start
+        end = self._end
+        accept_v2 = self.protocol >= PROTOCOL_V2
+        while True:
+            sync = buf.find(FRAME_SYNC, start, end)
+            sync_v2 = -1
+            if accept_v2:
+                # Only the bytes before the next v1 sync can hold a v2 frame start.
+                sync_v2 = buf.find(FRAME_SYNC_V2, start, end if sync < 0 else sync)
+                if sync_v2 >= 0:
+                    sync = sync_v2
+            if sync < 0:
+                self.discarded_bytes += end - start
+                start = end
+                break
+            self.discarded_bytes += sync - start
+            start = sync
+            if sync_v2 < 0:
+                if end - start < 4:
+                    break
+                frame_end = start + buf[start + 2] + 4
+                if frame_end > end:
+                    break
+                valid = buf[frame_end - 1] == sum(view[start:frame_end - 1]) & 0xFF
+            else:
+                if end - start < 6:
+                    break
+                frame_end = start + buf[start + 3] + 6
+                if frame_end > end:
+                    break
+                valid = crc16(view[start:frame_end - 2]) == buf[frame_end - 2] << 8 | buf[frame_end - 1]
+            if not valid:
+                # Not a real frame start; resync on the next sync byte.
+                self.bad_checksums += 1
+                self.discarded_bytes += 1
+                start += 1
+                continue
+            self._start = frame_end
+            if sync_v2 < 0:
+                yield buf[start + 1], view[start + 3:frame_end - 1], None
+            else:
+                yield buf[start + 1], view[start + 4:frame_end - 2], buf[start + 2]
+            start = frame_end
+        if start == end:
+            start = end = 0
+            self._end = 0
+        self._start = start
 
 def build_packet(cmd: int, payload: bytes) -> bytes:
     if not isinstance(payload, (bytes, bytearray)):
@@ -224,63 +428,1966 @@ def build_packet(cmd: int, payload: bytes) -> bytes:
     crc = sum(header) % 256
     return header + payload + bytes([crc])
 
-def send_packet(cmd, payload, wait_done=True, delay_after=0.01, retries=2, verbose=True):
-    global ser
-    if ser is None:
-        print("[Error] Serial port is not initialized.")
+def build_packet_v2(cmd: int, seq: int, payload: bytes) -> bytes:
+    frame = bytes([FRAME_SYNC_V2, cmd, seq, len(payload)]) + bytes(payload)
+    return frame + crc16(frame).to_bytes(2, "big")
+
+class CommandBatch:
+    def __init__(self):
+        self.commands = []      # (cmd, payload) in call order
+        self.wait_fields = []   # status fields blocking calls would have waited on
+        self.replies = None     # filled in by send_many() when the batch is flushed
+        self.completed = None   # result of the completion wait when batch(is_blocking=True)
+
+class RequestWindow:
+    """Slots for the v2 requests in flight. try_acquire() never blocks; a caller that finds
+    the window full waits on the Future from when_free(), which is set on the next release."""
+
+    def __init__(self, size):
+        self.size = size
+        self.free = size
+        self._lock = threading.Lock()
+        self._waiters = []
+
+    def try_acquire(self):
+        with self._lock:
+            if not self.free:
+                return False
+            self.free -= 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self.free += 1
+            waiters, self._waiters = self._waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def when_free(self):
+        """A Future that is done once a slot may be free; try_acquire() again then."""
+        future = concurrent.futures.Future()
+        with self._lock:
+            if not self.free:
+                self._waiters.append(future)
+                return future
+        future.set_result(None)
+        return future
+
+# --------------------------------------------------------------------------------------------------------------
+#-----------------Link metrics----------------------------------------------------------------------------------
+LATENCY_BUCKETS = 24    # bucket i counts round trips shorter than 2**i microseconds
+
+class CommandStats:
+    __slots__ = ('sent', 'replies', 'retries', 'timeouts', 'failures',
+                 'latency_total', 'latency_max', 'latency_buckets')
+
+    def __init__(self):
+        self.sent = 0
+        self.replies = 0
+        self.retries = 0
+        self.timeouts = 0       # attempts that got no reply in time
+        self.failures = 0       # calls that gave up after all retries
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self.latency_buckets = [0] * (LATENCY_BUCKETS + 1)
+
+    def snapshot(self):
+        histogram = {}
+        for i, count in enumerate(self.latency_buckets):
+            if count:
+                label = f"<{2 ** i}us" if i < LATENCY_BUCKETS else f">={2 ** LATENCY_BUCKETS}us"
+                histogram[label] = count
+        return {
+            "sent": self.sent,
+            "replies": self.replies,
+            "retries": self.retries,
+            "timeouts": self.timeouts,
+            "failures": self.failures,
+            "latency_mean_ms": self.latency_total / self.replies * 1000.0 if self.replies else None,
+            "latency_max_ms": self.latency_max * 1000.0,
+            "latency_histogram": histogram,
+        }
+
+# Retransmission timeouts, per opcode, as in TCP (RFC 6298): smoothed RTT plus four times
+# its mean deviation, doubled on every retry of the same request.
+RTO_INITIAL = 1.0       # before the first round trip of an opcode was measured
+RTO_MIN = 0.02
+RTO_MAX = 5.0
+RTO_CLOCK_GRANULARITY = 0.002
+SEND_DEADLINE = 3.0     # default retry budget of send_packet(), the old 3 tries x 1 s
+
+class RttEstimator:
+    __slots__ = ('srtt', 'rttvar', 'rto', 'samples')
+
+    def __init__(self):
+        self.srtt = None
+        self.rttvar = None
+        self.rto = RTO_INITIAL
+        self.samples = 0
+
+    def update(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(RTO_MAX, max(RTO_MIN, self.srtt + max(RTO_CLOCK_GRANULARITY, 4 * self.rttvar)))
+        self.samples += 1
+
+    def timeout(self, attempt=0):
+        return min(RTO_MAX, self.rto * (2 ** attempt))
+
+    def snapshot(self):
+        return {
+            "srtt_ms": None if self.srtt is None else self.srtt * 1000.0,
+            "rttvar_ms": None if self.rttvar is None else self.rttvar * 1000.0,
+            "rto_ms": self.rto * 1000.0,
+            "samples": self.samples,
+        }
+
+class LinkStats:
+    """Always-on counters for one robot's serial link, cheap enough to update on every frame."""
+
+    def __init__(self, robot):
+        self.robot = robot
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.started = time.monotonic()
+            self.commands = {}
+            self.unsolicited = 0
+            self.lock_acquisitions = 0
+            self.lock_wait_total = 0.0
+            self.lock_wait_max = 0.0
+            self.max_queue_depth = 0
+            decoder = self.robot.reader_decoder
+            self._decoder_base = (decoder.discarded_bytes, decoder.bad_checksums) if decoder else (0, 0)
+
+    def _command(self, cmd):
+        stats = self.commands.get(cmd)
+        if stats is None:
+            stats = self.commands[cmd] = CommandStats()
+        return stats
+
+    def record_sent(self, cmd):
+        with self._lock:
+            self._command(cmd).sent += 1
+
+    def record_retry(self, cmd):
+        with self._lock:
+            self._command(cmd).retries += 1
+
+    def record_timeout(self, cmd):
+        if cmd is None:
+            return
+        with self._lock:
+            self._command(cmd).timeouts += 1
+
+    def record_failure(self, cmd):
+        with self._lock:
+            self._command(cmd).failures += 1
+
+    def record_reply(self, cmd, seconds):
+        if cmd is None:
+            return
+        bucket = min(int(seconds * 1e6).bit_length(), LATENCY_BUCKETS)
+        with self._lock:
+            stats = self._command(cmd)
+            stats.replies += 1
+            stats.latency_total += seconds
+            if seconds > stats.latency_max:
+                stats.latency_max = seconds
+            stats.latency_buckets[bucket] += 1
+
+    def record_unsolicited(self):
+        with self._lock:
+            self.unsolicited += 1
+
+    def record_lock_wait(self, seconds):
+        with self._lock:
+            self.lock_acquisitions += 1
+            self.lock_wait_total += seconds
+            if seconds > self.lock_wait_max:
+                self.lock_wait_max = seconds
+
+    def record_queue_depth(self, depth):
+        if depth > self.max_queue_depth:
+            self.max_queue_depth = depth
+
+    def snapshot(self):
+        robot = self.robot
+        decoder = robot.reader_decoder
+        with robot.pending_lock:
+            pending = sum(len(waiters) for waiters in robot.pending_replies.values()) + len(robot.pending_sequences)
+        with self._lock:
+            discarded, bad = (decoder.discarded_bytes, decoder.bad_checksums) if decoder else (0, 0)
+            return {
+                "uptime_s": time.monotonic() - self.started,
+                "commands": {f"0x{cmd:02X}": stats.snapshot() for cmd, stats in sorted(self.commands.items())},
+                "decoder": {
+                    "discarded_bytes": discarded - self._decoder_base[0],
+                    "bad_checksums": bad - self._decoder_base[1],
+                },
+                "unsolicited_frames": self.unsolicited,
+                "serial_lock": {
+                    "acquisitions": self.lock_acquisitions,
+                    "wait_total_ms": self.lock_wait_total * 1000.0,
+                    "wait_max_ms": self.lock_wait_max * 1000.0,
+                },
+                "queue": {
+                    "depth": robot.serial_command_queue.qsize(),
+                    "max_depth": self.max_queue_depth,
+                },
+                "pending_replies": pending,
+                "protocol": robot.protocol,
+                "window": robot.window,
+            }
+
+# --------------------------------------------------------------------------------------------------------------
+#-----------------Sensor streaming------------------------------------------------------------------------------
+class SensorRing:
+    """Fixed-size ring of (monotonic timestamp, value) samples for one sensor.
+
+    Storage is allocated once. Every sample is written twice, at i and i + capacity, so
+    the newest n samples are always one contiguous slice and last() can hand out a view
+    without copying.
+    """
+
+    def __init__(self, capacity: int = 4096):
+        if capacity < 1:
+            raise ValueError("Capacity must be at least 1")
+        self.capacity = capacity
+        self.times = array.array('d', bytes(16 * capacity))
+        self.values = array.array('B', bytes(2 * capacity))
+        self.count = 0          # samples written since creation
+        self.new_sample = threading.Condition()
+
+    def append(self, timestamp, value):
+        i = self.count % self.capacity
+        times = self.times
+        values = self.values
+        times[i] = times[i + self.capacity] = timestamp
+        values[i] = values[i + self.capacity] = value
+        with self.new_sample:
+            self.count += 1
+            self.new_sample.notify_all()
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def _window(self, n):
+        end = self.count % self.capacity + self.capacity
+        n = len(self) if n is None else min(n, len(self))
+        return end - n, end
+
+    def last(self, n: int = None):
+        """Memoryviews (timestamps, values) of the newest n samples, oldest first.
+
+        The views share the ring's storage: copy them if they must outlive the next
+        `capacity` samples.
+        """
+        start, end = self._window(n)
+        return memoryview(self.times)[start:end], memoryview(self.values)[start:end]
+
+    def last_numpy(self, n: int = None):
+        """Same as last(), as NumPy arrays sharing the ring's storage (needs numpy)."""
+        import numpy
+        times, values = self.last(n)
+        return numpy.frombuffer(times, dtype=numpy.float64), numpy.frombuffer(values, dtype=numpy.uint8)
+
+    def latest(self):
+        """Newest (timestamp, value), or None before the first sample."""
+        if not self.count:
+            return None
+        i = (self.count - 1) % self.capacity
+        return self.times[i], self.values[i]
+
+    def aggregate(self, n: int = None, seconds: float = None):
+        """(min, max, mean) over the newest n samples, or those of the last `seconds`."""
+        start, end = self._window(n)
+        if seconds is not None:
+            cutoff = time.monotonic() - seconds
+            times = self.times
+            while start < end and times[start] < cutoff:
+                start += 1
+        if start == end:
+            return None
+        values = memoryview(self.values)[start:end]
+        return min(values), max(values), sum(values) / (end - start)
+
+    def samples(self, timeout: float = None, from_start: bool = False):
+        """Yield (timestamp, value) as samples arrive; stops after `timeout` s without one.
+
+        A consumer that falls more than `capacity` samples behind skips ahead to the
+        oldest sample still in the ring.
+        """
+        seen = max(0, self.count - self.capacity) if from_start else self.count
+        while True:
+            with self.new_sample:
+                if self.count == seen and not self.new_sample.wait_for(lambda: self.count != seen, timeout):
+                    return
+                count = self.count
+            seen = max(seen, count - self.capacity)
+            while seen < count:
+                i = seen % self.capacity
+                yield self.times[i], self.values[i]
+                seen += 1
+
+
+class SensorStream:
+    """Polls GET_SENSOR for one or both sensors as fast as the link allows.
+
+    Up to `window` requests are kept in flight. Requests are pre-encoded once and written
+    without registering reply futures; replies are routed from the reader thread straight
+    into one SensorRing per port.
+    """
+
+    def __init__(self, robot, ports=(1, 2), capacity: int = 4096, window: int = 4, reply_timeout: float = 0.2):
+        for port in ports:
+            if port not in (1, 2):
+                raise ValueError("Port must be 1 or 2")
+        self.robot = robot
+        self.ports = tuple(ports)
+        self.rings = {port: SensorRing(capacity) for port in self.ports}
+        self.window = max(window, len(self.ports))
+        self.reply_timeout = reply_timeout
+        self.requests = 0
+        self.lost = 0           # requests given up on after reply_timeout
+        self._packet = b"".join(build_packet(ALGOPYTHON_CMD_GET_SENSOR_REQ, bytes([port])) for port in self.ports)
+        self._in_flight = 0
+        self._credit = threading.Condition()
+        self._running = False
+        self._thread = None
+
+    def __getitem__(self, port):
+        return self.rings[port]
+
+    def start(self):
+        if self._running:
+            return self
+        if not self.robot.ensure_connection():
+            raise RuntimeError("Serial port is not initialized.")
+        self._running = True
+        self.robot.reply_sinks[ALGOPYTHON_CMD_GET_SENSOR_REP] = self._on_reply
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        with self._credit:
+            self._credit.notify_all()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        if self.robot.reply_sinks.get(ALGOPYTHON_CMD_GET_SENSOR_REP) == self._on_reply:
+            del self.robot.reply_sinks[ALGOPYTHON_CMD_GET_SENSOR_REP]
+
+    def _on_reply(self, payload):
+        ring = self.rings.get(payload[0]) if len(payload) >= 2 else None
+        if ring is not None:
+            ring.append(time.monotonic(), payload[-1])
+            for listener in self.robot.sensor_listeners:
+                listener(payload[0], payload[-1])
+        with self._credit:
+            if self._in_flight:
+                self._in_flight -= 1
+            self._credit.notify()
+
+    def _run(self):
+        batch_size = len(self.ports)
+        stats = self.robot.link_stats
+        while self._running:
+            with self._credit:
+                while self._running and self._in_flight + batch_size > self.window:
+                    if not self._credit.wait(self.reply_timeout):
+                        # Lost requests or replies: stop waiting for them.
+                        self.lost += self._in_flight
+                        self._in_flight = 0
+                if not self._running:
+                    break
+                self._in_flight += batch_size
+            if self.robot.ser is None:
+                self._running = False
+                break
+            try:
+                self.robot.serial_write(self._packet, PRIORITY_POLL)
+            except (serial.SerialException, OSError) as e:
+                print(f"[Error] Sensor stream stopped: {e}")
+                self._running = False
+                break
+            self.requests += batch_size
+            for _ in range(batch_size):
+                stats.record_sent(ALGOPYTHON_CMD_GET_SENSOR_REQ)
+
+# --------------------------------------------------------------------------------------------------------------
+#-----------------Status history--------------------------------------------------------------------------------
+class StatusHistory:
+    """Fixed-capacity columnar log of GET_STATUS frames.
+
+    Each sample is a monotonic timestamp plus the 10 raw status bytes, kept in one
+    preallocated byte column per STATUS_FIELDS entry (18 bytes per sample, no object per
+    sample). Only frames that differ from the previous one are stored and `last_seen`
+    records when the newest frame arrived: the status is a step function between samples,
+    so nothing is lost and an idle robot polled for days fills no more of the ring than
+    an active one. Past `capacity` samples the oldest are overwritten.
+    """
+
+    def __init__(self, capacity: int = 65536):
+        if capacity < 2:
+            raise ValueError("Capacity must be at least 2")
+        self.capacity = capacity
+        self.times = array.array('d', bytes(8 * capacity))
+        self.columns = {field: bytearray(capacity) for field in STATUS_FIELDS}
+        self._columns = tuple(self.columns.values())
+        self.count = 0          # samples stored since creation
+        self.frames = 0         # status frames seen, stored or not
+        self.last_seen = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    @property
+    def nbytes(self):
+        return self.capacity * (8 + len(self._columns))
+
+    def append(self, response, timestamp: float = None):
+        if timestamp is None:
+            timestamp = time.monotonic()
+        columns = self._columns
+        with self._lock:
+            self.frames += 1
+            self.last_seen = timestamp
+            if self.count:
+                j = (self.count - 1) % self.capacity
+                for k in range(len(columns)):
+                    if columns[k][j] != response[k]:
+                        break
+                else:
+                    return
+            i = self.count % self.capacity
+            self.times[i] = timestamp
+            for k in range(len(columns)):
+                columns[k][i] = response[k]
+            self.count += 1
+
+    def clear(self):
+        with self._lock:
+            self.count = self.frames = 0
+            self.last_seen = None
+
+    def _column(self, field):
+        try:
+            return self.columns[field]
+        except KeyError:
+            raise ValueError(f"Unknown status field: {field}") from None
+
+    def _oldest(self):
+        return max(0, self.count - self.capacity)
+
+    def _index_at(self, t):
+        """Sequence number of the newest sample at or before t, or None (binary search)."""
+        lo, hi = self._oldest(), self.count
+        times, capacity = self.times, self.capacity
+        if lo == hi or times[lo % capacity] > t:
+            return None
+        while hi - lo > 1:
+            mid = (lo + hi) // 2
+            if times[mid % capacity] <= t:
+                lo = mid
+            else:
+                hi = mid
+        return lo
+
+    def value_at(self, field, t: float):
+        """Raw value of `field` at monotonic time t, or None before the oldest sample."""
+        column = self._column(field)
+        with self._lock:
+            n = self._index_at(t)
+            return None if n is None else column[n % self.capacity]
+
+    def last_change(self, field, to: int = None):
+        """Monotonic time `field` last changed (to the value `to`, if given), or None."""
+        column = self._column(field)
+        with self._lock:
+            capacity = self.capacity
+            for n in range(self.count - 1, self._oldest(), -1):
+                value = column[n % capacity]
+                if value != column[(n - 1) % capacity] and (to is None or value == to):
+                    return self.times[n % capacity]
         return None
 
-    packet = build_packet(cmd, payload)
-    expected_reply_cmd = CMD_REPLY_MAP.get(cmd)
-    # print(f"Sending packet: {packet.hex()} (CMD: 0x{cmd:02X}, Expected Reply: 0x{expected_reply_cmd:02X})")
-    for attempt in range(retries + 1):
-        with serial_lock:
-            ser.reset_input_buffer()
+    def last_idle(self, field):
+        """Monotonic time of the last busy -> idle edge of `field`, e.g. last_idle('motor2')."""
+        return self.last_change(field, 0)
+
+    def duty_cycle(self, field, seconds: float = 60.0, now: float = None):
+        """Fraction of the last `seconds` during which `field` was non-zero.
+
+        Only time covered by the history counts, from the oldest sample to the newest
+        frame. None if the window holds no history at all.
+        """
+        column = self._column(field)
+        if now is None:
+            now = time.monotonic()
+        start = now - seconds
+        busy = covered = 0.0
+        with self._lock:
+            if self.last_seen is None:
+                return None
+            capacity = self.capacity
+            end = min(now, self.last_seen)
+            # Walk back from the newest sample; each one holds until the next one.
+            for n in range(self.count - 1, self._oldest() - 1, -1):
+                t = self.times[n % capacity]
+                if t < end:
+                    span = end - max(t, start)
+                    if span > 0:
+                        covered += span
+                        if column[n % capacity]:
+                            busy += span
+                    end = t
+                if t <= start:
+                    break
+        return busy / covered if covered > 0 else None
+
+    def samples(self, seconds: float = None):
+        """(timestamp, {field: value}) for every sample of the last `seconds`, oldest first."""
+        cutoff = None if seconds is None else time.monotonic() - seconds
+        rows = []
+        with self._lock:
+            capacity = self.capacity
+            for n in range(self._oldest(), self.count):
+                i = n % capacity
+                if cutoff is None or self.times[i] >= cutoff:
+                    rows.append((self.times[i], {field: column[i] for field, column in self.columns.items()}))
+        return rows
+
+    def export_csv(self, file, interval: float = 1.0, start: float = None, end: float = None):
+        """Write the status in effect every `interval` seconds from `start` to `end` as CSV.
+
+        `file` is a path or a text file object; times are seconds since `start` (default:
+        the oldest sample). Returns the number of rows written.
+        """
+        if interval <= 0:
+            raise ValueError("Interval must be positive")
+        if isinstance(file, (str, os.PathLike)):
+            with open(file, "w", newline="") as f:
+                return self.export_csv(f, interval, start, end)
+        with self._lock:
+            count, capacity = self.count, self.capacity
+            if count == 0:
+                return 0
+            if start is None:
+                start = self.times[self._oldest() % capacity]
+            if end is None:
+                end = self.last_seen
+            file.write("time_s," + ",".join(STATUS_FIELDS) + "\n")
+            n = self._index_at(start)
+            rows = 0
+            k = 0
+            while start + k * interval <= end:
+                t = start + k * interval
+                k += 1
+                if n is None:
+                    n = self._index_at(t)
+                    if n is None:
+                        continue
+                while n + 1 < count and self.times[(n + 1) % capacity] <= t:
+                    n += 1
+                i = n % capacity
+                file.write(f"{t - start:.3f}," + ",".join(str(column[i]) for column in self._columns) + "\n")
+                rows += 1
+        return rows
+
+# --------------------------------------------------------------------------------------------------------------
+#-----------------Tracing---------------------------------------------------------------------------------------
+def traced(name, with_cmd=False):
+    """Record calls of a Robot method as `name` spans while the robot has a tracer.
+
+    With with_cmd=True the first argument (the opcode) is attached to the span.
+    """
+    def decorate(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            tracer = self.tracer
+            if tracer is None:
+                return method(self, *args, **kwargs)
+            begin = tracer.now()
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                tracer.span(name, begin, cmd=(args[0] if args else kwargs['cmd']) if with_cmd else -1)
+        return wrapper
+    return decorate
+
+# --------------------------------------------------------------------------------------------------------------
+#-----------------Robot-----------------------------------------------------------------------------------------
+class Robot:
+    """One brain board: its serial connection, reader and status threads, status and metrics.
+
+    Nothing is opened until connect() (or the first command) runs. The module-level
+    functions drive a default Robot; create more instances to drive several brains from
+    one process.
+    """
+
+    def __init__(self, port: str = None, connection=None, name: str = None, history_capacity: int = 65536,
+                 protocol: int = PROTOCOL_V1):
+        self.port = port
+        self.name = name or port
+        self.ser = None
+        self._connection = connection
+        self._connect_lock = threading.Lock()
+        self.serial_lock = threading.Lock()
+        self.serial_command_queue = queue.PriorityQueue()  # (priority, sequence, SerialCommand)
+        self._queue_sequence = itertools.count()
+        self.serial_worker_running = False
+        # Writers of stop frames waiting for serial_lock; other writers hold back while > 0.
+        self._urgent_writers = 0
+        self._lanes = threading.Condition()
+        self.stop_generation = 0    # bumped by every stop, ends retries started before it
+
+        # Status and busy -> idle edges. One condition per resource, all sharing status_lock,
+        # so a finished motor only wakes the callers waiting on that motor.
+        self.status = DeviceStatus()
+        self.status_lock = threading.Lock()
+        self.status_conditions = {field: threading.Condition(self.status_lock) for field in STATUS_EDGE_FIELDS}
+        self.status_idle_edges = dict.fromkeys(STATUS_EDGE_FIELDS, 0)
+        # Callables run on the poller thread as listener(field) after each busy -> idle edge.
+        # They must not block; the asyncio API uses them to wake its waiters.
+        self.status_edge_listeners = []
+        # Subscribers run on the poller thread, only for frames that change a field they watch.
+        self.status_subscribers = []        # (callback, frozenset of fields or None for all)
+        self._status_printer = None
+        self.status_history = StatusHistory(history_capacity)     # every status frame, changes only
+
+        # Status poller
+        self.polling_policy = PollingPolicy()
+        self.status_waiters = 0             # callers currently blocked on a status edge
+        self.status_thread = None
+        self.status_thread_running = False
+        self._poller_wakeup = threading.Event()
+        self._poll_requested = False
+
+        # Reader thread and reply dispatcher. Frames nobody is waiting for (late replies,
+        # replies to retried requests) are kept in unsolicited_frames.
+        self.reader_thread = None
+        self.reader_running = False
+        self.reader_decoder = None
+        self.reader_selects = True          # wait on the port's fd when it has one
+        self._reader_wakeup = None          # (read fd, write fd) of the reader's wakeup pipe
+        self._reader_wakeup_lock = threading.Lock()
+        self.pending_lock = threading.Lock()
+        self.pending_replies = {}                                   # reply cmd -> deque of Futures, oldest first
+        self.pending_sequences = {}                                 # v2 sequence number -> Future
+        # Framing: the newest protocol connect() offers, and what the brain agreed to.
+        self.protocol_preference = protocol
+        self.protocol = PROTOCOL_V1
+        self.window = None                  # v2 requests in flight at most
+        self._window_slots = None           # RequestWindow of `window` slots
+        self._sequence = 0
+        self.unsolicited_frames = collections.deque(maxlen=256)     # (timestamp, cmd, payload)
+        self.link_stats = LinkStats(self)
+        self.rtt_estimators = {}                                    # request cmd -> RttEstimator
+        self.link_rtt = RttEstimator()                              # all opcodes, for opcodes not yet measured
+        # reply cmd -> callable(payload) for frames no request is waiting for (sensor streaming)
+        self.reply_sinks = {}
+        self.sensor_stream = None
+        # Callables run on the reader thread as listener(port, value) for each streamed sample.
+        self.sensor_listeners = []
+        self.recorder = None        # record.SessionRecorder while recording
+        self.tracer = None          # trace.Tracer while tracing
+
+        self._batch_state = threading.local()
+
+    def __repr__(self):
+        return f"Robot({self.name!r})"
+
+    # -- connection ----------------------------------------------------------------------------------------
+    def connect(self, port: str = None, connection=None, timeout: float = 5.0):
+        """Open the brain's serial port, wait for it to answer and start the status poller.
+
+        `connection` is an already open pyserial-compatible object (for example
+        algopython.sim.LoopbackSerial) to use instead of opening `port`. Returns as soon as
+        a GET_STATUS handshake succeeds, or False if the brain does not answer within
+        `timeout` seconds.
+        """
+        port = port or self.port
+        connection = connection or self._connection
+        opened = connection is None
+        if connection is None and not port:
+            # Reuse the port that answered the discovery probe instead of reopening it.
+            brains = discover_brains(first_only=True)
+            if not brains:
+                print("USB port not found. Please connect the device and try again.")
+                return False
+            port, connection = brains[0]
+        if connection is not None:
+            port = getattr(connection, 'port', connection)
+        else:
+            try:
+                connection = serial.Serial(
+                    port=port,
+                    baudrate=115200,
+                    parity=serial.PARITY_NONE,
+                    stopbits=serial.STOPBITS_ONE,
+                    bytesize=serial.EIGHTBITS,
+                    timeout=0.5
+                )
+            except serial.SerialException as e:
+                print(f"\nError when opening port: {port}: {e}\n")
+                return False
+
+        previous, self.ser = self.ser, connection
+        self.reader_start()
+        self.wake_reader()
+        if previous is not None and previous is not connection:
+            # Reconnecting: the reader has moved on to the new port, release the old one.
+            previous.close()
+        status = self.handshake(timeout)
+        if status is None:
+            print(f"No answer from the brain on {port} within {timeout} s.")
+            self.ser = None
+            self.wake_reader()
+            connection.close()
+            return False
+        if opened:
+            # Reconnect to the same device later; a handed-in connection can't be reopened.
+            self.port = port
+        self._connection = None
+        if self.name is None:
+            self.name = str(port)
+        print(f"Serial port: {port}")
+        self.negotiate_protocol()
+        self.apply_status(status)
+        self.serial_thread_start()
+        return True
+
+    def handshake(self, timeout: float = 5.0, attempt_timeout: float = 0.1):
+        """Send GET_STATUS until the brain answers; returns the status payload or None.
+
+        Boards that reset when the port opens answer after they boot, so this retries
+        with a short per-attempt timeout instead of sleeping a fixed time up front.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            future = self.submit_packet(ALGOPYTHON_CMD_GET_STATUS_REQ, b"")
+            reply = self.wait_for_reply(ALGOPYTHON_CMD_GET_STATUS_REP, min(attempt_timeout, remaining), future)
+            if reply is not None and len(reply) >= 10:
+                return reply
+
+    def negotiate_protocol(self, timeout: float = 0.2):
+        """Offer protocol_preference to the brain with a v1 HELLO and return the protocol in use.
+
+        The brain answers with the version it agrees to and how many requests it can have
+        in flight; firmware that doesn't know HELLO doesn't answer and the link stays v1.
+        """
+        self.protocol = PROTOCOL_V1
+        self.window = None
+        self._window_slots = None
+        self._set_decoder_protocol()
+        if self.protocol_preference < PROTOCOL_V2:
+            return self.protocol
+        future = self.submit_packet(ALGOPYTHON_CMD_HELLO_REQ, bytes([self.protocol_preference, PROTOCOL_WINDOW]))
+        reply = self.wait_for_reply(ALGOPYTHON_CMD_HELLO_REP, timeout, future)
+        if reply is not None and len(reply) >= 2 and reply[0] >= PROTOCOL_V2:
+            self.window = max(1, min(PROTOCOL_WINDOW, reply[1]))
+            self._window_slots = RequestWindow(self.window)
+            self.protocol = PROTOCOL_V2
+            self._set_decoder_protocol()
+            print(f"Protocol v2, {self.window} requests in flight")
+        return self.protocol
+
+    def _set_decoder_protocol(self):
+        # The reader decodes only the frames of the protocol in use.
+        decoder = self.reader_decoder
+        if decoder is not None:
+            decoder.protocol = self.protocol
+
+    def ensure_connection(self):
+        """Connect on first use, so creating a Robot never touches a serial port."""
+        if self.ser is not None:
+            return True
+        with self._connect_lock:
+            if self.ser is not None:
+                return True
+            return self.connect()
+
+    def close(self):
+        self.stop_sensor_stream()
+        self.stop_recording()
+        # Let the poller and then the reader finish before the port goes away.
+        self.stop_status_monitor(verbose=False)
+        self.preempt_polls()
+        current = threading.current_thread()
+        if self.status_thread is not None and self.status_thread is not current:
+            self.status_thread.join()
+        self.reader_stop()
+        if self.reader_thread is not None and self.reader_thread is not current:
+            self.reader_thread.join()
+        port, self.ser = self.ser, None
+        self.wake_reader()
+        if port is not None:
+            port.close()
+
+    # -- status edges --------------------------------------------------------------------------------------
+    def status_edge_snapshot(self):
+        with self.status_lock:
+            return dict(self.status_idle_edges)
+
+    @traced("wait_for_idle")
+    def wait_for_idle(self, fields, since, timeout=None):
+        """Sleep until every field in `fields` went busy -> idle after the `since` snapshot.
+
+        Returns False if `timeout` seconds pass first.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.watching_status(), self.status_lock:
+            for field in fields:
+                condition = self.status_conditions[field]
+                while self.status_idle_edges[field] <= since[field]:
+                    if deadline is None:
+                        condition.wait()
+                        continue
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or not condition.wait(remaining):
+                        if self.status_idle_edges[field] <= since[field]:
+                            return False
+        return True
+
+    # -- status polling ------------------------------------------------------------------------------------
+    def set_polling_policy(self, fast_interval=0.01, idle_interval=0.5, backoff=2.0):
+        self.polling_policy = PollingPolicy(fast_interval, idle_interval, backoff)
+        self._poller_wakeup.set()
+        return self.polling_policy
+
+    def request_status_poll(self):
+        """Ask the poller for a GET_STATUS right away instead of at its next interval."""
+        self._poll_requested = True
+        self._poller_wakeup.set()
+
+    @contextlib.contextmanager
+    def watching_status(self):
+        """Keep the poller at its fast rate while the block runs."""
+        with self.status_lock:
+            self.status_waiters += 1
+        self.request_status_poll()
+        try:
+            yield
+        finally:
+            with self.status_lock:
+                self.status_waiters -= 1
+
+    def status_is_active(self):
+        s = self.status
+        return self.status_waiters > 0 or any(getattr(s, field) for field in STATUS_EDGE_FIELDS)
+
+    def serial_thread_task(self):
+        interval = self.polling_policy.fast_interval
+        next_poll = time.monotonic()
+        while self.status_thread_running:
+            self._poller_wakeup.wait(max(0, next_poll - time.monotonic()))
+            self._poller_wakeup.clear()
+
+            # Process queued commands
+            while True:
+                try:
+                    _, _, command = self.serial_command_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if command is not None:
+                    tracer = self.tracer
+                    if tracer is not None:
+                        tracer.span("queue_wait", command.queued_at, cmd=command.cmd)
+                    self.serial_send_next_command(command)
+
+            now = time.monotonic()
+            if self._poll_requested or now >= next_poll:
+                self._poll_requested = False
+                self.serial_get_brain_status()
+                interval = self.polling_policy.next_interval(interval, self.status_is_active())
+                next_poll = time.monotonic() + interval
+
+    def serial_thread_start(self):
+        if self.status_thread_running:
+            return
+        self.status_thread_running = True
+        self.status_thread = threading.Thread(target=self.serial_thread_task, daemon=True)
+        self.status_thread.start()
+
+    def stop_status_monitor(self, verbose=True):
+        self.status_thread_running = False
+        self._poller_wakeup.set()
+        if verbose:
+            print("Status monitor stopped.")
+
+    def serial_get_brain_status(self):
+        response = self.serial_send_command(ALGOPYTHON_CMD_GET_STATUS_REQ, b"", expect_reply=True, background=True)
+
+        if not response or len(response) < 10:
+            return "?, ?, ?, ?, ?, ?, ?, ?, ?, ?"
+        self.apply_status(response)
+
+    def apply_status(self, response):
+        """Update the DeviceStatus from a GET_STATUS payload and signal any changes."""
+        s = self.status
+        with self.status_lock:
+            previous = {field: getattr(s, field) for field in STATUS_FIELDS}
+
+            s.motor1 = response[0]
+            s.motor2 = response[1]
+            s.motor3 = response[2]
+            s.led1 = bool(response[3])
+            s.led2 = bool(response[4])
+            s.sound = bool(response[5])
+            s.sensor1 = bool(response[6])
+            s.sensor2 = bool(response[7])
+            s.sensor1_value = response[8]
+            s.sensor2_value = response[9]
+            self.status_history.append(response)
+
+            finished = []
+            for field in STATUS_EDGE_FIELDS:
+                if previous[field] and not getattr(s, field):
+                    self.status_idle_edges[field] += 1
+                    self.status_conditions[field].notify_all()
+                    finished.append(field)
+
+        for field in finished:
+            for listener in self.status_edge_listeners:
+                listener(field)
+
+        changes = {field: (previous[field], getattr(s, field))
+                   for field in STATUS_FIELDS if previous[field] != getattr(s, field)}
+        if changes:
+            self.notify_status_subscribers(changes)
+
+    # -- status subscriptions ------------------------------------------------------------------------------
+    def subscribe_status(self, callback, fields=None):
+        """Call callback({field: (old, new)}) whenever a watched DeviceStatus field changes.
+
+        Returns a handle for unsubscribe_status(). Callbacks must return quickly.
+        """
+        if fields is not None:
+            fields = frozenset(fields)
+            unknown = fields - set(STATUS_FIELDS)
+            if unknown:
+                raise ValueError(f"Unknown status fields: {sorted(unknown)}")
+        handle = (callback, fields)
+        self.status_subscribers.append(handle)
+        return handle
+
+    def unsubscribe_status(self, handle):
+        try:
+            self.status_subscribers.remove(handle)
+        except ValueError:
+            pass
+
+    def notify_status_subscribers(self, changes):
+        for callback, fields in list(self.status_subscribers):
+            if fields is None:
+                callback(changes)
+                continue
+            watched = {field: change for field, change in changes.items() if field in fields}
+            if watched:
+                callback(watched)
+
+    def print_status(self, changes=None):
+        s = self.status
+        print(
+            f"Motors: {s.motor1}, {s.motor2}, {s.motor3} | "
+            f"LEDs: {int(s.led1)}, {int(s.led2)} | "
+            f"Sound: {int(s.sound)} | "
+            f"Sensors: Trig1={int(s.sensor1)}, Trig2={int(s.sensor2)}, "
+            f"Value1={s.sensor1_value}, Value2={s.sensor2_value}"
+        )
+
+    def set_status_printing(self, enabled: bool):
+        """Print the status line whenever it changes (off by default)."""
+        if enabled and self._status_printer is None:
+            self._status_printer = self.subscribe_status(self.print_status)
+        elif not enabled and self._status_printer is not None:
+            self.unsubscribe_status(self._status_printer)
+            self._status_printer = None
+
+    # -- command queue -------------------------------------------------------------------------------------
+    def start_serial_worker(self):
+        if not self.serial_worker_running:
+            self.serial_worker_running = True
+            threading.Thread(target=self.serial_worker_loop, daemon=True).start()
+
+    def stop_serial_worker(self):
+        self.serial_worker_running = False
+        # Wake the blocked get(); the sentinel sorts before every real command.
+        self.serial_command_queue.put((PRIORITY_STOP - 1, next(self._queue_sequence), None))
+
+    def serial_worker_loop(self):
+        while self.serial_worker_running:
+            _, _, command = self.serial_command_queue.get()
+            if command is None:
+                continue
+            tracer = self.tracer
+            if tracer is not None:
+                tracer.span("queue_wait", command.queued_at, cmd=command.cmd)
+            result = self.send_packet(
+                command.cmd,
+                command.payload,
+                wait_done=True,
+                verbose=True
+            )
+            command.response = result
+            command.done.set()
+
+    def serial_queue_command(self, cmd, payload, expect_reply=True, priority=None):
+        command = SerialCommand(cmd, payload, expect_reply, priority)
+        if command.priority == PRIORITY_STOP:
+            # Free the poller if it is stuck retrying a status request.
+            self.begin_stop()
+        self.serial_command_queue.put((command.priority, next(self._queue_sequence), command))
+        self.link_stats.record_queue_depth(self.serial_command_queue.qsize())
+        self._poller_wakeup.set()
+        command.done.wait()
+        return command.response
+
+    def serial_send_command(self, cmd, payload, expect_reply=True, background=False):
+        command = SerialCommand(cmd, payload, expect_reply, background=background)
+        self.serial_send_next_command(command)
+        command.done.wait()
+        return command.response
+
+    def serial_send_next_command(self, command):
+        result = self.send_packet(
+                command.cmd,
+                command.payload,
+                wait_done=command.expect_reply,
+                verbose=True,
+                priority=command.priority,
+                background=command.background
+                )
+        command.response = result
+        command.done.set()
+
+    # -- sending -------------------------------------------------------------------------------------------
+    @traced("send_packet", with_cmd=True)
+    def send_packet(self, cmd, payload, wait_done=True, delay_after=0, retries=None, verbose=True, priority=None,
+                    deadline: float = None, background: bool = False):
+        """Send one frame and wait for its reply, retrying on adaptive timeouts.
+
+        Each attempt waits for the opcode's current retransmission timeout, doubled per
+        retry. The call gives up after `retries` retries or, when given, once `deadline`
+        seconds have passed. With neither it retries for up to SEND_DEADLINE seconds.
+        background=True marks the poller's status polls, the only requests a stop preempts.
+        """
+        pending_batch = self.current_batch()
+        if pending_batch is not None:
+            pending_batch.commands.append((cmd, bytes(payload)))
+            return None
+
+        if not self.ensure_connection():
+            print("[Error] Serial port is not initialized.")
+            return None
+
+        if priority is None:
+            priority = command_priority(cmd)
+        if priority == PRIORITY_STOP:
+            self.begin_stop()
+            if deadline is None:
+                retries = max(retries or 0, STOP_RETRIES)
+        elif retries is None and deadline is None:
+            deadline = SEND_DEADLINE
+        generation = self.stop_generation
+        give_up_at = None if deadline is None else time.monotonic() + deadline
+
+        packet = build_packet(cmd, payload)
+        expected_reply_cmd = CMD_REPLY_MAP.get(cmd)
+        # print(f"Sending packet: {packet.hex()} (CMD: 0x{cmd:02X}, Expected Reply: 0x{expected_reply_cmd:02X})")
+        if expected_reply_cmd is None:
+            if not self.serial_write(packet, priority):
+                return None
+            self.link_stats.record_sent(cmd)
+            return True
+
+        attempt = 0
+        while True:
+            if self.ser is None:
+                return None     # closed meanwhile
             # if verbose:
             #     print(f"\n[Try {attempt + 1}] Sending packet: " + ' '.join(f'{b:02X}' for b in packet))
-            ser.write(packet)
-            time.sleep(delay_after)
-            # if wait_done:
-            if True:
-                reply = wait_for_reply(expected_reply_cmd)
-                if reply is not None:
-                    return reply
+            reply_timeout = self.retransmit_timeout(cmd, attempt)
+            if priority == PRIORITY_STOP:
+                reply_timeout = min(reply_timeout, STOP_REPLY_TIMEOUT)
+            if give_up_at is not None:
+                reply_timeout = min(reply_timeout, give_up_at - time.monotonic())
+            if attempt:
+                if priority != PRIORITY_STOP and (background or cmd not in POLL_COMMANDS) \
+                        and self.stop_generation != generation:
+                    # A stop went out meanwhile; re-sending could undo it.
+                    if verbose and priority == PRIORITY_COMMAND:
+                        print(f"[Preempted] CMD 0x{cmd:02X} not retried after a stop.")
+                    return None
+                self.link_stats.record_retry(cmd)
+                if self.tracer is not None:
+                    self.tracer.instant("retry", cmd)
+            reply_future = self.submit_packet(cmd, payload, packet, priority)
+            if reply_future is None:
+                # The v2 window stayed full for a whole retransmission timeout: nothing was
+                # sent, so this attempt is lost.
+                attempt += 1
+                if retries is not None and attempt > retries:
+                    break
+                if give_up_at is not None and time.monotonic() >= give_up_at:
+                    break
+                continue
+            # Karn's rule: a reply to a retransmission may answer an earlier attempt.
+            reply_future.retransmission = attempt > 0
+            if background:
+                reply_future.background_poll = True
+                if self.stop_generation != generation:
+                    # A stop's preempt_polls() ran before the flag was set.
+                    self.cancel_reply(expected_reply_cmd, reply_future)
+                    return None
+            tracer = self.tracer
+            if delay_after:
+                begin = time.perf_counter()
+                time.sleep(delay_after)
+                if tracer is not None:
+                    tracer.span("delay_after", begin)
+            if tracer is None:
+                reply = self.wait_for_reply(expected_reply_cmd, reply_timeout, reply_future)
             else:
-                return True
-    if verbose:
-        print(f"[Fail] No reply for CMD 0x{cmd:02X} after {retries + 1} tries.")
-    return None
+                begin = tracer.now()
+                reply = self.wait_for_reply(expected_reply_cmd, reply_timeout, reply_future)
+                tracer.span("wait_for_reply", begin, cmd=expected_reply_cmd)
+                if reply is None:
+                    tracer.instant("reply_timeout", cmd)
+            if reply is not None:
+                return reply
+            attempt += 1
+            if retries is not None and attempt > retries:
+                break
+            if give_up_at is not None and time.monotonic() >= give_up_at:
+                break
+        self.link_stats.record_failure(cmd)
+        if verbose:
+            print(f"[Fail] No reply for CMD 0x{cmd:02X} after {attempt} tries.")
+        return None
 
-def wait_for_reply(expected_cmd, timeout=1):
-    global ser
-    start = time.time()
-    buffer = bytearray()
-    #print(f"Waiting for reply for CMD 0x{expected_cmd:02X}...")
-    while time.time() - start < timeout:
-        if ser.in_waiting:
-            # print("Serianl in waiting: ", ser.in_waiting);
-            buffer.extend(ser.read(ser.in_waiting))
-        while len(buffer) >= 4:
-            # print("Buffer length: ", len(buffer))
-            # print("Buffer content: ", buffer.hex())
-            if buffer[0] == 0xA5:
-                cmd, size = buffer[1], buffer[2]
-                total_length = 3 + size + 1
-                if len(buffer) >= total_length:
-                    crc = buffer[3 + size]
-                    #print("CRC: ", crc, "Expected: ", (sum(buffer[:total_length - 1])&0xff) )
-                    if cmd == expected_cmd and crc == sum(buffer[:total_length - 1])&0xff:
-                        return buffer[3:3+size]
-                    buffer = buffer[1:]
-                else:
+    def retransmit_timeout(self, cmd, attempt=0):
+        """How long attempt number `attempt` (0 for the first) of `cmd` waits for its reply."""
+        estimator = self.rtt_estimators.get(cmd)
+        if estimator is None:
+            estimator = self.link_rtt
+        return estimator.timeout(attempt)
+
+    def get_rtt_estimates(self):
+        """Per-opcode SRTT, RTTVAR and current retransmission timeout, plus the link-wide estimate."""
+        estimates = {f"0x{cmd:02X}": estimator.snapshot() for cmd, estimator in sorted(self.rtt_estimators.items())}
+        estimates["link"] = self.link_rtt.snapshot()
+        return estimates
+
+    def submit_packet(self, cmd, payload, packet=None, priority=None, block=True):
+        """Write one frame without waiting and return the Future its reply will resolve.
+
+        Returns None when the command has no reply code, or when the v2 window is full
+        (see prepare_request()) and nothing was written.
+        """
+        if priority is None:
+            priority = command_priority(cmd)
+        request = self.prepare_request(cmd, payload, packet, priority, block)
+        if request is None:
+            return None
+        packet, reply_future = request
+        if not self.serial_write(packet, priority):
+            if reply_future is not None:
+                self.cancel_reply(CMD_REPLY_MAP[cmd], reply_future)
+            return None
+        self.link_stats.record_sent(cmd)
+        if reply_future is not None:
+            reply_future.sent_at = time.perf_counter()
+        return reply_future
+
+    def prepare_request(self, cmd, payload, packet=None, priority=None, block=True):
+        """Frame a request in the negotiated protocol and register the Future for its reply.
+
+        Returns (packet, future); future is None for commands without a reply code.
+        `packet` is a prebuilt v1 frame to reuse; in v2 every call takes a new sequence
+        number and, except for stops, a slot of the window, freed when the Future is done.
+        Nothing is ever sent beyond the window: if it is full this returns None, right away
+        with block=False (wait on window_slot_free() then), otherwise after waiting for a
+        slot for up to one retransmission timeout.
+        """
+        reply_cmd = CMD_REPLY_MAP.get(cmd)
+        slots = self._window_slots
+        if slots is None or reply_cmd is None:
+            if packet is None:
+                packet = build_packet(cmd, payload)
+            # Register before writing so a fast reply can't slip past as unsolicited.
+            return packet, self.expect_reply(reply_cmd, cmd) if reply_cmd is not None else None
+        if priority is None:
+            priority = command_priority(cmd)
+        acquired = priority != PRIORITY_STOP
+        if acquired and not slots.try_acquire():
+            if not block:
+                return None
+            # Slots come back as replies arrive or their waiters give up. Don't wait
+            # longer than a reply would take: the caller may itself be holding the
+            # slots of requests whose replies were lost.
+            give_up_at = time.monotonic() + self.retransmit_timeout(cmd)
+            while not slots.try_acquire():
+                remaining = give_up_at - time.monotonic()
+                if remaining <= 0:
+                    return None
+                try:
+                    slots.when_free().result(remaining)
+                except concurrent.futures.TimeoutError:
+                    return None
+        with self.pending_lock:
+            for _ in range(255):
+                self._sequence = self._sequence % 255 + 1
+                if self._sequence not in self.pending_sequences:
                     break
+            sequence = self._sequence
+        future = self.expect_reply(reply_cmd, cmd, sequence)
+        if acquired:
+            future.add_done_callback(lambda _: slots.release())
+        return build_packet_v2(cmd, sequence, payload), future
+
+    def window_slot_free(self):
+        """A Future that is done once a v2 window slot may be free, for callers that must not
+        block: retry submit_packet(..., block=False) when it is."""
+        slots = self._window_slots
+        if slots is not None:
+            return slots.when_free()
+        future = concurrent.futures.Future()
+        future.set_result(None)
+        return future
+
+    def serial_write(self, data, priority=PRIORITY_COMMAND):
+        """Write to the port under serial_lock, recording how long the lock took to get.
+
+        A stop waits for at most the one write already in progress: other writers hold
+        back while a stop is waiting for the lock. Returns False, writing nothing, once the
+        port is closed.
+        """
+        requested = time.perf_counter()
+        if priority == PRIORITY_STOP:
+            with self._lanes:
+                self._urgent_writers += 1
+            try:
+                return self._write_locked(data, requested)
+            finally:
+                with self._lanes:
+                    self._urgent_writers -= 1
+                    self._lanes.notify_all()
+        if self._urgent_writers:
+            with self._lanes:
+                while self._urgent_writers:
+                    self._lanes.wait()
+        return self._write_locked(data, requested)
+
+    def _write_locked(self, data, requested):
+        with self.serial_lock:
+            locked = time.perf_counter()
+            self.link_stats.record_lock_wait(locked - requested)
+            port = self.ser
+            if port is None:
+                return False
+            port.write(data)
+            recorder = self.recorder
+            if recorder is not None:
+                recorder.tx(data)
+        tracer = self.tracer
+        if tracer is not None:
+            tracer.span("lock_wait", requested, locked)
+            tracer.span("write", locked, cmd=data[1] if len(data) > 1 else -1)
+        return True
+
+    def wait_for_reply(self, expected_cmd, timeout=1, future=None):
+        """Wait for the reader thread to route an `expected_cmd` frame and return its payload."""
+        if future is None:
+            future = self.expect_reply(expected_cmd)
+        try:
+            return future.result(timeout)
+        except concurrent.futures.CancelledError:
+            # Preempted by a stop.
+            return None
+        except concurrent.futures.TimeoutError:
+            if self.cancel_reply(expected_cmd, future):
+                return None
+            # The reply was dispatched just as the timeout fired.
+            return future.result()
+
+    def send_many(self, commands, timeout=None, retries=2, verbose=True):
+        """Write several (cmd, payload) frames with a single write and wait for all their replies.
+
+        Returns one reply payload per command, in order (True for commands without a reply
+        code, None for commands that got no reply). Only the unanswered commands are retried.
+        Each attempt waits `timeout` seconds, or the longest retransmission timeout of the
+        commands in it.
+        """
+        if not self.ensure_connection():
+            print("[Error] Serial port is not initialized.")
+            return [None] * len(commands)
+
+        if not commands:
+            return []
+        replies = [None] * len(commands)
+        todo = list(range(len(commands)))
+        for attempt in range(retries + 1):
+            priority = min(command_priority(commands[i][0]) for i in todo)
+            sent = []       # (index, future) of the commands written in this attempt
+            chunk = []      # (packet, future) not written yet
+            for i in todo:
+                cmd, payload = commands[i]
+                if attempt:
+                    self.link_stats.record_retry(cmd)
+                request = self.prepare_request(cmd, payload, priority=priority, block=False)
+                if request is None:
+                    # The v2 window is full: put what we have on the wire, then wait for a slot.
+                    self._write_chunk(chunk, attempt, priority)
+                    request = self.prepare_request(cmd, payload, priority=priority)
+                    if request is None:
+                        continue    # still full: not sent, so it stays unanswered this attempt
+                chunk.append(request)
+                sent.append((i, request[1]))
+            self._write_chunk(chunk, attempt, priority)
+            if timeout is None:
+                attempt_timeout = max(self.retransmit_timeout(commands[i][0], attempt) for i in todo)
             else:
-                buffer = buffer[1:]
-        time.sleep(0.005)
-    return None
+                attempt_timeout = timeout
+            deadline = time.monotonic() + attempt_timeout
+            for i, future in sent:
+                if future is None:
+                    replies[i] = True
+                    continue
+                reply_cmd = CMD_REPLY_MAP[commands[i][0]]
+                replies[i] = self.wait_for_reply(reply_cmd, max(0, deadline - time.monotonic()), future)
+            todo = [i for i in todo if replies[i] is None]
+            if not todo:
+                break
+        for i in todo:
+            self.link_stats.record_failure(commands[i][0])
+        if todo and verbose:
+            failed = ", ".join(f"0x{commands[i][0]:02X}" for i in todo)
+            print(f"[Fail] No reply for CMD {failed} after {retries + 1} tries.")
+        return replies
+
+    def _write_chunk(self, chunk, attempt, priority):
+        if not chunk:
+            return
+        self.serial_write(b"".join(packet for packet, _ in chunk), priority)
+        sent_at = time.perf_counter()
+        for packet, future in chunk:
+            self.link_stats.record_sent(packet[1])
+            if future is not None:
+                future.sent_at = sent_at
+                future.retransmission = attempt > 0
+        chunk.clear()
+
+    # -- batched commands ----------------------------------------------------------------------------------
+    # Inside `with robot.batch():` send_packet() only records frames. They are written together
+    # when the block exits, so e.g. three motors and both LEDs start within one link round trip.
+    def current_batch(self):
+        return getattr(self._batch_state, 'current', None)
+
+    def batch_defer_wait(self, fields):
+        """Inside a batch, record `fields` for the batch to wait on and return True."""
+        pending_batch = self.current_batch()
+        if pending_batch is None:
+            return False
+        pending_batch.wait_fields.extend(f for f in fields if f not in pending_batch.wait_fields)
+        return True
 
-# You can import send_command from this file into algopython_cmd.py and replace all uses of send_packet.
+    @contextlib.contextmanager
+    def batch(self, is_blocking=False, timeout=None):
+        """Collect the frames of the calls made in the block and send them in one write.
 
+        With is_blocking=True the exit also waits for every motor/LED/sound/sensor that the
+        calls in the block would have waited on. Nothing is sent if the block raises.
+        """
+        pending_batch = CommandBatch()
+        outer = self.current_batch()
+        self._batch_state.current = pending_batch
+        try:
+            yield pending_batch
+        finally:
+            self._batch_state.current = outer
+
+        if outer is not None:
+            # Nested batch: hand everything to the enclosing one.
+            outer.commands.extend(pending_batch.commands)
+            self.batch_defer_wait(pending_batch.wait_fields)
+            return
+        since = self.status_edge_snapshot()
+        pending_batch.replies = self.send_many(pending_batch.commands)
+        if is_blocking and pending_batch.wait_fields:
+            pending_batch.completed = self.wait_for_idle(pending_batch.wait_fields, since, timeout)
+
+    # -- metrics -------------------------------------------------------------------------------------------
+    def get_link_stats(self, reset: bool = False):
+        """Snapshot of the link counters; with reset=True start a new measurement window."""
+        snapshot = self.link_stats.snapshot()
+        if reset:
+            self.link_stats.reset()
+        return snapshot
+
+    def reset_link_stats(self):
+        self.link_stats.reset()
+
+    # -- session recording ---------------------------------------------------------------------------------
+    def start_recording(self, path, flush_bytes: int = 64 * 1024, flush_interval: float = 0.5):
+        """Append every byte written to and read from the port to a session log at `path`.
+
+        Replay the log with algopython.record.SessionReplay.
+        """
+        from .record import SessionRecorder
+        self.stop_recording()
+        self.recorder = SessionRecorder(path, flush_bytes, flush_interval)
+        return self.recorder
+
+    def stop_recording(self):
+        recorder, self.recorder = self.recorder, None
+        if recorder is not None:
+            recorder.close()
+
+    # -- tracing -------------------------------------------------------------------------------------------
+    def start_tracing(self, capacity: int = 65536):
+        """Record spans of API calls and their serial phases into a new trace.Tracer.
+
+        Export it with tracer.export_chrome(path) for chrome://tracing or Perfetto.
+        """
+        from .trace import Tracer
+        self.tracer = Tracer(capacity)
+        return self.tracer
+
+    def stop_tracing(self):
+        """Stop tracing and return the tracer (None if not tracing)."""
+        tracer, self.tracer = self.tracer, None
+        return tracer
+
+    # -- reader thread and reply dispatcher ----------------------------------------------------------------
+    # A single reader thread owns the receive side of the port. It decodes 0xA5 frames as bytes
+    # arrive and hands each one to the oldest request waiting for that reply code.
+    def expect_reply(self, reply_cmd, request_cmd=None, sequence=None):
+        """Register a Future for the next `reply_cmd` frame, or for the v2 reply to `sequence`."""
+        future = concurrent.futures.Future()
+        future.request_cmd = request_cmd
+        future.reply_cmd = reply_cmd
+        future.sequence = sequence
+        future.sent_at = time.perf_counter()
+        future.retransmission = False
+        future.background_poll = False
+        with self.pending_lock:
+            if sequence is None:
+                self.pending_replies.setdefault(reply_cmd, collections.deque()).append(future)
+            else:
+                self.pending_sequences[sequence] = future
+        return future
+
+    def cancel_reply(self, reply_cmd, future):
+        with self.pending_lock:
+            sequence = getattr(future, 'sequence', None)
+            if sequence is not None:
+                if self.pending_sequences.get(sequence) is future:
+                    del self.pending_sequences[sequence]
+            else:
+                waiters = self.pending_replies.get(reply_cmd)
+                if waiters and future in waiters:
+                    waiters.remove(future)
+        cancelled = future.cancel()
+        if cancelled:
+            self.link_stats.record_timeout(future.request_cmd)
+        return cancelled
+
+    def dispatch_frame(self, cmd, payload, seq=None):
+        tracer = self.tracer
+        if tracer is not None:
+            tracer.instant("frame", cmd)
+        with self.pending_lock:
+            if seq is not None:
+                future = self.pending_sequences.get(seq)
+                if future is not None and future.reply_cmd == cmd:
+                    del self.pending_sequences[seq]
+                    if not future.set_running_or_notify_cancel():
+                        future = None
+                else:
+                    # Late reply to a request given up on; its sequence number may be reused.
+                    future = None
+            else:
+                waiters = self.pending_replies.get(cmd)
+                while waiters:
+                    future = waiters.popleft()
+                    # Skip waiters that were cancelled but not yet removed.
+                    if future.set_running_or_notify_cancel():
+                        break
+                else:
+                    future = None
+        if future is None:
+            sink = self.reply_sinks.get(cmd)
+            if sink is not None:
+                sink(payload)
+                return
+            self.link_stats.record_unsolicited()
+            self.unsolicited_frames.append((time.monotonic(), cmd, payload))
+            return
+        rtt = time.perf_counter() - future.sent_at
+        self.link_stats.record_reply(future.request_cmd, rtt)
+        # Karn's rule: a reply to a v1 retransmission may answer an earlier attempt. v2
+        # attempts have sequence numbers of their own, so every reply gives a sample.
+        if future.request_cmd is not None and (seq is not None or not future.retransmission):
+            estimator = self.rtt_estimators.get(future.request_cmd)
+            if estimator is None:
+                estimator = self.rtt_estimators[future.request_cmd] = RttEstimator()
+            estimator.update(rtt)
+            self.link_rtt.update(rtt)
+        future.set_result(payload)
+        if cmd != ALGOPYTHON_CMD_GET_STATUS_REP:
+            # A command was just acknowledged; look at its effect on the status right away.
+            self.request_status_poll()
+
+    def begin_stop(self):
+        """Mark a stop as sent: commands submitted before it are no longer retried and the
+        poller's in-flight status poll stops waiting. Call before writing any stop frame."""
+        self.stop_generation += 1
+        self.preempt_polls()
+
+    def preempt_polls(self):
+        """Cancel the poller's in-flight status poll so it gets to queued stops now.
+
+        Only requests sent with background=True are cancelled; their replies, if they
+        still come, end up in unsolicited_frames.
+        """
+        cancelled = []
+        with self.pending_lock:
+            for waiters in self.pending_replies.values():
+                for future in [f for f in waiters if f.background_poll]:
+                    waiters.remove(future)
+                    cancelled.append(future)
+            for sequence, future in list(self.pending_sequences.items()):
+                if future.background_poll:
+                    del self.pending_sequences[sequence]
+                    cancelled.append(future)
+        for future in cancelled:
+            future.cancel()
+        return len(cancelled)
+
+    def pop_unsolicited_frames(self):
+        frames = []
+        while self.unsolicited_frames:
+            frames.append(self.unsolicited_frames.popleft())
+        return frames
+
+    def reader_start(self):
+        if self.reader_running:
+            return
+        self.reader_running = True
+        wakeup = os.pipe() if os.name == 'posix' else None
+        if wakeup is not None:
+            os.set_blocking(wakeup[1], False)
+        with self._reader_wakeup_lock:
+            self._reader_wakeup = wakeup
+        self.reader_thread = threading.Thread(target=self.reader_loop, args=(wakeup,), daemon=True)
+        self.reader_thread.start()
+
+    def reader_stop(self):
+        self.reader_running = False
+        self.wake_reader()
+
+    def wake_reader(self):
+        """Make the reader re-check its port and running flag without waiting for data."""
+        with self._reader_wakeup_lock:
+            if self._reader_wakeup is not None:
+                try:
+                    os.write(self._reader_wakeup[1], b"\0")
+                except BlockingIOError:
+                    pass    # a wakeup is already pending
+
+    def reader_loop(self, wakeup=None):
+        """Read and dispatch frames until reader_stop() or a newer reader replaces this one.
+
+        Ports with a file descriptor are waited on with a selector together with the
+        wakeup pipe, so an idle link costs no wakeups at all. Other ports (Windows,
+        LoopbackSerial) fall back to blocking reads bounded by the port timeout.
+        """
+        me = threading.current_thread()
+        decoder = FrameDecoder(protocol=self.protocol)
+        self.reader_decoder = decoder
+        selector = selectors.DefaultSelector() if wakeup is not None else None
+        if selector is not None:
+            selector.register(wakeup[0], selectors.EVENT_READ)
+        registered = None       # (port, fd) registered with the selector
+        try:
+            while self.reader_running and self.reader_thread is me:
+                port = self.ser
+                fd = selectable_fd(port) if selector is not None and self.reader_selects else None
+                if registered is not None and (registered[0] is not port or registered[1] != fd):
+                    try:
+                        selector.unregister(registered[1])
+                    except (KeyError, ValueError):
+                        pass
+                    registered = None
+                if fd is not None and registered is None:
+                    selector.register(fd, selectors.EVENT_READ)
+                    registered = (port, fd)
+                if port is None or fd is not None:
+                    if port is None and selector is None:
+                        time.sleep(0.1)
+                        continue
+                    readable = False
+                    # While a partial frame is buffered, wake up to expire it if it stalls.
+                    events = selector.select(decoder.idle_gap if decoder.buffered() else None)
+                    if not events:
+                        for cmd, payload, seq in decoder.expire():
+                            self.dispatch_frame(cmd, bytes(payload), seq)
+                        continue
+                    for key, _ in events:
+                        if key.fd == wakeup[0]:
+                            os.read(wakeup[0], 512)
+                        else:
+                            readable = True
+                    if not readable:
+                        continue
+                try:
+                    # Blocks for up to the port timeout only on the fallback path.
+                    data = port.read(port.in_waiting or 1)
+                except (serial.SerialException, OSError) as e:
+                    if port is self.ser and self.reader_running:
+                        print(f"[Error] Serial read failed: {e}")
+                        time.sleep(0.1)
+                    continue
+                if not data:
+                    for cmd, payload, seq in decoder.expire():
+                        self.dispatch_frame(cmd, bytes(payload), seq)
+                    continue
+                recorder = self.recorder
+                if recorder is not None:
+                    recorder.rx(data)
+                for cmd, payload, seq in decoder.feed(data):
+                    self.dispatch_frame(cmd, bytes(payload), seq)
+        finally:
+            if selector is not None:
+                selector.close()
+            if wakeup is not None:
+                with self._reader_wakeup_lock:
+                    if self._reader_wakeup is wakeup:
+                        self._reader_wakeup = None
+                    os.close(wakeup[0])
+                    os.close(wakeup[1])
+
+    # -- commands ------------------------------------------------------------------------------------------
+    @traced("move")
+    def move(self, port: str, duration: float, power: int, direction: int, is_blocking=True, timeout: float = None):
+        motor_port, payload, forever = build_move_payload(port, duration, power, direction)
+        if forever:
+            is_blocking = False;
+
+        motor_fields = motor_status_fields(motor_port)
+        since = self.status_edge_snapshot()
+
+        self.send_packet(ALGOPYTHON_CMD_MOVE_REQ, payload, wait_done=False)
+
+        if not is_blocking:
+            return None
+        if self.batch_defer_wait(motor_fields):
+            return None
+
+        print("Wait for motor to finish...");
+        if not self.wait_for_idle(motor_fields, since, timeout):
+            print(f"[Timeout] Motor {motor_port_name(motor_port)} did not finish within {timeout} s")
+            return False
+        if len(motor_fields) == 1:
+            print(f"Motor{motor_port_name(motor_port)} completed movement")
+        else:
+            print(f"Motors {motor_port_name(motor_port)} completed movement")
+        return True
+
+    def rotations(self, port: str, rotations: float, power: float, direction: int):
+        port_mask, duration = rotations_to_duration(port, rotations, power, direction)
+
+        return self.move(
+            port=port_mask,
+            direction=direction,
+            power=int(power),
+            duration=duration
+        )
+
+    @traced("moveStop")
+    def moveStop(self, stop_port: str):
+        if stop_port not in motor_map:
+            raise ValueError("Invalid motor")
+        motor_stop_port = motor_map[stop_port.upper()];
+        print(f"Stopping motor {stop_port}...")
+        payload = bytes([
+            motor_stop_port & 0xFF
+            ])
+        self.send_packet(ALGOPYTHON_CMD_MOVE_STOP_REQ, payload)
+
+    @traced("light")
+    def light(self, port: int, duration: float, power: int, color: str | tuple[int, int, int], is_blocking=True, timeout: float = None):
+        payload, forever = build_light_payload(port, duration, power, color)
+        if forever:
+            is_blocking = False;
+
+        led_field = 'led1' if port == 1 else 'led2'
+        since = self.status_edge_snapshot()
+
+        self.send_packet(ALGOPYTHON_CMD_LIGHT_REQ, payload, wait_done=False)
+
+        if not is_blocking:
+            return None
+        if self.batch_defer_wait([led_field]):
+            return None
+
+        print("Wait for led to finish...");
+        if not self.wait_for_idle([led_field], since, timeout):
+            print(f"[Timeout] Led{port} did not finish within {timeout} s")
+            return False
+        print(f"Led{port} completed ")
+        return True
+
+    @traced("lightStop")
+    def lightStop(self, stop_port: int):
+        if stop_port not in (1, 2):
+            raise ValueError("LED port must be 1 or 2")
+
+        payload = bytes([
+            stop_port & 0xFF
+            ])
+        self.send_packet(ALGOPYTHON_CMD_LIGHT_STOP_REQ, payload)
+
+    @traced("playSound")
+    def playSound(self, sound_id: int, volume: int, is_blocking=True, timeout: float = None):
+        payload = build_sound_payload(sound_id, volume)
+        since = self.status_edge_snapshot()
+
+        self.send_packet(ALGOPYTHON_CMD_PLAY_SOUND_REQ, payload, wait_done=False)
+
+        if not is_blocking:
+            return None
+        if self.batch_defer_wait(['sound']):
+            return None
+
+        print("Wait for sound to finish...");
+        if not self.wait_for_idle(['sound'], since, timeout):
+            print(f"[Timeout] Sound did not finish within {timeout} s")
+            return False
+        print("Sound completed ")
+        return True
+
+    @traced("soundStop")
+    def soundStop(self):
+        print("Stopping sound...")
+        self.send_packet(ALGOPYTHON_CMD_SOUND_STOP_REQ, b"")
+
+    @traced("get_sensor_value")
+    def get_sensor_value(self, sensor_port: int) -> int:
+        if sensor_port not in (1, 2):
+            raise ValueError("Port must be 1 or 2")
+
+        stream = self.sensor_stream
+        if stream is not None and sensor_port in stream.rings:
+            # Streaming already polls this sensor; don't compete with it for replies.
+            ring = stream.rings[sensor_port]
+            if not ring.count:
+                next(ring.samples(timeout=1.0), None)
+            sample = ring.latest()
+            return None if sample is None else sample[1]
+
+        payload = bytes([sensor_port])
+
+        reply = self.send_packet(ALGOPYTHON_CMD_GET_SENSOR_REQ, payload, wait_done=False)
+        if not reply:
+            return None
+        return reply[-1]
+
+    def start_sensor_stream(self, ports=(1, 2), capacity: int = 4096, window: int = 4):
+        """Sample the given sensors continuously into timestamped ring buffers.
+
+        Returns the SensorStream; stream[port] is that sensor's SensorRing.
+        """
+        self.stop_sensor_stream()
+        self.sensor_stream = SensorStream(self, ports, capacity, window).start()
+        return self.sensor_stream
+
+    def stop_sensor_stream(self):
+        stream, self.sensor_stream = self.sensor_stream, None
+        if stream is not None:
+            stream.stop()
+
+    @traced("wait_sensor")
+    def wait_sensor(self, sensor_port: int, min: int, max: int, timeout: float = None):
+        payload = build_wait_sensor_payload(sensor_port, min, max)
+
+        print(f"Waiting for sensor {sensor_port} to detect value in range [{min}, {max}]")
+
+        sensor_field = 'sensor1' if sensor_port == 1 else 'sensor2'
+        since = self.status_edge_snapshot()
+
+        self.send_packet(ALGOPYTHON_CMD_WAIT_SENSOR_REQ, payload, wait_done=False)
+        if self.batch_defer_wait([sensor_field]):
+            return None
+
+        print("Wait for sensor to finish...");
+        if not self.wait_for_idle([sensor_field], since, timeout):
+            print(f"[Timeout] Sensor {sensor_port} did not trigger within {timeout} s")
+            return False
+        print(f"Sensor {sensor_port} done ")
+        return True
+
+# --------------------------------------------------------------------------------------------------------------
+#-----------------Fleet-----------------------------------------------------------------------------------------
+class Fleet:
+    """Several robots driven together; every command fans out to all of them in parallel.
+
+    Each method returns one result per robot, in the order of `robots`.
+    """
+
+    def __init__(self, robots):
+        self.robots = list(robots)
+        self._pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(1, len(self.robots)), thread_name_prefix="algopython-fleet")
+
+    @classmethod
+    def discover(cls, timeout: float = 5.0):
+        """Connect to every USB serial port that answers a GET_STATUS handshake."""
+        robots = [Robot(device, connection) for device, connection in discover_brains()]
+        if not robots:
+            return cls([])
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(robots)) as pool:
+            connected = list(pool.map(lambda robot: robot.connect(timeout=timeout), robots))
+        return cls(robot for robot, ok in zip(robots, connected) if ok)
+
+    def __len__(self):
+        return len(self.robots)
+
+    def __iter__(self):
+        return iter(self.robots)
+
+    def fan_out(self, method: str, *args, **kwargs):
+        """Call `method` on every robot at the same time and gather the results."""
+        futures = [self._pool.submit(getattr(robot, method), *args, **kwargs) for robot in self.robots]
+        return [future.result() for future in futures]
+
+    def connect(self, timeout: float = 5.0):
+        return self.fan_out('connect', timeout=timeout)
+
+    def move(self, port: str, duration: float, power: int, direction: int, is_blocking=True, timeout: float = None):
+        return self.fan_out('move', port, duration, power, direction, is_blocking, timeout)
+
+    def rotations(self, port: str, rotations: float, power: float, direction: int):
+        return self.fan_out('rotations', port, rotations, power, direction)
+
+    def moveStop(self, stop_port: str):
+        return self.fan_out('moveStop', stop_port)
+
+    def light(self, port: int, duration: float, power: int, color, is_blocking=True, timeout: float = None):
+        return self.fan_out('light', port, duration, power, color, is_blocking, timeout)
+
+    def lightStop(self, stop_port: int):
+        return self.fan_out('lightStop', stop_port)
+
+    def playSound(self, sound_id: int, volume: int, is_blocking=True, timeout: float = None):
+        return self.fan_out('playSound', sound_id, volume, is_blocking, timeout)
+
+    def soundStop(self):
+        return self.fan_out('soundStop')
+
+    def wait_sensor(self, sensor_port: int, min: int, max: int, timeout: float = None):
+        return self.fan_out('wait_sensor', sensor_port, min, max, timeout)
+
+    def get_sensor_value(self, sensor_port: int):
+        return self.fan_out('get_sensor_value', sensor_port)
+
+    def get_link_stats(self, reset: bool = False):
+        return {robot.name: robot.get_link_stats(reset) for robot in self.robots}
+
+    def close(self):
+        for robot in self.robots:
+            robot.close()
+        self._pool.shutdown(wait=False)
+
+# --------------------------------------------------------------------------------------------------------------
+#-----------------Default robot---------------------------------------------------------------------------------
+# The module-level API drives this robot, so single-brain scripts keep working unchanged.
+_default_robot = Robot()
+g_algopython_system_status = _default_robot.status
+
+# Connection state, status bookkeeping and the lower-level helpers that used to be module
+# globals (ser, link_stats, send_packet, ...) are looked up on the default robot.
+_DEFAULT_ROBOT_ATTRIBUTES = frozenset(
+    name for name in dir(_default_robot) if not name.startswith('__') and name not in globals())
+
+def __getattr__(name):
+    if name in _DEFAULT_ROBOT_ATTRIBUTES:
+        return getattr(_default_robot, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def default_robot():
+    return _default_robot
+
+def algopython_init(port: str = None, connection=None, timeout: float = 5.0, separate_process: bool = False,
+                    daemon=None, protocol: int = None):
+    """Connect the default robot. With separate_process=True the serial engine runs in a
+    child process (see algopython.process); with daemon=True (or a socket path) the robot
+    is shared through a running algopython daemon (see algopython.daemon). protocol=2
+    offers the brain protocol v2, falling back to v1 if it doesn't support it."""
+    global _default_robot
+    if daemon:
+        from .daemon import DaemonRobot
+        path = None if daemon is True else daemon
+        if not isinstance(_default_robot, DaemonRobot) or (path and _default_robot.path != path):
+            _default_robot.close()
+            _default_robot = DaemonRobot.replacing(_default_robot, path=path)
+    elif separate_process and not getattr(_default_robot, 'separate_process', False):
+        from .process import ProcessRobot
+        _default_robot.close()
+        _default_robot = ProcessRobot.replacing(_default_robot)
+    if protocol is not None:
+        _default_robot.protocol_preference = protocol
+    return _default_robot.connect(port, connection, timeout)
+
+def batch(is_blocking=False, timeout=None):
+    return _default_robot.batch(is_blocking, timeout)
+
+def send_many(commands, timeout=None, retries=2, verbose=True):
+    return _default_robot.send_many(commands, timeout, retries, verbose)
+
+def subscribe_status(callback, fields=None):
+    return _default_robot.subscribe_status(callback, fields)
+
+def unsubscribe_status(handle):
+    _default_robot.unsubscribe_status(handle)
+
+def set_polling_policy(fast_interval=0.01, idle_interval=0.5, backoff=2.0):
+    return _default_robot.set_polling_policy(fast_interval, idle_interval, backoff)
+
+def set_status_printing(enabled: bool):
+    _default_robot.set_status_printing(enabled)
+
+def get_link_stats(reset: bool = False):
+    return _default_robot.get_link_stats(reset)
+
+def get_rtt_estimates():
+    return _default_robot.get_rtt_estimates()
+
+def start_tracing(capacity: int = 65536):
+    return _default_robot.start_tracing(capacity)
+
+def stop_tracing():
+    return _default_robot.stop_tracing()
+
+def get_status_history():
+    return _default_robot.status_history
+
+def reset_link_stats():
+    _default_robot.reset_link_stats()
 
 #--------------------------------------------------------------------------------------------------------------
 #-----------------Constants and Mappings----------------------------------------------------------------------
@@ -313,6 +2420,7 @@ ALGOPYTHON_CMD_LIGHT12_REQ      =0x16 # not implemented yet
 ALGOPYTHON_CMD_WAIT_SENSOR_REQ  =0x17
 ALGOPYTHON_CMD_GET_SENSOR_REQ   =0x18
 ALGOPYTHON_CMD_GET_STATUS_REQ   =0x19
+ALGOPYTHON_CMD_HELLO_REQ        =0x1A
 
 ALGOPYTHON_CMD_MOVE_REP         =0x80
 ALGOPYTHON_CMD_LIGHT_REP        =0x81
@@ -323,6 +2431,7 @@ ALGOPYTHON_CMD_LIGHT12_REP      =0x86 # not implemented yet
 ALGOPYTHON_CMD_WAIT_SENSOR_REP  =0x87
 ALGOPYTHON_CMD_GET_SENSOR_REP   =0x88
 ALGOPYTHON_CMD_GET_STATUS_REP   =0x89
+ALGOPYTHON_CMD_HELLO_REP        =0x8A
 
 FOREVER = math.inf
 # --------------------------------------------------------------------------------------------------------------
@@ -347,24 +2456,41 @@ ROTATIONS_TO_SECONDS_MAP = {
     'BC': 0.68
 }
 
-def move(port:str, duration :float , power: int, direction: int, is_blocking = True):
-    if port not in motor_map:
-        raise ValueError("Invalid motor")
+MOTOR_STATUS_FIELDS = ((0b001, 'motor1'), (0b010, 'motor2'), (0b100, 'motor3'))
+
+def motor_mask(port) -> int:
+    """Bit mask for a motor port name like 'AB', or an int mask as built by rotations()."""
+    if isinstance(port, int) and 0 < port <= 0b111:
+        return port
+    if isinstance(port, str) and port.upper() in motor_map:
+        return motor_map[port.upper()]
+    raise ValueError("Invalid motor")
+
+def motor_status_fields(mask: int):
+    return [field for bit, field in MOTOR_STATUS_FIELDS if mask & bit]
+
+def motor_port_name(mask: int) -> str:
+    """Port letters for a motor mask, e.g. 0b101 -> 'AC'."""
+    return ''.join(letter for letter in 'ABC' if mask & motor_map[letter])
+
+def build_move_payload(port, duration: float, power: int, direction: int):
+    """Validate move() arguments and return (motor mask, payload, runs_forever)."""
+    motor_port = motor_mask(port)
     if duration < 0 and duration > 10:
         raise ValueError("Duration must be between 0 and 10 seconds")
     if not (0 <= power <= 10):
         raise ValueError("Power must be 0-10")
 
-    motor_port = motor_map[port.upper()];
     motor_power = int((power * 255) / 10);
     motor_direction = direction;
     motor_type = 0;
+    forever = False
 
     if math.isinf(duration):
         print("x is positive infinity")
         motor_type = 1;
         motor_duration = 0;
-        is_blocking = False;
+        forever = True
     else:
         motor_duration = int(duration * 100);
 
@@ -378,62 +2504,15 @@ def move(port:str, duration :float , power: int, direction: int, is_blocking = T
         motor_power & 0xFF,
         motor_direction & 0xFF
     ])
+    return motor_port, payload, forever
+
+def move(port:str, duration :float , power: int, direction: int, is_blocking = True, timeout: float = None):
+    return _default_robot.move(port, duration, power, direction, is_blocking, timeout)
 
-    send_packet(ALGOPYTHON_CMD_MOVE_REQ, payload, wait_done=False)
-
-    print("Wait for motor to finish...");
-
-    if motor_port == 0b001:
-        motor_prev_status = g_algopython_system_status.motor1;
-        while is_blocking:
-            if(motor_prev_status == 1) and (g_algopython_system_status.motor1 == 0): 
-                print("MotorA completed movement")
-                break;
-            motor_prev_status = g_algopython_system_status.motor1;
-    elif motor_port == 0b010:
-        motor_prev_status = g_algopython_system_status.motor2;
-        while is_blocking:
-            if(motor_prev_status == 1) and (g_algopython_system_status.motor2 == 0):
-                print("MotorB completed movement")
-                break;
-            motor_prev_status = g_algopython_system_status.motor2;
-    elif motor_port == 0b100:
-        motor_prev_status = g_algopython_system_status.motor3;
-        while is_blocking:
-            if(motor_prev_status == 1) and (g_algopython_system_status.motor3 == 0):
-                print("MotorC completed movement")
-                break;
-            motor_prev_status = g_algopython_system_status.motor3;
-    elif motor_port == 0b011:
-        motorA_prev_status = g_algopython_system_status.motor1;
-        motorB_prev_status = g_algopython_system_status.motor2;
-        while is_blocking:
-            if(motorA_prev_status == 1 and motorB_prev_status == 1) and (g_algopython_system_status.motor1 == 0 and g_algopython_system_status.motor2 == 0):
-                print("Motors AB completed movement")
-                break;
-            motorA_prev_status = g_algopython_system_status.motor1;
-            motorB_prev_status = g_algopython_system_status.motor2;
-    elif motor_port == 0b101:   
-        motorA_prev_status = g_algopython_system_status.motor1;
-        motorC_prev_status = g_algopython_system_status.motor3;
-        while is_blocking:
-            if(motorA_prev_status == 1 and motorC_prev_status == 1) and (g_algopython_system_status.motor1 == 0 and g_algopython_system_status.motor3 == 0):
-                print("Motors AC completed movement")
-                break;
-            motorA_prev_status = g_algopython_system_status.motor1;
-            motorC_prev_status = g_algopython_system_status.motor3;
-    elif motor_port == 0b110:
-        motorB_prev_status = g_algopython_system_status.motor2;
-        motorC_prev_status = g_algopython_system_status.motor3;
-        while is_blocking:
-            if(motorB_prev_status == 1 and motorC_prev_status == 1) and (g_algopython_system_status.motor2 == 0 and g_algopython_system_status.motor3 == 0):
-                print("Motors BC completed movement")
-                break;
-            motorB_prev_status = g_algopython_system_status.motor2;
-            motorC_prev_status = g_algopython_system_status.motor3;
 # --------------------------------------------------------------------------------------------------------------
 
-def rotations(port: str, rotations: float, power: float, direction: int):
+def rotations_to_duration(port, rotations: float, power: float, direction: int):
+    """Validate rotations() arguments and return (motor mask, duration in seconds)."""
     if isinstance(port, str):
         port = port.upper()
         if not all(m in ('A', 'B', 'C') for m in port):
@@ -466,24 +2545,13 @@ def rotations(port: str, rotations: float, power: float, direction: int):
     if direction not in (1, -1):
         raise ValueError("Direction must be 1 (CW) or -1 (CCW)")
 
-    duration = rotations * factor
+    return port_mask, rotations * factor
 
-    move(
-        port=port_mask,
-        direction=direction,
-        power=int(power),
-        duration=duration
-    )
+def rotations(port: str, rotations: float, power: float, direction: int):
+    return _default_robot.rotations(port, rotations, power, direction)
 
 def moveStop(stop_port: str):
-    if stop_port not in motor_map:
-        raise ValueError("Invalid motor")
-    motor_stop_port = motor_map[stop_port.upper()];
-    print(f"Stopping motor {stop_port}...")
-    payload = bytes([
-        motor_stop_port & 0xFF
-        ])
-    send_packet(ALGOPYTHON_CMD_MOVE_STOP_REQ, payload)
+    return _default_robot.moveStop(stop_port)
 
 # --------------------------------------------------------------------------------------------------------------
 #-----------------Light section---------------------------------------------------------------------------------
@@ -498,8 +2566,8 @@ COLOR_MAP = {
     "purple":  (128, 0, 128),
 }
 
-def light(port: int, duration: float , power: int, color: str | tuple[int, int, int], is_blocking = True):
-    
+def build_light_payload(port: int, duration: float, power: int, color: str | tuple[int, int, int]):
+    """Validate light() arguments and return (payload, runs_forever)."""
     if port != 1 and port != 2:
         raise ValueError("Invalid LED")
     if not (0 <= power <= 10):
@@ -521,12 +2589,13 @@ def light(port: int, duration: float , power: int, color: str | tuple[int, int,
     led_g = g;
     led_b = b;
     led_type = 0;
+    forever = False
 
     if math.isinf(duration):
         print("x is positive infinity")
         led_type = 1;
         led_duration = 0;
-        is_blocking = False;
+        forever = True
     else:
         led_duration = int(duration * 100);
 
@@ -542,39 +2611,17 @@ def light(port: int, duration: float , power: int, color: str | tuple[int, int,
         led_g & 0xFF,
         led_b & 0xFF
     ])
+    return payload, forever
 
-    send_packet(ALGOPYTHON_CMD_LIGHT_REQ, payload, wait_done=False)
-
-    print("Wait for led to finish..."); 
-    if port == 1:
-        led1_prev_status = g_algopython_system_status.led1;
-        while is_blocking:
-            if(led1_prev_status == 1) and (g_algopython_system_status.led1 == 0): 
-                print("Led1 completed ")
-                break;
-            led1_prev_status = g_algopython_system_status.led1;
-    elif port == 2:
-        led2_prev_status = g_algopython_system_status.led2;
-        while is_blocking:
-            if(led2_prev_status == 1) and (g_algopython_system_status.led2 == 0): 
-                print("Led2 completed ")
-                break;
-            led2_prev_status = g_algopython_system_status.led2;
-
+def light(port: int, duration: float , power: int, color: str | tuple[int, int, int], is_blocking = True, timeout: float = None):
+    return _default_robot.light(port, duration, power, color, is_blocking, timeout)
 
 def lightStop(stop_port: int):
-    if stop_port not in (1, 2):
-        raise ValueError("LED port must be 1 or 2")
-
-    payload = bytes([
-        stop_port & 0xFF
-        ])
-    send_packet(ALGOPYTHON_CMD_LIGHT_STOP_REQ, payload)
+    return _default_robot.lightStop(stop_port)
 
 # --------------------------------------------------------------------------------------------------------------
 #-----------------Play sound section----------------------------------------------------------------------------
-def playSound(sound_id: int, volume: int, is_blocking= True):
-
+def build_sound_payload(sound_id: int, volume: int) -> bytes:
     if not (0 <= volume <= 10):
         raise ValueError("Volume must be between 0 and 10")
     if sound_id not in SOUNDS_MAP:
@@ -586,19 +2633,13 @@ def playSound(sound_id: int, volume: int, is_blocking= True):
         sound_id & 0xFF,         
         volume & 0xFF,     
     ])
+    return payload
 
-    send_packet(ALGOPYTHON_CMD_PLAY_SOUND_REQ, payload,wait_done=False)
-    print("Wait for sound to finish..."); 
-    playSound_prev_status = g_algopython_system_status.sound;
-    while is_blocking:
-        if(playSound_prev_status == 1) and (g_algopython_system_status.sound == 0): 
-            print("Sound completed ")
-            break;
-        playSound_prev_status = g_algopython_system_status.sound;
+def playSound(sound_id: int, volume: int, is_blocking= True, timeout: float = None):
+    return _default_robot.playSound(sound_id, volume, is_blocking, timeout)
 
 def soundStop(): 
-    print("Stopping sound...")
-    send_packet(ALGOPYTHON_CMD_SOUND_STOP_REQ, b"")
+    return _default_robot.soundStop()
 
 def listAvailableSounds():
 
@@ -610,45 +2651,33 @@ def listAvailableSounds():
 # --------------------------------------------------------------------------------------------------------------
 #-----------------Sensor section--------------------------------------------------------------------------------
 def get_sensor_value(sensor_port: int) -> int:
+    return _default_robot.get_sensor_value(sensor_port)
 
-    if sensor_port not in (1, 2):
-        raise ValueError("Port must be 1 or 2")
+def start_sensor_stream(ports=(1, 2), capacity: int = 4096, window: int = 4):
+    return _default_robot.start_sensor_stream(ports, capacity, window)
 
-    payload = bytes([sensor_port])
+def stop_sensor_stream():
+    _default_robot.stop_sensor_stream()
 
-    send_packet(ALGOPYTHON_CMD_GET_SENSOR_REQ, payload, wait_done=False)
+def start_recording(path, flush_bytes: int = 64 * 1024, flush_interval: float = 0.5):
+    return _default_robot.start_recording(path, flush_bytes, flush_interval)
 
-def wait_sensor(sensor_port: int, min: int, max: int):
+def stop_recording():
+    _default_robot.stop_recording()
 
+def build_wait_sensor_payload(sensor_port: int, min: int, max: int) -> bytes:
     if sensor_port not in (1, 2):
         raise ValueError("sensorPort mora biti 1 ili 2")
 
-    print(f"Waiting for sensor {sensor_port} to detect value in range [{min}, {max}]")
-
     payload = bytes([
         sensor_port & 0xFF, 
         min & 0xFF, 
         max & 0xFF
         ])
+    return payload
 
-    send_packet(ALGOPYTHON_CMD_WAIT_SENSOR_REQ, payload, wait_done=False)
-
-    print("Wait for sensor to finish..."); 
-    if sensor_port == 1:
-        sensor1_prev_status = g_algopython_system_status.sensor1;
-        while True:
-            if(sensor1_prev_status == 1) and (g_algopython_system_status.sensor1 == 0): 
-                print("Sensor 1 done ")
-                break;
-            sensor1_prev_status = g_algopython_system_status.sensor1;
-    elif sensor_port == 2:
-        sensor2_prev_status = g_algopython_system_status.sensor2;
-        while True:
-            if(sensor2_prev_status == 1) and (g_algopython_system_status.sensor2 == 0): 
-                print("Sensor 2 done ")
-                break;
-            sensor2_prev_status = g_algopython_system_status.sensor2;
-    
+def wait_sensor(sensor_port: int, min: int, max: int, timeout: float = None):
+    return _default_robot.wait_sensor(sensor_port, min, max, timeout)
 
 # --------------------------------------------------------------------------------------------------------------
 #-----------------Status section--------------------------------------------------------------------------------
@@ -0,0 +1,214 @@
+"""Stream LED colours and motor powers at the rate the link sustains.
+
+    anim = Animator()
+    anim.play({'led1': (i, 0, 255 - i), 'A': i / 25.5} for i in range(256))
+
+A keyframe is a dict with any of the keys 'led1', 'led2' (a colour name or RGB tuple, None
+for off) and 'A', 'B', 'C' (motor power -10..10, the sign giving the direction; 0 or None
+stops the motor). Keyframes only record the wanted value per actuator. A sender thread
+writes whatever is wanted once one of the `window` in-flight frames is acknowledged, so a
+value overwritten before it could be sent is dropped (last write wins), and a value equal
+to what the brain already has is never sent at all.
+
+Frames run until changed (run type "forever"); stop() or the end of play() switches off
+everything the animation drove.
+"""
+import threading
+import time
+
+from . import algopython as core
+from .algopython import build_packet, CMD_REPLY_MAP
+
+__all__ = ['Animator']
+
+LED_KEYS = {'led1': 1, 'led2': 2}
+MOTOR_KEYS = ('A', 'B', 'C')
+
+
+class Animator:
+    """Coalescing sender of LED/motor keyframes for one robot."""
+
+    def __init__(self, robot=None, window: int = 4, led_power: int = 10, reply_timeout: float = 0.5):
+        self.robot = robot if robot is not None else core.default_robot()
+        self.window = window
+        self.led_power = led_power
+        self.reply_timeout = reply_timeout
+        self._wanted = {}
+        self._dirty = set()
+        self._sent = {}         # actuator -> value the brain last acknowledged or was sent
+        self._in_flight = []    # (reply cmd, Future)
+        self._cond = threading.Condition()
+        self._running = False
+        self._thread = None
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.keyframes = 0
+        self.dropped = 0        # values overwritten before they were sent
+        self.suppressed = 0     # values equal to what was already sent
+        self.values_sent = 0
+        self.writes = 0
+
+    # -- encoding ------------------------------------------------------------------------------------------
+    def encode(self, key, value):
+        """(cmd, payload) that puts actuator `key` at `value` until further notice."""
+        if key in LED_KEYS:
+            port = LED_KEYS[key]
+            if value is None:
+                return core.ALGOPYTHON_CMD_LIGHT_STOP_REQ, bytes([port])
+            payload, _ = core.build_light_payload(port, 0, self.led_power, value)
+        elif key in MOTOR_KEYS:
+            if not value:
+                return core.ALGOPYTHON_CMD_MOVE_STOP_REQ, bytes([core.motor_map[key]])
+            direction = 1 if value > 0 else -1
+            _, payload, _ = core.build_move_payload(key, 0, min(abs(value), 10), direction)
+        else:
+            raise ValueError(f"Unknown actuator: {key}")
+        # Run type 1: keep going until the next frame, so unchanged values need no refresh.
+        payload[1] = 1
+        cmd = core.ALGOPYTHON_CMD_LIGHT_REQ if key in LED_KEYS else core.ALGOPYTHON_CMD_MOVE_REQ
+        return cmd, payload
+
+    # -- producer side -------------------------------------------------------------------------------------
+    def update(self, frame, wait: bool = False):
+        """Record the wanted value of each actuator in `frame`.
+
+        With wait=True first block until the sender has taken the previous keyframe, so
+        a precomputed sequence advances at link speed instead of collapsing to its end.
+        """
+        for key in frame:
+            if key not in LED_KEYS and key not in MOTOR_KEYS:
+                raise ValueError(f"Unknown actuator: {key}")
+        with self._cond:
+            if wait:
+                while self._dirty and self._running:
+                    self._cond.wait()
+            for key, value in frame.items():
+                if isinstance(value, list):
+                    value = tuple(value)
+                if key in self._dirty:
+                    self.dropped += 1
+                self._wanted[key] = value
+                self._dirty.add(key)
+            self.keyframes += 1
+            self._cond.notify_all()
+
+    def play(self, frames, fps: float = None, stop_at_end: bool = True):
+        """Stream keyframes from an iterable and return the animation statistics.
+
+        Without `fps` every keyframe is handed over as soon as the previous one was
+        taken. With `fps` keyframes follow the wall clock and stale ones are dropped.
+        """
+        self.reset_stats()
+        self.start()
+        start = time.perf_counter()
+        try:
+            for i, frame in enumerate(frames):
+                if fps:
+                    delay = start + i / fps - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                self.update(frame, wait=not fps)
+            self.flush()
+        finally:
+            elapsed = time.perf_counter() - start
+            self.stop(halt=stop_at_end)
+        return {
+            "elapsed_s": elapsed,
+            "keyframes": self.keyframes,
+            "writes": self.writes,
+            "values_sent": self.values_sent,
+            "dropped": self.dropped,
+            "suppressed": self.suppressed,
+            "writes_per_s": self.writes / elapsed if elapsed else None,
+        }
+
+    def flush(self, timeout: float = None):
+        """Wait until every wanted value was sent and acknowledged."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._running and (self._dirty or self._in_flight):
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    # -- sender --------------------------------------------------------------------------------------------
+    def start(self):
+        if self._running:
+            return self
+        if not self.robot.ensure_connection():
+            raise RuntimeError("Serial port is not initialized.")
+        self._running = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self, halt: bool = True):
+        """Stop the sender; with halt=True also switch off every actuator it drove."""
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        for reply_cmd, future in self._in_flight:
+            self.robot.cancel_reply(reply_cmd, future)
+        self._in_flight = []
+        if halt:
+            for key, value in self._sent.items():
+                if value is not None and value != 0:
+                    cmd, payload = self.encode(key, None)
+                    self.robot.send_packet(cmd, payload, verbose=False)
+            self._sent.clear()
+        self._wanted.clear()
+        self._dirty.clear()
+
+    def _acknowledged(self, future):
+        with self._cond:
+            self._in_flight = [entry for entry in self._in_flight if entry[1] is not future]
+            self._cond.notify_all()
+
+    def _run(self):
+        robot = self.robot
+        while True:
+            with self._cond:
+                while self._running and not (self._dirty and len(self._in_flight) < self.window):
+                    if not self._cond.wait(self.reply_timeout) and self._in_flight:
+                        # Lost frames or acknowledgements: give up on them and resend.
+                        for reply_cmd, future in self._in_flight:
+                            robot.cancel_reply(reply_cmd, future)
+                        self._in_flight = []
+                        self._dirty.update(self._sent)
+                        self._sent.clear()
+                if not self._running:
+                    return
+                changes = [(key, self._wanted[key]) for key in self._dirty]
+                self._dirty.clear()
+                self._cond.notify_all()
+
+            frames = []
+            for key, value in changes:
+                if key in self._sent and self._sent[key] == value:
+                    self.suppressed += 1
+                    continue
+                frames.append(self.encode(key, value))
+                self._sent[key] = value
+            if not frames:
+                continue
+
+            futures = []
+            for cmd, _ in frames:
+                reply_cmd = CMD_REPLY_MAP[cmd]
+                futures.append((reply_cmd, robot.expect_reply(reply_cmd, cmd)))
+            with self._cond:
+                self._in_flight.extend(futures)
+            robot.serial_write(b"".join(build_packet(cmd, payload) for cmd, payload in frames))
+            sent_at = time.perf_counter()
+            for (cmd, _), (_, future) in zip(frames, futures):
+                future.sent_at = sent_at
+                robot.link_stats.record_sent(cmd)
+                future.add_done_callback(self._acknowledged)
+            self.values_sent += len(frames)
+            self.writes += 1
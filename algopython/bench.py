@@ -0,0 +1,540 @@
+"""Benchmarks for the host side of the algopython serial link.
+
+Run with:
+
+    python -m algopython.bench decoder --megabytes 8
+    python -m algopython.bench link --sim --latency 0.002 --output results.json
+    python -m algopython.bench link --port /dev/ttyUSB0 --baseline results.json
+    python -m algopython.bench idle
+    python -m algopython.bench protocol --loss 0.001
+
+`link` measures per-opcode round-trip latency, sustained command throughput, the cost of
+status polling, the delay between an actuator finishing and move()/light() returning, and
+how long a stop takes to be acknowledged while the link is saturated with polls.
+It runs against a real port or the simulated brain from algopython.sim.
+`idle` counts how often the reader and poller threads wake up, and the CPU they use,
+while nothing is sent (Linux only). `protocol` compares protocol v1 with v2 (sequence
+numbers, windowed pipelining) on the simulated brain.
+
+Results are printed as JSON so they can be saved and compared between versions.
+"""
+import argparse
+import contextlib
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+from . import algopython as core
+from .algopython import FrameDecoder, build_packet, CMD_REPLY_MAP
+
+
+def make_decoder_stream(megabytes=4, garbage_ratio=0.2, seed=1):
+    """Build a byte stream of valid reply frames mixed with line noise and corrupted frames.
+
+    Returns (stream, number of valid frames in it).
+    """
+    rng = random.Random(seed)
+    target = int(megabytes * 1024 * 1024)
+    reply_cmds = list(CMD_REPLY_MAP.values())
+    stream = bytearray()
+    frames = 0
+    while len(stream) < target:
+        roll = rng.random()
+        if roll < garbage_ratio:
+            # Line noise, including stray sync bytes.
+            noise = bytearray(rng.getrandbits(8) for _ in range(rng.randint(1, 32)))
+            noise[rng.randrange(len(noise))] = 0xA5
+            stream += noise
+        elif roll < garbage_ratio * 1.5:
+            frame = bytearray(build_packet(rng.choice(reply_cmds), bytes(rng.randint(0, 10))))
+            frame[-1] ^= 0xFF
+            stream += frame
+        else:
+            cmd = rng.choice(reply_cmds)
+            size = 10 if cmd == 0x89 else rng.randint(0, 12)
+            packet = bytearray([0xA5, cmd, size]) + bytes(rng.getrandbits(8) for _ in range(size))
+            packet.append(sum(packet) & 0xFF)
+            stream += packet
+            frames += 1
+    return bytes(stream), frames
+
+
+def bench_decoder(megabytes=4, chunk_size=256, seed=1):
+    stream, frames_expected = make_decoder_stream(megabytes, seed=seed)
+    view = memoryview(stream)
+    decoder = FrameDecoder()
+    frames = 0
+    payload_bytes = 0
+    start = time.perf_counter()
+    for offset in range(0, len(stream), chunk_size):
+        for cmd, payload, _ in decoder.feed(view[offset:offset + chunk_size]):
+            frames += 1
+            payload_bytes += len(payload)
+    elapsed = time.perf_counter() - start
+    return {
+        "bytes": len(stream),
+        "chunk_size": chunk_size,
+        "frames_expected": frames_expected,
+        "frames": frames,
+        "payload_bytes": payload_bytes,
+        "discarded_bytes": decoder.discarded_bytes,
+        "bad_checksums": decoder.bad_checksums,
+        "seconds": elapsed,
+        "mb_per_s": len(stream) / elapsed / (1024 * 1024),
+        "frames_per_s": frames / elapsed,
+    }
+
+
+HISTOGRAM_EDGES_MS = (0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+def summarize(samples_s):
+    """Latency summary in milliseconds with a fixed-edge histogram."""
+    samples = sorted(x * 1000.0 for x in samples_s)
+    if not samples:
+        return {"count": 0}
+    buckets = dict.fromkeys([f"<={edge}ms" for edge in HISTOGRAM_EDGES_MS] + [">1000ms"], 0)
+    for x in samples:
+        for edge in HISTOGRAM_EDGES_MS:
+            if x <= edge:
+                buckets[f"<={edge}ms"] += 1
+                break
+        else:
+            buckets[">1000ms"] += 1
+
+    def pct(p):
+        return samples[min(len(samples) - 1, int(p / 100.0 * len(samples)))]
+
+    return {
+        "count": len(samples),
+        "mean_ms": sum(samples) / len(samples),
+        "p50_ms": pct(50),
+        "p90_ms": pct(90),
+        "p99_ms": pct(99),
+        "max_ms": samples[-1],
+        "histogram": buckets,
+    }
+
+
+def opcode_payloads():
+    """A harmless request payload for every opcode in CMD_REPLY_MAP."""
+    return {
+        core.ALGOPYTHON_CMD_MOVE_REQ: bytes(core.build_move_payload('A', 0, 0, 1)[1]),
+        core.ALGOPYTHON_CMD_LIGHT_REQ: bytes(core.build_light_payload(1, 0, 0, 'red')[0]),
+        core.ALGOPYTHON_CMD_PLAY_SOUND_REQ: core.build_sound_payload(1, 0),
+        core.ALGOPYTHON_CMD_MOVE_STOP_REQ: bytes([0b111]),
+        core.ALGOPYTHON_CMD_LIGHT_STOP_REQ: bytes([1]),
+        core.ALGOPYTHON_CMD_SOUND_STOP_REQ: b"",
+        core.ALGOPYTHON_CMD_LIGHT12_REQ: b"",
+        core.ALGOPYTHON_CMD_WAIT_SENSOR_REQ: core.build_wait_sensor_payload(1, 0, 255),
+        core.ALGOPYTHON_CMD_GET_SENSOR_REQ: bytes([1]),
+        core.ALGOPYTHON_CMD_GET_STATUS_REQ: b"",
+    }
+
+
+def timed_request(cmd, payload):
+    start = time.perf_counter()
+    reply = core.send_packet(cmd, payload, retries=0, verbose=False)
+    return time.perf_counter() - start, reply is not None
+
+
+def bench_rtt(samples=100):
+    results = {}
+    for cmd, payload in opcode_payloads().items():
+        latencies = []
+        failures = 0
+        for _ in range(samples):
+            elapsed, ok = timed_request(cmd, payload)
+            if ok:
+                latencies.append(elapsed)
+            else:
+                failures += 1
+        results[f"0x{cmd:02X}"] = dict(summarize(latencies), failures=failures)
+    core.send_packet(core.ALGOPYTHON_CMD_SOUND_STOP_REQ, b"", verbose=False)
+    return results
+
+
+def bench_throughput(seconds=2.0, workers=4):
+    """GET_STATUS requests per second with `workers` threads keeping requests in flight."""
+    counts = [0] * workers
+    failures = [0] * workers
+    stop_at = time.perf_counter() + seconds
+
+    def worker(i):
+        while time.perf_counter() < stop_at:
+            if core.send_packet(core.ALGOPYTHON_CMD_GET_STATUS_REQ, b"", retries=0, verbose=False) is None:
+                failures[i] += 1
+            else:
+                counts[i] += 1
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(workers)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    return {
+        "workers": workers,
+        "seconds": elapsed,
+        "commands": sum(counts),
+        "failures": sum(failures),
+        "commands_per_s": sum(counts) / elapsed,
+    }
+
+
+def status_polls_sent():
+    stats = core.get_link_stats()["commands"].get(f"0x{core.ALGOPYTHON_CMD_GET_STATUS_REQ:02X}")
+    return stats["sent"] if stats else 0
+
+
+def bench_poll_overhead(samples=200, fast_interval=0.01):
+    """GET_SENSOR round trip with the poller backed off versus polling every fast_interval."""
+    previous = core.polling_policy
+    results = {}
+    try:
+        for name, policy in (("idle", (fast_interval, 10.0, 1000.0)),
+                             ("polling", (fast_interval, fast_interval, 1.0))):
+            core.set_polling_policy(*policy)
+            time.sleep(0.2)
+            polls_before = status_polls_sent()
+            start = time.perf_counter()
+            latencies = [timed_request(core.ALGOPYTHON_CMD_GET_SENSOR_REQ, bytes([1]))[0] for _ in range(samples)]
+            polls_per_s = (status_polls_sent() - polls_before) / (time.perf_counter() - start)
+            results[name] = dict(summarize(latencies), status_polls_per_s=polls_per_s)
+    finally:
+        core.set_polling_policy(previous.fast_interval, previous.idle_interval, previous.backoff)
+    results["poll_interval_s"] = fast_interval
+    results["p50_overhead_ms"] = results["polling"]["p50_ms"] - results["idle"]["p50_ms"]
+    return results
+
+
+def bench_completion(brain=None, repeats=5, duration=0.2):
+    """Delay between an actuator finishing and the blocking call returning.
+
+    With the simulated brain the exact finish time is known; on a real port it is
+    estimated as the commanded duration after the command was acknowledged.
+    """
+    results = {}
+    cases = (
+        ("move", lambda: core.move('A', duration, 5, 1), lambda: brain.motor_until[0]),
+        ("light", lambda: core.light(1, duration, 5, 'red'), lambda: brain.led_until[0]),
+    )
+    for name, call, finished_at in cases:
+        latencies = []
+        for _ in range(repeats):
+            start = time.monotonic()
+            call()
+            returned = time.monotonic()
+            if brain is not None:
+                latencies.append(returned - finished_at())
+            else:
+                latencies.append(returned - start - duration)
+            time.sleep(0.05)
+        results[name] = summarize(latencies)
+    results["exact"] = brain is not None
+    return results
+
+
+def bench_stop_latency(samples=50, workers=4, fast_interval=0.005):
+    """Call-to-acknowledge latency of stops versus ordinary commands under polling load.
+
+    The poller runs every fast_interval, `workers` threads keep GET_STATUS requests in
+    flight and both sensors are streamed, so every write competes for the link.
+    """
+    previous = core.polling_policy
+    stop_load = threading.Event()
+
+    def poll_load():
+        while not stop_load.is_set():
+            core.send_packet(core.ALGOPYTHON_CMD_GET_STATUS_REQ, b"", retries=0, verbose=False)
+
+    core.set_polling_policy(fast_interval, fast_interval, 1.0)
+    core.start_sensor_stream()
+    threads = [threading.Thread(target=poll_load) for _ in range(workers)]
+    for t in threads:
+        t.start()
+    results = {}
+    try:
+        time.sleep(0.2)
+        _, command_payload, _ = core.build_move_payload('A', 0.01, 0, 1)
+        for name, cmd, payload in (("stop", core.ALGOPYTHON_CMD_MOVE_STOP_REQ, bytes([0b111])),
+                                   ("command", core.ALGOPYTHON_CMD_MOVE_REQ, command_payload)):
+            latencies = []
+            failures = 0
+            for _ in range(samples):
+                elapsed, ok = timed_request(cmd, payload)
+                if ok:
+                    latencies.append(elapsed)
+                else:
+                    failures += 1
+                time.sleep(0.005)
+            results[name] = dict(summarize(latencies), failures=failures)
+    finally:
+        stop_load.set()
+        for t in threads:
+            t.join()
+        core.stop_sensor_stream()
+        core.set_polling_policy(previous.fast_interval, previous.idle_interval, previous.backoff)
+    results["load"] = {"workers": workers, "poll_interval_s": fast_interval, "sensor_stream": True}
+    return results
+
+
+def thread_counters(native_id):
+    """(context switches, CPU seconds) of one thread of this process, from /proc (Linux only)."""
+    try:
+        with open(f"/proc/self/task/{native_id}/status") as f:
+            switches = sum(int(line.split()[1]) for line in f if "ctxt_switches" in line)
+        with open(f"/proc/self/task/{native_id}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        cpu = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return None
+    return switches, cpu
+
+
+def bench_idle_wakeups(port=None, seconds=5.0, idle_interval=10.0):
+    """Wakeups per second and CPU use of the reader and poller threads on an idle link.
+
+    The reader is measured twice on the same connection: waiting with a selector on the
+    port's file descriptor and a wakeup pipe, and with blocking reads bounded by the port
+    timeout. The poller backs off to `idle_interval` between status polls. Without `port`
+    a PtyLink supplies a real file descriptor.
+    """
+    link = None
+    if port is None:
+        from .sim import PtyLink
+        link = PtyLink()
+        port = link.port
+    robot = core.Robot(port)
+    if not robot.connect():
+        raise SystemExit(1)
+    results = {"port_has_fd": core.selectable_fd(robot.ser) is not None, "seconds": seconds,
+               "idle_interval_s": idle_interval}
+    try:
+        robot.set_polling_policy(robot.polling_policy.fast_interval, idle_interval, 1000.0)
+        threads = {"reader": robot.reader_thread, "poller": robot.status_thread}
+        if thread_counters(robot.reader_thread.native_id) is None:
+            results["error"] = "per-thread counters need /proc"
+            return results
+        for mode, selects in (("blocking_read", False), ("selector", True)):
+            robot.reader_selects = selects
+            robot.wake_reader()
+            time.sleep(1.0)
+            before = {name: thread_counters(t.native_id) for name, t in threads.items()}
+            start = time.perf_counter()
+            time.sleep(seconds)
+            elapsed = time.perf_counter() - start
+            after = {name: thread_counters(t.native_id) for name, t in threads.items()}
+            results[mode] = {
+                name: {
+                    "wakeups_per_s": (after[name][0] - before[name][0]) / elapsed,
+                    "cpu_percent": (after[name][1] - before[name][1]) / elapsed * 100,
+                }
+                for name in threads
+            }
+    finally:
+        robot.close()
+        if link is not None:
+            link.close()
+    return results
+
+
+def bench_protocol(seconds=2.0, workers=4, latency=0.002, jitter=0.002, loss=0.0005, seed=1, batch=32):
+    """Protocol v1 against v2 on the same simulated link.
+
+    `workers` threads send GET_SENSOR for alternating ports, then send_many() pipelines
+    `batch` of them at once. The two sensors hold different values, so a reply matched to
+    the wrong request shows up as a wrong port. With loss, v1 hands a reply to whichever
+    request of that opcode is oldest; v2 matches it by sequence number.
+    """
+    from .sim import SimulatedBrain, LoopbackSerial
+    results = {"sim": {"latency": latency, "jitter": jitter, "loss": loss, "seed": seed}}
+    for protocol in (core.PROTOCOL_V1, core.PROTOCOL_V2):
+        brain = SimulatedBrain()
+        brain.set_sensor(1, 11)
+        brain.set_sensor(2, 22)
+        robot = core.Robot(connection=LoopbackSerial(brain, latency=latency, jitter=jitter, loss=loss, seed=seed),
+                           protocol=protocol)
+        if not robot.connect():
+            raise SystemExit(1)
+        latencies = []
+        counts = {"ok": 0, "wrong_port": 0, "failures": 0}
+        lock = threading.Lock()
+        stop_at = time.perf_counter() + seconds
+
+        def worker(i):
+            port = 1 + i % 2
+            while time.perf_counter() < stop_at:
+                start = time.perf_counter()
+                reply = robot.send_packet(core.ALGOPYTHON_CMD_GET_SENSOR_REQ, bytes([port]), retries=2, verbose=False)
+                elapsed = time.perf_counter() - start
+                with lock:
+                    if reply is None:
+                        counts["failures"] += 1
+                    elif reply[0] != port:
+                        counts["wrong_port"] += 1
+                    else:
+                        counts["ok"] += 1
+                        latencies.append(elapsed)
+                port = 3 - port
+
+        try:
+            threads = [threading.Thread(target=worker, args=(i,)) for i in range(workers)]
+            start = time.perf_counter()
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            elapsed = time.perf_counter() - start
+            commands = [(core.ALGOPYTHON_CMD_GET_SENSOR_REQ, bytes([1 + i % 2])) for i in range(batch)]
+            pipelined = {"batches": 0, "wrong_port": 0, "failures": 0}
+            batch_start = time.perf_counter()
+            while time.perf_counter() - batch_start < seconds:
+                for (_, payload), reply in zip(commands, robot.send_many(commands, verbose=False)):
+                    if reply is None:
+                        pipelined["failures"] += 1
+                    elif reply[0] != payload[0]:
+                        pipelined["wrong_port"] += 1
+                pipelined["batches"] += 1
+            batch_elapsed = time.perf_counter() - batch_start
+            sent = pipelined["batches"] * batch
+            pipelined["commands_per_s"] = sent / batch_elapsed
+            pipelined["correct_per_s"] = (sent - pipelined["wrong_port"] - pipelined["failures"]) / batch_elapsed
+            results[f"v{robot.protocol}"] = {
+                "window": robot.window,
+                "concurrent": dict(counts, commands_per_s=(counts["ok"] + counts["wrong_port"]) / elapsed,
+                                   correct_per_s=counts["ok"] / elapsed, latency=summarize(latencies)),
+                "pipelined": pipelined,
+                "unsolicited_frames": robot.get_link_stats()["unsolicited_frames"],
+            }
+        finally:
+            robot.close()
+    return results
+
+
+LINK_BENCHES = ("rtt", "throughput", "poll_overhead", "completion", "stop_latency")
+
+
+def run_link(args):
+    brain = None
+    if args.port:
+        connected = core.algopython_init(args.port)
+    else:
+        from .sim import SimulatedBrain, LoopbackSerial
+        brain = SimulatedBrain(sound_duration=0.05)
+        connected = core.algopython_init(connection=LoopbackSerial(
+            brain, latency=args.latency, jitter=args.jitter, loss=args.loss, seed=args.seed))
+    if not connected:
+        raise SystemExit(1)
+
+    selected = args.only.split(",") if args.only else LINK_BENCHES
+    results = {"target": args.port or "sim"}
+    if brain is not None:
+        results["sim"] = {"latency": args.latency, "jitter": args.jitter, "loss": args.loss, "seed": args.seed}
+    if "rtt" in selected:
+        results["rtt"] = bench_rtt(args.samples)
+    if "throughput" in selected:
+        results["throughput"] = bench_throughput(args.seconds, args.workers)
+    if "poll_overhead" in selected:
+        results["poll_overhead"] = bench_poll_overhead(args.samples)
+    if "completion" in selected:
+        results["completion"] = bench_completion(brain, args.repeats)
+    if "stop_latency" in selected:
+        results["stop_latency"] = bench_stop_latency(args.samples, args.workers)
+    results["rtt_estimates"] = core.get_rtt_estimates()
+    return results
+
+
+def compare(results, baseline, prefix=""):
+    """Yield (metric, baseline, current) for every numeric leaf present in both."""
+    for key, value in results.items():
+        if key not in baseline:
+            continue
+        if isinstance(value, dict) and isinstance(baseline[key], dict):
+            yield from compare(value, baseline[key], f"{prefix}{key}.")
+        elif isinstance(value, (int, float)) and isinstance(baseline[key], (int, float)) \
+                and not isinstance(value, bool) and "histogram" not in prefix:
+            yield f"{prefix}{key}", baseline[key], value
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m algopython.bench")
+    sub = parser.add_subparsers(dest="bench", required=True)
+
+    decoder = sub.add_parser("decoder", help="frame decoder throughput on mixed valid/garbage input")
+    decoder.add_argument("--megabytes", type=float, default=4)
+    decoder.add_argument("--chunk-size", type=int, default=256)
+    decoder.add_argument("--seed", type=int, default=1)
+    decoder.add_argument("--min-mbps", type=float, default=None,
+                         help="exit with status 1 if throughput falls below this many MB/s")
+
+    link = sub.add_parser("link", help="round trip, throughput, polling and completion latency")
+    target = link.add_mutually_exclusive_group()
+    target.add_argument("--port", help="serial port of a real brain")
+    target.add_argument("--sim", action="store_true", help="use the simulated brain (default)")
+    link.add_argument("--latency", type=float, default=0.002, help="simulated one-way latency in seconds")
+    link.add_argument("--jitter", type=float, default=0.0)
+    link.add_argument("--loss", type=float, default=0.0, help="simulated per-byte loss probability")
+    link.add_argument("--seed", type=int, default=1)
+    link.add_argument("--only", help=f"comma separated subset of {','.join(LINK_BENCHES)}")
+    link.add_argument("--samples", type=int, default=100)
+    link.add_argument("--seconds", type=float, default=2.0)
+    link.add_argument("--workers", type=int, default=4)
+    link.add_argument("--repeats", type=int, default=5)
+    link.add_argument("--output", help="also write the JSON results to this file")
+    link.add_argument("--baseline", help="JSON results of an earlier run to compare against")
+
+    protocol = sub.add_parser("protocol", help="protocol v1 against v2 on a lossy simulated link")
+    protocol.add_argument("--seconds", type=float, default=2.0)
+    protocol.add_argument("--workers", type=int, default=4)
+    protocol.add_argument("--latency", type=float, default=0.002, help="simulated one-way latency in seconds")
+    protocol.add_argument("--jitter", type=float, default=0.002)
+    protocol.add_argument("--loss", type=float, default=0.0005, help="simulated per-byte loss probability")
+    protocol.add_argument("--seed", type=int, default=1)
+    protocol.add_argument("--batch", type=int, default=32, help="commands per send_many() call")
+
+    idle = sub.add_parser("idle", help="wakeups and CPU of the I/O threads while nothing happens")
+    idle.add_argument("--port", help="serial port of a real brain (default: simulated brain on a pty)")
+    idle.add_argument("--seconds", type=float, default=5.0)
+    idle.add_argument("--idle-interval", type=float, default=10.0, help="status poll interval while idle")
+
+    args = parser.parse_args(argv)
+    if args.bench == "link":
+        # The library reports progress on stdout; keep stdout for the JSON.
+        with contextlib.redirect_stdout(sys.stderr):
+            result = {"link": run_link(args)}
+        print(json.dumps(result, indent=2))
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(result, f, indent=2)
+        if args.baseline:
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+            for metric, before, after in compare(result, baseline):
+                change = (after - before) / before * 100 if before else 0.0
+                print(f"{metric}: {before:.4g} -> {after:.4g} ({change:+.1f}%)", file=sys.stderr)
+    elif args.bench == "protocol":
+        with contextlib.redirect_stdout(sys.stderr):
+            result = bench_protocol(args.seconds, args.workers, args.latency, args.jitter, args.loss, args.seed,
+                                    args.batch)
+        print(json.dumps({"protocol": result}, indent=2))
+    elif args.bench == "idle":
+        with contextlib.redirect_stdout(sys.stderr):
+            result = bench_idle_wakeups(args.port, args.seconds, args.idle_interval)
+        print(json.dumps({"idle": result}, indent=2))
+    elif args.bench == "decoder":
+        result = bench_decoder(args.megabytes, args.chunk_size, args.seed)
+        print(json.dumps({"decoder": result}, indent=2))
+        if args.min_mbps is not None and result["mb_per_s"] < args.min_mbps:
+            print(f"[Fail] Decoder throughput {result['mb_per_s']:.2f} MB/s is below {args.min_mbps} MB/s",
+                  file=sys.stderr)
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
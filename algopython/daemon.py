@@ -0,0 +1,625 @@
+"""Share one brain between several local processes.
+
+    python -m algopython.daemon --port /dev/ttyUSB0        # owns the serial port
+    algopython_init(daemon=True)                            # in every client script
+
+The daemon runs one Robot: a single status poller serves every client, and client
+commands are sent as soon as they arrive, each on its own thread, so requests from
+different clients (or several from one client) are in flight at once. Clients connect over
+a Unix domain socket and DaemonRobot gives them the same methods as Robot, so the
+module-level functions work unchanged.
+
+Messages on the socket are a 7-byte header (type, request id, payload length) and a
+payload:
+
+    REQUEST   cmd, priority, retries, deadline ms,   ->  REPLY   outcome, reply payload
+              frame payload
+    SUBSCRIBE u16 mask of STATUS_FIELDS (0 ends it)  ->  STATUS  timestamp, raw status,
+                                                                  edge counters, frame count
+    WATCH     +1 / -1: keep the poller at its fast rate
+    CALL      JSON {"name", "args"}                  ->  RESULT  JSON {"ok", "value"}
+
+Clients that subscribe to the same fields share one status subscription: each change is
+encoded once and the same bytes are sent to all of them.
+"""
+import argparse
+import concurrent.futures
+import json
+import os
+import selectors
+import socket
+import struct
+import sys
+import threading
+import time
+
+from . import algopython as core
+from .algopython import Robot, STATUS_FIELDS, STATUS_EDGE_FIELDS, CMD_REPLY_MAP, PRIORITY_STOP, command_priority
+from .process import RemoteRobot, STATUS_BLOCK
+
+__all__ = ['Daemon', 'DaemonRobot', 'default_socket_path']
+
+HEADER = struct.Struct("<BIH")          # message type, request id, payload length
+# cmd, priority (0xFF: by opcode), retries (0xFF: adaptive), deadline in ms (0xFFFFFFFF: none)
+REQUEST_HEADER = struct.Struct("<BBBI")
+NO_DEADLINE = 0xFFFFFFFF
+MSG_REQUEST = 0x01
+MSG_SUBSCRIBE = 0x02
+MSG_WATCH = 0x03
+MSG_CALL = 0x04
+MSG_REPLY = 0x81
+MSG_STATUS = 0x82
+MSG_RESULT = 0x84
+
+REPLY_NONE = 0          # no reply from the brain
+REPLY_PAYLOAD = 1       # reply payload follows
+REPLY_SENT = 2          # command without a reply code, written
+
+ALL_FIELDS = (1 << len(STATUS_FIELDS)) - 1
+OUTBOX_LIMIT = 1024 * 1024      # a client this far behind is dropped
+
+# Robot methods clients may run through CALL.
+DAEMON_CALLS = frozenset((
+    'get_rtt_estimates', 'get_link_stats', 'reset_link_stats', 'retransmit_timeout', 'get_sensor_value',
+    'start_sensor_stream', 'stop_sensor_stream', 'start_recording', 'stop_recording',
+))
+
+
+def default_socket_path():
+    runtime = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime:
+        return os.path.join(runtime, "algopython.sock")
+    return f"/tmp/algopython-{os.getuid()}.sock"
+
+
+def encode(kind, request_id, payload=b""):
+    return HEADER.pack(kind, request_id, len(payload)) + payload
+
+
+def decode(buffer):
+    """Pop complete (type, request id, payload) messages off the front of a bytearray."""
+    messages = []
+    offset = 0
+    while len(buffer) - offset >= HEADER.size:
+        kind, request_id, length = HEADER.unpack_from(buffer, offset)
+        end = offset + HEADER.size + length
+        if end > len(buffer):
+            break
+        messages.append((kind, request_id, bytes(buffer[offset + HEADER.size:end])))
+        offset = end
+    del buffer[:offset]
+    return messages
+
+
+def request_header(cmd, priority=None, retries=None, deadline=None):
+    return REQUEST_HEADER.pack(
+        cmd,
+        0xFF if priority is None else priority,
+        0xFF if retries is None else min(max(retries, 0), 0xFE),
+        NO_DEADLINE if deadline is None else min(max(int(deadline * 1000), 0), NO_DEADLINE - 1))
+
+
+def split_frames(data):
+    """(cmd, payload) of every v1 request frame in `data`."""
+    frames = []
+    i = 0
+    while i + 3 < len(data):
+        if data[i] != core.FRAME_SYNC:
+            i += 1
+            continue
+        end = i + 3 + data[i + 2]
+        frames.append((data[i + 1], bytes(data[i + 3:end])))
+        i = end + 1
+    return frames
+
+
+def fields_mask(fields):
+    mask = 0
+    for field in fields:
+        mask |= 1 << STATUS_FIELDS.index(field)
+    return mask
+
+
+# -- daemon ----------------------------------------------------------------------------------------------------
+class Client:
+    __slots__ = ('sock', 'inbox', 'outbox', 'lock', 'mask', 'watches', 'closed')
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.inbox = bytearray()
+        self.outbox = bytearray()
+        self.lock = threading.Lock()
+        self.mask = 0
+        self.watches = 0
+        self.closed = False
+
+
+class Daemon:
+    """Owns one robot and serves it to the clients of a Unix domain socket."""
+
+    def __init__(self, port: str = None, connection=None, path: str = None, robot: Robot = None,
+                 protocol: int = core.PROTOCOL_V1):
+        self.robot = robot if robot is not None else Robot(port, connection, protocol=protocol)
+        self.path = path or default_socket_path()
+        self.clients = set()
+        self.groups = {}            # field mask -> [subscription handle, set of clients]
+        self._groups_lock = threading.Lock()
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=16, thread_name_prefix="algopython-daemon")
+        self._selector = selectors.DefaultSelector()
+        self._wakeup = os.pipe()
+        os.set_blocking(self._wakeup[1], False)
+        self._want_write = set()
+        self._listener = None
+        self._running = False
+        self._thread = None
+        self.requests = 0
+
+    # -- lifecycle -----------------------------------------------------------------------------------------
+    def start(self):
+        """Connect the robot, listen on the socket and serve from a background thread.
+
+        Raises RuntimeError if another daemon is already listening on the socket.
+        """
+        if os.path.exists(self.path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.path)
+            except ConnectionRefusedError:
+                os.unlink(self.path)    # left over from a daemon that did not shut down
+            except FileNotFoundError:
+                pass
+            else:
+                raise RuntimeError(f"An algopython daemon is already serving {self.path}")
+            finally:
+                probe.close()
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # Only this user may connect, from the moment the socket exists.
+        umask = os.umask(0o177)
+        try:
+            listener.bind(self.path)
+        except OSError:
+            listener.close()
+            raise
+        finally:
+            os.umask(umask)
+        if not self.robot.ensure_connection():
+            listener.close()
+            os.unlink(self.path)
+            raise RuntimeError("Serial port is not initialized.")
+        listener.listen()
+        listener.setblocking(False)
+        self._listener = listener
+        self._selector.register(listener, selectors.EVENT_READ, "listen")
+        self._selector.register(self._wakeup[0], selectors.EVENT_READ, "wakeup")
+        self._running = True
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        self.start()
+        try:
+            while self._thread.is_alive():
+                self._thread.join(0.5)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
+
+    def close(self):
+        if not self._running:
+            return
+        self._running = False
+        self._wake()
+        self._thread.join()
+        for client in list(self.clients):
+            self._drop(client)
+        self._selector.close()
+        self._listener.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        os.close(self._wakeup[0])
+        os.close(self._wakeup[1])
+        self._pool.shutdown(wait=False, cancel_futures=True)
+        self.robot.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # -- event loop ----------------------------------------------------------------------------------------
+    def _wake(self):
+        try:
+            os.write(self._wakeup[1], b"\0")
+        except (BlockingIOError, OSError):
+            pass
+
+    def _loop(self):
+        while self._running:
+            for key, events in self._selector.select():
+                if key.data == "listen":
+                    self._accept()
+                elif key.data == "wakeup":
+                    os.read(self._wakeup[0], 512)
+                    self._update_interest()
+                else:
+                    client = key.data
+                    if events & selectors.EVENT_READ:
+                        self._read(client)
+                    if events & selectors.EVENT_WRITE and not client.closed:
+                        self._flush(client)
+
+    def _accept(self):
+        try:
+            sock, _ = self._listener.accept()
+        except (BlockingIOError, OSError):
+            return
+        sock.setblocking(False)
+        client = Client(sock)
+        self.clients.add(client)
+        self._selector.register(sock, selectors.EVENT_READ, client)
+
+    def _update_interest(self):
+        with self._groups_lock:
+            pending, self._want_write = self._want_write, set()
+        for client in pending:
+            if client.closed:
+                self._drop(client)
+                continue
+            with client.lock:
+                events = selectors.EVENT_READ | (selectors.EVENT_WRITE if client.outbox else 0)
+            try:
+                self._selector.modify(client.sock, events, client)
+            except (KeyError, ValueError):
+                pass
+
+    def _read(self, client):
+        try:
+            data = client.sock.recv(65536)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b""
+        if not data:
+            self._drop(client)
+            return
+        client.inbox += data
+        for kind, request_id, payload in decode(client.inbox):
+            self._handle(client, kind, request_id, payload)
+
+    def _flush(self, client):
+        with client.lock:
+            try:
+                sent = client.sock.send(client.outbox)
+            except BlockingIOError:
+                sent = 0
+            except OSError:
+                client.closed = True
+                sent = 0
+            del client.outbox[:sent]
+            idle = not client.outbox
+        if client.closed:
+            self._drop(client)
+        elif idle:
+            self._selector.modify(client.sock, selectors.EVENT_READ, client)
+
+    def send(self, client, data):
+        """Queue `data` for a client; called from any thread."""
+        with client.lock:
+            if client.closed:
+                return
+            if not client.outbox:
+                try:
+                    sent = client.sock.send(data)
+                except BlockingIOError:
+                    sent = 0
+                except OSError:
+                    client.closed = True
+                    sent = len(data)
+                data = data[sent:]
+            if data:
+                client.outbox += data
+                if len(client.outbox) > OUTBOX_LIMIT:
+                    client.closed = True
+            if not data and not client.closed:
+                return
+        with self._groups_lock:
+            self._want_write.add(client)
+        self._wake()
+
+    def _drop(self, client):
+        if client not in self.clients:
+            return
+        self.clients.discard(client)
+        client.closed = True
+        self._set_mask(client, 0)
+        if client.watches:
+            with self.robot.status_lock:
+                self.robot.status_waiters -= client.watches
+            client.watches = 0
+        try:
+            self._selector.unregister(client.sock)
+        except (KeyError, ValueError):
+            pass
+        client.sock.close()
+
+    # -- requests ------------------------------------------------------------------------------------------
+    def _handle(self, client, kind, request_id, payload):
+        if kind == MSG_REQUEST:
+            self.requests += 1
+            cmd, priority, retries, deadline = REQUEST_HEADER.unpack_from(payload)
+            job = (client, request_id, cmd, payload[REQUEST_HEADER.size:],
+                   None if priority == 0xFF else priority, None if retries == 0xFF else retries,
+                   None if deadline == NO_DEADLINE else deadline / 1000)
+            if command_priority(cmd) == PRIORITY_STOP:
+                # Stops must not wait for a pool thread.
+                threading.Thread(target=self._run_request, args=job, daemon=True).start()
+            else:
+                self._pool.submit(self._run_request, *job)
+        elif kind == MSG_SUBSCRIBE:
+            self._set_mask(client, int.from_bytes(payload[:2], "little") & ALL_FIELDS)
+        elif kind == MSG_WATCH:
+            delta = int.from_bytes(payload[:1], "little", signed=True)
+            delta = max(delta, -client.watches)
+            client.watches += delta
+            with self.robot.status_lock:
+                self.robot.status_waiters += delta
+            if delta > 0:
+                self.robot.request_status_poll()
+        elif kind == MSG_CALL:
+            self._pool.submit(self._run_call, client, request_id, payload)
+
+    def _run_request(self, client, request_id, cmd, payload, priority, retries, deadline):
+        reply = self.robot.send_packet(cmd, payload, retries=retries, verbose=False, priority=priority,
+                                       deadline=deadline)
+        if reply is None:
+            body = bytes([REPLY_NONE])
+        elif reply is True:
+            body = bytes([REPLY_SENT])
+        else:
+            body = bytes([REPLY_PAYLOAD]) + bytes(reply)
+        self.send(client, encode(MSG_REPLY, request_id, body))
+
+    def _run_call(self, client, request_id, payload):
+        try:
+            call = json.loads(payload)
+            if call["name"] not in DAEMON_CALLS:
+                raise AttributeError(f"{call['name']} is not available through the daemon")
+            value = getattr(self.robot, call["name"])(*call.get("args", ()))
+            if call["name"] in ('start_sensor_stream', 'start_recording'):
+                value = None        # the stream or recorder stays in the daemon
+            result = {"ok": True, "value": value}
+        except Exception as e:
+            result = {"ok": False, "error": f"{type(e).__name__}: {e}"}
+        self.send(client, encode(MSG_RESULT, request_id, json.dumps(result).encode()))
+
+    # -- status subscriptions ------------------------------------------------------------------------------
+    def status_message(self):
+        robot = self.robot
+        status = robot.status
+        with robot.status_lock:
+            raw = bytes(int(getattr(status, field)) & 0xFF for field in STATUS_FIELDS)
+            edges = [robot.status_idle_edges[field] for field in STATUS_EDGE_FIELDS]
+        history = robot.status_history
+        timestamp = history.last_seen or time.monotonic()
+        return encode(MSG_STATUS, 0, STATUS_BLOCK.pack(timestamp, raw, *edges, history.frames))
+
+    def _set_mask(self, client, mask):
+        with self._groups_lock:
+            if client.mask:
+                group = self.groups[client.mask]
+                group[1].discard(client)
+                if not group[1]:
+                    self.robot.unsubscribe_status(group[0])
+                    del self.groups[client.mask]
+            client.mask = mask
+            if mask:
+                group = self.groups.get(mask)
+                if group is None:
+                    fields = [field for i, field in enumerate(STATUS_FIELDS) if mask >> i & 1]
+                    handle = self.robot.subscribe_status(lambda changes, mask=mask: self._publish(mask), fields)
+                    group = self.groups[mask] = [handle, set()]
+                group[1].add(client)
+        if mask:
+            self.send(client, self.status_message())
+
+    def _publish(self, mask):
+        message = self.status_message()         # encoded once for the whole group
+        with self._groups_lock:
+            group = self.groups.get(mask)
+            clients = list(group[1]) if group else []
+        for client in clients:
+            self.send(client, message)
+
+
+# -- client ----------------------------------------------------------------------------------------------------
+class DaemonRobot(RemoteRobot):
+    """A Robot served by a running daemon; same methods as Robot.
+
+    Sensor streams and session recordings run in the daemon (a recording's path is opened
+    there), and link statistics are shared by every client.
+    """
+
+    def __init__(self, port: str = None, connection=None, name: str = None, history_capacity: int = 65536,
+                 path: str = None):
+        super().__init__(port, connection, name, history_capacity)
+        self.path = path or default_socket_path()
+        self._sock = None
+        self._send_lock = threading.Lock()
+        self._receiver = None
+        self._first_status = threading.Event()
+
+    def connect(self, port: str = None, connection=None, timeout: float = 5.0):
+        """Connect to the daemon's socket and subscribe to the full status."""
+        if self._sock is not None:
+            return True
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.path)
+        except OSError as e:
+            print(f"No algopython daemon at {self.path}: {e}")
+            sock.close()
+            return False
+        self._sock = sock
+        self._first_status.clear()
+        self._receiver = threading.Thread(target=self._receive_loop, args=(sock,), daemon=True)
+        self._receiver.start()
+        self._send(encode(MSG_SUBSCRIBE, 0, ALL_FIELDS.to_bytes(2, "little")))
+        if not self._first_status.wait(timeout):
+            self.close()
+            return False
+        self.ser = sock
+        if self.name is None:
+            self.name = self.path
+        return True
+
+    def close(self):
+        sock, self._sock = self._sock, None
+        self.ser = None
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
+        self._fail_pending(ConnectionError("Disconnected from the daemon"))
+
+    def _send(self, data):
+        with self._send_lock:
+            if self._sock is None:
+                return False
+            try:
+                self._sock.sendall(data)
+            except OSError:
+                return False
+        return True
+
+    def _receive_loop(self, sock):
+        inbox = bytearray()
+        while True:
+            try:
+                data = sock.recv(65536)
+            except OSError:
+                break
+            if not data:
+                break
+            inbox += data
+            for kind, request_id, payload in decode(inbox):
+                if kind == MSG_STATUS:
+                    self.apply_remote_status(*self._unpack_status(payload))
+                    self._first_status.set()
+                elif kind == MSG_REPLY:
+                    outcome = payload[0]
+                    value = None if outcome == REPLY_NONE else True if outcome == REPLY_SENT else payload[1:]
+                    self._resolve(request_id, True, value)
+                elif kind == MSG_RESULT:
+                    result = json.loads(payload)
+                    if result["ok"]:
+                        self._resolve(request_id, True, result["value"])
+                    else:
+                        self._resolve(request_id, False, RuntimeError(result["error"]))
+        if self._sock is sock:
+            print("[Error] Connection to the algopython daemon lost.")
+            self._sock = None
+            self.ser = None
+        self._fail_pending(ConnectionError("Disconnected from the daemon"))
+
+    @staticmethod
+    def _unpack_status(payload):
+        values = STATUS_BLOCK.unpack(payload)
+        return values[0], values[1], values[2:-1], values[-1]
+
+    def _request(self, kind, payload):
+        request_id, future = self._new_request()
+        if not self._send(encode(kind, request_id, payload)):
+            self._replies.pop(request_id, None)
+            future.set_exception(ConnectionError("Not connected to the daemon"))
+        return request_id, future
+
+    def _request_frame(self, cmd, payload, priority=None, retries=None, deadline=None):
+        header = request_header(cmd, priority, retries, deadline)
+        request_id, future = self._request(MSG_REQUEST, header + bytes(payload))
+        future.remote_request = request_id
+        return future
+
+    def _call(self, name, *args):
+        if not self.ensure_connection():
+            print("[Error] Serial port is not initialized.")
+            return None
+        if name == 'send_packet':
+            cmd, payload, _, _, retries, verbose, priority, deadline = args
+            reply = self._result(self._request_frame(cmd, payload, priority, retries, deadline))
+            if reply is None and verbose:
+                print(f"[Fail] No reply for CMD 0x{cmd:02X}.")
+            return reply
+        if name == 'serial_queue_command':
+            # Every request is queued by priority in the daemon already.
+            cmd, payload, _, priority = args
+            return self._result(self._request_frame(cmd, payload, priority))
+        if name == 'send_many':
+            # Pipelined: every request is on its way before the first reply is awaited.
+            commands, _, retries, verbose = args
+            futures = [self._request_frame(cmd, payload, retries=retries) for cmd, payload in commands]
+            replies = [self._result(future) for future in futures]
+            if verbose and any(reply is None for reply in replies):
+                failed = ", ".join(f"0x{cmd:02X}" for (cmd, _), reply in zip(commands, replies) if reply is None)
+                print(f"[Fail] No reply for CMD {failed}.")
+            return replies
+        if name == 'set_polling_policy':
+            return None     # the daemon's poller serves every client
+        _, future = self._request(MSG_CALL, json.dumps({"name": name, "args": list(args)}).encode())
+        return self._result(future)
+
+    def _submit(self, cmd, payload, priority):
+        future = self._request_frame(cmd, payload, priority, retries=0)
+        if CMD_REPLY_MAP.get(cmd) is None:
+            return None
+        return future
+
+    def _write(self, data, expected, priority):
+        # The daemon writes no raw bytes: each frame goes out as a request without retries,
+        # under the id its expect_reply() Future waits on.
+        expected = list(expected)
+        for cmd, payload in split_frames(data):
+            request_id = 0
+            if expected and expected[0][2] == cmd:
+                request_id = expected.pop(0)[0]
+            message = encode(MSG_REQUEST, request_id, request_header(cmd, priority, 0) + payload)
+            if not self._send(message) and request_id:
+                self._resolve(request_id, False, ConnectionError("Not connected to the daemon"))
+
+    def _watch(self, delta):
+        self._send(encode(MSG_WATCH, 0, delta.to_bytes(1, "little", signed=True)))
+
+    def request_status_poll(self):
+        self._watch(1)
+        self._watch(-1)
+
+    def subscribe_fields(self, fields):
+        """Narrow the status this client receives to `fields` (all of them by default)."""
+        self._send(encode(MSG_SUBSCRIBE, 0, fields_mask(fields).to_bytes(2, "little")))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m algopython.daemon")
+    target = parser.add_mutually_exclusive_group()
+    target.add_argument("--port", help="serial port of the brain (default: discover it)")
+    target.add_argument("--sim", action="store_true", help="serve the simulated brain")
+    parser.add_argument("--socket", help=f"socket path (default: {default_socket_path()})")
+    parser.add_argument("--protocol", type=int, choices=(1, 2), default=1,
+                        help="newest protocol version to offer the brain (default: 1)")
+    args = parser.parse_args(argv)
+    connection = None
+    if args.sim:
+        from .sim import LoopbackSerial
+        connection = LoopbackSerial()
+    daemon = Daemon(args.port, connection, args.socket, protocol=args.protocol)
+    print(f"Serving on {daemon.path}")
+    daemon.serve_forever()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
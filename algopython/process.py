@@ -0,0 +1,629 @@
+"""Run the serial engine in a child process.
+
+    algopython_init(separate_process=True)      # the module-level API, unchanged
+    robot = ProcessRobot("/dev/ttyUSB0")        # or one robot explicitly
+
+The child process owns the port and runs an ordinary Robot: reader, status poller, retries
+and sensor streams. A script that keeps the interpreter busy with numeric work therefore no
+longer delays status polling or reply decoding.
+
+The child publishes every status frame into a small multiprocessing.shared_memory block
+guarded by a seqlock: the raw status bytes, when they arrived and how many busy -> idle
+edges each field has had. Waiting calls read the block themselves, so a completion is
+never missed even when the parent's threads were starved while it happened. Commands
+and their replies travel over a multiprocessing Pipe; every request carries an id and the
+child runs it on its own thread, so stops are never queued behind a retrying command.
+
+Raw frames written with expect_reply() and serial_write() (Timeline, Animator) go to the
+child in one message and are written there in one piece; queued commands (RuleEngine
+actions) go through the child's command queue. Sensor stream rings and session
+recordings stay in the child; get_sensor_value() still returns the newest streamed sample.
+
+The child is started with "forkserver" (Linux) or "spawn", never "fork", so the script
+that starts the engine must guard its top level with `if __name__ == "__main__":` and
+`connection` must be picklable (LoopbackSerial is).
+"""
+import collections
+import concurrent.futures
+import contextlib
+import itertools
+import multiprocessing
+import struct
+import sys
+import threading
+import time
+from multiprocessing import shared_memory
+
+from . import algopython as core
+from .algopython import Robot, STATUS_EDGE_FIELDS, STATUS_FIELDS, CMD_REPLY_MAP, PRIORITY_STOP, command_priority
+from .record import sent_commands
+
+__all__ = ['ProcessRobot', 'RemoteRobot']
+
+# Seqlock word, then: arrival time (time.monotonic(), system wide), raw status bytes,
+# busy -> idle edges per STATUS_EDGE_FIELDS entry and the number of frames published.
+SEQUENCE = struct.Struct("<I")
+STATUS_BLOCK = struct.Struct(f"<d{len(STATUS_FIELDS)}s{len(STATUS_EDGE_FIELDS)}II")
+BLOCK_SIZE = SEQUENCE.size + STATUS_BLOCK.size
+
+# How often a waiting call re-reads the block if no change notification reaches it.
+RESYNC_INTERVAL = 0.02
+
+# Robot methods the parent runs in the child, with results sent back.
+ENGINE_CALLS = frozenset((
+    'send_packet', 'send_many', 'retransmit_timeout', 'get_rtt_estimates', 'get_link_stats',
+    'reset_link_stats', 'set_polling_policy', 'request_status_poll', 'get_sensor_value',
+    'start_sensor_stream', 'stop_sensor_stream', 'start_recording', 'stop_recording', 'serial_queue_command',
+))
+
+
+def default_start_method():
+    # Never "fork": the parent already runs the reader, poller and user threads, and a
+    # forked child can inherit a lock one of them held.
+    if 'forkserver' in multiprocessing.get_all_start_methods() and sys.platform != 'darwin':
+        return 'forkserver'
+    return 'spawn'
+
+
+def write_block(buf, timestamp, raw, edges, frames):
+    """Publish one status frame. Only one writer may call this at a time."""
+    sequence = SEQUENCE.unpack_from(buf, 0)[0]
+    SEQUENCE.pack_into(buf, 0, (sequence + 1) & 0xFFFFFFFF)       # odd: write in progress
+    STATUS_BLOCK.pack_into(buf, SEQUENCE.size, timestamp, raw, *edges, frames)
+    SEQUENCE.pack_into(buf, 0, (sequence + 2) & 0xFFFFFFFF)
+
+
+def read_block(buf):
+    """(timestamp, raw status, edges, frames) from a consistent copy of the block."""
+    while True:
+        before = SEQUENCE.unpack_from(buf, 0)[0]
+        if before & 1:
+            time.sleep(0)
+            continue
+        values = STATUS_BLOCK.unpack_from(buf, SEQUENCE.size)
+        if SEQUENCE.unpack_from(buf, 0)[0] == before:
+            return values[0], values[1], values[2:-1], values[-1]
+
+
+# -- child side ------------------------------------------------------------------------------------------------
+class EngineRobot(Robot):
+    """The child's Robot: also publishes every status frame to the shared block."""
+
+    def __init__(self, buf, notify, port=None, connection=None, protocol=core.PROTOCOL_V1):
+        super().__init__(port, connection, protocol=protocol)
+        self.block = buf
+        self.notify = notify
+        self.frames_published = 0
+        self._published = None
+        self._publish_lock = threading.Lock()
+
+    def apply_status(self, response):
+        super().apply_status(response)
+        raw = bytes(response[:len(STATUS_FIELDS)])
+        with self._publish_lock:
+            if self.block is None:
+                return
+            with self.status_lock:
+                edges = [self.status_idle_edges[field] for field in STATUS_EDGE_FIELDS]
+            self.frames_published += 1
+            write_block(self.block, time.monotonic(), raw, edges, self.frames_published)
+            changed = raw != self._published
+            self._published = raw
+        if changed:
+            self.notify()
+
+
+def engine_main(conn, block_name, port, connection, timeout, protocol=core.PROTOCOL_V1):
+    block = shared_memory.SharedMemory(name=block_name)
+    send_lock = threading.Lock()
+
+    def send(message):
+        with send_lock:
+            try:
+                conn.send(message)
+            except (OSError, ValueError):
+                pass        # the parent is gone
+
+    robot = EngineRobot(block.buf, lambda: send(("status",)), port, connection, protocol)
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=8, thread_name_prefix="algopython-engine")
+    submitted = {}      # request id -> (reply cmd, Future)
+    deferred = set()    # request ids waiting for a slot of the v2 window
+
+    def run_call(request_id, name, args, kwargs):
+        try:
+            result = getattr(robot, name)(*args, **kwargs)
+            if name in ('start_sensor_stream', 'start_recording'):
+                result = None       # the stream or recorder stays here
+            send(("reply", request_id, True, result))
+        except Exception as e:
+            send(("reply", request_id, False, e))
+
+    def on_reply(request_id, future):
+        submitted.pop(request_id, None)
+        if future.cancelled():
+            send(("reply", request_id, None, None))
+        else:
+            send(("reply", request_id, True, future.result()))
+
+    def submit(request_id, cmd, payload, priority):
+        # Never block the message loop on the v2 window: retry once a slot comes free.
+        future = robot.submit_packet(cmd, payload, priority=priority, block=False)
+        if request_id is None:
+            return
+        if future is None:
+            deferred.add(request_id)
+            robot.window_slot_free().add_done_callback(
+                lambda _: pool.submit(resubmit, request_id, cmd, payload, priority))
+            return
+        submitted[request_id] = (CMD_REPLY_MAP[cmd], future)
+        future.add_done_callback(lambda f: on_reply(request_id, f))
+
+    def resubmit(request_id, cmd, payload, priority):
+        try:
+            deferred.remove(request_id)
+        except KeyError:
+            return      # cancelled while waiting
+        submit(request_id, cmd, payload, priority)
+
+    try:
+        ok = robot.connect(port, connection, timeout)
+        send(("ready", ok, str(robot.port if robot.port is not None else getattr(robot.ser, 'port', port))))
+        if not ok:
+            return
+        while True:
+            try:
+                message = conn.recv()
+            except (EOFError, OSError):
+                break
+            kind = message[0]
+            if kind == "call":
+                _, request_id, name, args, kwargs = message
+                if name not in ENGINE_CALLS:
+                    send(("reply", request_id, False, AttributeError(f"{name} is not available in the engine")))
+                elif name in ('send_packet', 'serial_queue_command') and command_priority(args[0]) == PRIORITY_STOP:
+                    # Stops must not wait for a pool thread.
+                    threading.Thread(target=run_call, args=message[1:], daemon=True).start()
+                else:
+                    pool.submit(run_call, request_id, name, args, kwargs)
+            elif kind == "submit":
+                _, request_id, cmd, payload, priority = message
+                if (command_priority(cmd) if priority is None else priority) == PRIORITY_STOP:
+                    robot.begin_stop()
+                submit(request_id, cmd, payload, priority)
+            elif kind == "write":
+                _, data, expected, priority = message
+                if priority == PRIORITY_STOP:
+                    robot.begin_stop()
+                # Register before writing so a fast reply can't slip past as unsolicited.
+                for request_id, reply_cmd, request_cmd in expected:
+                    future = robot.expect_reply(reply_cmd, request_cmd)
+                    submitted[request_id] = (reply_cmd, future)
+                    future.add_done_callback(lambda f, request_id=request_id: on_reply(request_id, f))
+                robot.serial_write(data, priority)
+                for cmd, _ in sent_commands(data):
+                    robot.link_stats.record_sent(cmd)
+            elif kind == "cancel":
+                deferred.discard(message[1])
+                entry = submitted.pop(message[1], None)
+                if entry is not None:
+                    robot.cancel_reply(*entry)
+            elif kind == "watch":
+                with robot.status_lock:
+                    robot.status_waiters += message[1]
+                robot.request_status_poll()
+            elif kind == "close":
+                break
+    finally:
+        robot.close()
+        pool.shutdown(wait=False, cancel_futures=True)
+        with robot._publish_lock:
+            robot.block = None      # the poller may still be finishing a poll
+        block.close()
+        conn.close()
+
+
+# -- parent side -----------------------------------------------------------------------------------------------
+class EngineHandle:
+    """Stands in for the serial port in the parent: the port is open in the engine process."""
+
+    def __init__(self, process, port):
+        self.process = process
+        self.port = port
+
+    @property
+    def is_open(self):
+        return self.process.is_alive()
+
+    def __repr__(self):
+        return f"EngineHandle({self.port!r}, pid={self.process.pid})"
+
+
+class RemoteRobot(Robot):
+    """Base of robots whose serial engine lives elsewhere (a child process, the daemon).
+
+    Subclasses provide the transport: _call(name, *args) runs a Robot method remotely,
+    _submit(cmd, payload, priority) returns a Future for one reply, _write(data, expected,
+    priority) writes raw frames and routes their replies to the request ids in
+    `expected`, _watch(delta) keeps the remote poller fast and sync_status() pulls status
+    that is not pushed. Status and
+    busy -> idle edge counters come in through apply_remote_status(); the counters are
+    taken over as they are, so edges between two updates are never lost.
+    """
+
+    separate_process = True
+
+    def __init__(self, port: str = None, connection=None, name: str = None, history_capacity: int = 65536):
+        super().__init__(port, connection, name, history_capacity)
+        self._requests = itertools.count(1)
+        self._replies = {}          # request id -> Future
+        self._sync_lock = threading.Lock()
+        self._raw_lock = threading.Lock()
+        self._raw_expected = {}     # reply cmd -> (request id, request cmd) awaiting serial_write()
+        self._frames_seen = 0
+        self.status_age = None      # seconds between the newest status frame and the last update
+
+    @classmethod
+    def replacing(cls, robot, **kwargs):
+        """A robot that takes over `robot`'s status object and listener lists."""
+        replacement = cls(robot.port, robot._connection, robot.name, **kwargs)
+        replacement.protocol_preference = robot.protocol_preference
+        replacement.status = robot.status
+        replacement.status_edge_listeners = robot.status_edge_listeners
+        replacement.status_subscribers = robot.status_subscribers
+        return replacement
+
+    def _new_request(self):
+        request_id = next(self._requests)
+        future = concurrent.futures.Future()
+        self._replies[request_id] = future
+        return request_id, future
+
+    def _resolve(self, request_id, ok, value):
+        """Settle a request: ok is True (result), False (exception) or None (cancelled)."""
+        future = self._replies.pop(request_id, None)
+        if future is None or future.done():
+            return
+        if ok is None:
+            future.cancel()
+        elif ok:
+            future.set_result(value)
+        else:
+            future.set_exception(value)
+
+    def _fail_pending(self, error):
+        replies, self._replies = self._replies, {}
+        for future in replies.values():
+            if not future.done():
+                future.set_exception(error)
+
+    def _result(self, future):
+        try:
+            return future.result()
+        except ConnectionError as e:
+            print(f"[Error] {e}")
+            return None
+
+    # -- status --------------------------------------------------------------------------------------------
+    def apply_remote_status(self, timestamp, raw, edges, frames):
+        with self._sync_lock:
+            self.status_age = time.monotonic() - timestamp if frames else None
+            if frames == self._frames_seen:
+                return
+            self._frames_seen = frames
+            self.apply_status(raw)
+            missed = []
+            with self.status_lock:
+                for field, count in zip(STATUS_EDGE_FIELDS, edges):
+                    if count > self.status_idle_edges[field]:
+                        self.status_idle_edges[field] = count
+                        self.status_conditions[field].notify_all()
+                        missed.append(field)
+        for field in missed:
+            for listener in self.status_edge_listeners:
+                listener(field)
+
+    def sync_status(self):
+        return self.status
+
+    def read_status(self):
+        """The current DeviceStatus, as fresh as the transport allows."""
+        return self.sync_status()
+
+    def status_edge_snapshot(self):
+        self.sync_status()
+        return super().status_edge_snapshot()
+
+    @core.traced("wait_for_idle")
+    def wait_for_idle(self, fields, since, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.watching_status():
+            while True:
+                self.sync_status()
+                with self.status_lock:
+                    waiting = [f for f in fields if self.status_idle_edges[f] <= since[f]]
+                    if not waiting:
+                        return True
+                    wait = RESYNC_INTERVAL
+                    if deadline is not None:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            return False
+                        wait = min(wait, remaining)
+                    self.status_conditions[waiting[0]].wait(wait)
+
+    @contextlib.contextmanager
+    def watching_status(self):
+        with self.status_lock:
+            self.status_waiters += 1
+        self._watch(1)
+        try:
+            yield
+        finally:
+            with self.status_lock:
+                self.status_waiters -= 1
+            self._watch(-1)
+
+    def set_polling_policy(self, fast_interval=0.01, idle_interval=0.5, backoff=2.0):
+        self.polling_policy = core.PollingPolicy(fast_interval, idle_interval, backoff)
+        if self.ser is not None:
+            self._call('set_polling_policy', fast_interval, idle_interval, backoff)
+        return self.polling_policy
+
+    # -- commands ------------------------------------------------------------------------------------------
+    @core.traced("send_packet", with_cmd=True)
+    def send_packet(self, cmd, payload, wait_done=True, delay_after=0, retries=None, verbose=True, priority=None,
+                    deadline=None, background=False):
+        # background polls only come from the engine's own poller.
+        if self.current_batch() is not None:
+            return super().send_packet(cmd, payload, wait_done, delay_after, retries, verbose, priority, deadline)
+        return self._call('send_packet', cmd, bytes(payload), wait_done, delay_after, retries, verbose, priority,
+                          deadline)
+
+    def send_many(self, commands, timeout=None, retries=2, verbose=True):
+        replies = self._call('send_many', [(cmd, bytes(payload)) for cmd, payload in commands],
+                             timeout, retries, verbose)
+        return [None] * len(commands) if replies is None else replies
+
+    def submit_packet(self, cmd, payload, packet=None, priority=None, block=True):
+        # The engine holds requests back while its v2 window is full; this never blocks.
+        future = self._submit(cmd, bytes(payload), priority)
+        if future is not None:
+            future.request_cmd = cmd
+            future.retransmission = False
+            future.sent_at = time.perf_counter()
+        return future
+
+    def cancel_reply(self, reply_cmd, future):
+        request_id = getattr(future, 'remote_request', None)
+        if request_id is not None and self._replies.pop(request_id, None) is not None:
+            self._cancel(request_id)
+        return future.cancel()
+
+    def _cancel(self, request_id):
+        pass
+
+    def serial_queue_command(self, cmd, payload, expect_reply=True, priority=None):
+        return self._call('serial_queue_command', cmd, bytes(payload), expect_reply, priority)
+
+    def expect_reply(self, reply_cmd, request_cmd=None, sequence=None):
+        """Future for the reply to a `request_cmd` frame that the next serial_write() sends."""
+        request_id, future = self._new_request()
+        future.remote_request = request_id
+        future.request_cmd = request_cmd
+        future.reply_cmd = reply_cmd
+        future.sequence = None
+        future.sent_at = time.perf_counter()
+        future.retransmission = False
+        future.background_poll = False
+        with self._raw_lock:
+            self._raw_expected.setdefault(reply_cmd, collections.deque()).append((request_id, request_cmd))
+        return future
+
+    def serial_write(self, data, priority=core.PRIORITY_COMMAND):
+        """Write raw v1 frames; replies resolve the Futures taken with expect_reply()."""
+        data = bytes(data)
+        expected = []
+        with self._raw_lock:
+            for cmd, _ in sent_commands(data):
+                reply_cmd = CMD_REPLY_MAP.get(cmd)
+                waiting = self._raw_expected.get(reply_cmd)
+                while waiting:
+                    request_id, request_cmd = waiting.popleft()
+                    if request_id in self._replies:         # not cancelled meanwhile
+                        expected.append((request_id, reply_cmd, request_cmd))
+                        break
+        self._write(data, expected, priority)
+
+    def _write(self, data, expected, priority):
+        raise NotImplementedError
+
+    def retransmit_timeout(self, cmd, attempt=0):
+        return self._call('retransmit_timeout', cmd, attempt)
+
+    def get_rtt_estimates(self):
+        return self._call('get_rtt_estimates')
+
+    def get_link_stats(self, reset: bool = False):
+        return self._call('get_link_stats', reset)
+
+    def reset_link_stats(self):
+        return self._call('reset_link_stats')
+
+    def get_sensor_value(self, sensor_port: int) -> int:
+        if sensor_port not in (1, 2):
+            raise ValueError("Port must be 1 or 2")
+        return self._call('get_sensor_value', sensor_port)
+
+    def start_sensor_stream(self, ports=(1, 2), capacity: int = 4096, window: int = 4):
+        """Stream the sensors in the engine; get_sensor_value() then returns the newest sample."""
+        return self._call('start_sensor_stream', tuple(ports), capacity, window)
+
+    def stop_sensor_stream(self):
+        if self.ser is not None:
+            self._call('stop_sensor_stream')
+
+    def start_recording(self, path, flush_bytes: int = 64 * 1024, flush_interval: float = 0.5):
+        return self._call('start_recording', path, flush_bytes, flush_interval)
+
+    def stop_recording(self):
+        if self.ser is not None:
+            self._call('stop_recording')
+
+
+class ProcessRobot(RemoteRobot):
+    """A Robot whose serial engine runs in a child process; same methods as Robot."""
+
+    def __init__(self, port: str = None, connection=None, name: str = None, history_capacity: int = 65536,
+                 start_method: str = None):
+        super().__init__(port, connection, name, history_capacity)
+        self.start_method = start_method or default_start_method()
+        self.process = None
+        self._block = None
+        self._conn = None
+        self._send_lock = threading.Lock()
+        self._receiver = None
+
+    # -- connection ----------------------------------------------------------------------------------------
+    def connect(self, port: str = None, connection=None, timeout: float = 5.0):
+        """Start the engine process and wait until it has connected to the brain."""
+        if self.process is not None and self.process.is_alive():
+            return True
+        port = port or self.port
+        connection = connection or self._connection
+        context = multiprocessing.get_context(self.start_method)
+        block = shared_memory.SharedMemory(create=True, size=BLOCK_SIZE)
+        block.buf[:BLOCK_SIZE] = bytes(BLOCK_SIZE)
+        conn, child_conn = context.Pipe()
+        process = context.Process(target=engine_main,
+                                  args=(child_conn, block.name, port, connection, timeout, self.protocol_preference),
+                                  name=f"algopython-engine-{port}", daemon=True)
+        try:
+            process.start()
+        except Exception as e:      # typically a connection that can't be pickled
+            print(f"[Error] Could not start the engine process: {e}")
+            conn.close()
+            child_conn.close()
+            block.close()
+            block.unlink()
+            return False
+        child_conn.close()
+        # Discovery and the handshake both happen in the child; allow for them on top of timeout.
+        ready = None
+        give_up_at = time.monotonic() + timeout + 10.0
+        while ready is None and conn.poll(max(0.0, give_up_at - time.monotonic())):
+            try:
+                message = conn.recv()
+            except (EOFError, OSError):
+                break
+            if message[0] == "ready":       # status notifications from the handshake come first
+                ready = message
+        if not ready or not ready[1]:
+            process.join(1.0)
+            if process.is_alive():
+                process.terminate()
+            conn.close()
+            block.close()
+            block.unlink()
+            return False
+
+        self.process, self._block, self._conn = process, block, conn
+        self._connection = None
+        if port:
+            self.port = port
+        if self.name is None:
+            self.name = ready[2]
+        self._frames_seen = 0
+        self.sync_status()
+        self.ser = EngineHandle(process, ready[2])
+        self._receiver = threading.Thread(target=self._receive_loop, args=(conn,), daemon=True)
+        self._receiver.start()
+        return True
+
+    def close(self):
+        conn, process, block = self._conn, self.process, self._block
+        if process is None:
+            return
+        self.ser = None
+        self._send(("close",))
+        process.join(2.0)
+        if process.is_alive():
+            process.terminate()
+            process.join()
+        conn.close()
+        self.process = self._conn = self._block = None
+        block.close()
+        block.unlink()
+        self._fail_pending(ConnectionError("Engine process stopped"))
+
+    # -- messaging -----------------------------------------------------------------------------------------
+    def _send(self, message):
+        with self._send_lock:
+            if self._conn is None:
+                return False
+            try:
+                self._conn.send(message)
+            except (OSError, ValueError):
+                return False
+        return True
+
+    def _request(self, kind, *fields):
+        request_id, future = self._new_request()
+        if not self._send((kind, request_id) + fields):
+            self._replies.pop(request_id, None)
+            future.set_exception(ConnectionError("Engine process is not running"))
+        return request_id, future
+
+    def _call(self, name, *args, **kwargs):
+        if not self.ensure_connection():
+            print("[Error] Serial port is not initialized.")
+            return None
+        _, future = self._request("call", name, args, kwargs)
+        return self._result(future)
+
+    def _submit(self, cmd, payload, priority):
+        if CMD_REPLY_MAP.get(cmd) is None:
+            self._send(("submit", None, cmd, payload, priority))
+            return None
+        request_id, future = self._request("submit", cmd, payload, priority)
+        future.remote_request = request_id
+        return future
+
+    def _write(self, data, expected, priority):
+        if not self._send(("write", data, expected, priority)):
+            error = ConnectionError("Engine process is not running")
+            for request_id, _, _ in expected:
+                future = self._replies.pop(request_id, None)
+                if future is not None and not future.done():
+                    future.set_exception(error)
+
+    def _cancel(self, request_id):
+        self._send(("cancel", request_id))
+
+    def _watch(self, delta):
+        self._send(("watch", delta))
+
+    def request_status_poll(self):
+        self._send(("call", 0, 'request_status_poll', (), {}))
+
+    def _receive_loop(self, conn):
+        while True:
+            try:
+                message = conn.recv()
+            except (EOFError, OSError):
+                break
+            if message[0] == "status":
+                self.sync_status()
+            elif message[0] == "reply":
+                self._resolve(*message[1:])
+        if self._conn is conn and self.ser is not None:
+            print("[Error] Engine process stopped.")
+            self.ser = None
+        self._fail_pending(ConnectionError("Engine process stopped"))
+
+    # -- status --------------------------------------------------------------------------------------------
+    def sync_status(self):
+        """Bring DeviceStatus and the edge counters up to date from the shared block."""
+        block = self._block
+        if block is not None:
+            self.apply_remote_status(*read_block(block.buf))
+        return self.status
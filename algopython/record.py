@@ -0,0 +1,207 @@
+"""Record the raw serial traffic of a session and replay it through the host stack.
+
+    robot.start_recording("session.apylog")
+    ...                                     # drive the robot as usual
+    robot.stop_recording()
+
+    replay = SessionReplay("session.apylog")
+    print(replay.run())                     # as fast as possible
+    print(replay.run(realtime=True))        # with the recorded timing
+
+The log is append-only: an 8-byte magic, the wall-clock start time, then one record per
+write to or read from the port. Every record is a 13-byte header (direction, nanoseconds
+since the start of the recording, length) followed by the bytes exactly as they crossed
+the link, so garbage and broken frames are replayed too. Records are buffered in memory
+and written in batches by a flusher thread.
+
+The replayer memory-maps the log and feeds the received bytes through FrameDecoder and
+Robot.dispatch_frame(), the same code the reader thread runs. Requests found in the
+sent bytes register reply waiters first, so replies are matched the way they were live
+and status replies update the robot's DeviceStatus.
+"""
+import mmap
+import struct
+import threading
+import time
+
+from .algopython import (Robot, FrameDecoder, CMD_REPLY_MAP, FRAME_SYNC, FRAME_SYNC_V2, PROTOCOL_V2,
+                         STATUS_FIELDS, ALGOPYTHON_CMD_GET_STATUS_REQ)
+
+__all__ = ['SessionRecorder', 'SessionReplay', 'iter_records']
+
+LOG_MAGIC = b"APYLOG\x01\x00"
+LOG_HEADER = struct.Struct("<8sd")          # magic, wall-clock start (time.time())
+RECORD_HEADER = struct.Struct("<BQI")       # direction, ns since start, length
+TX = 0
+RX = 1
+
+
+class SessionRecorder:
+    """Append TX/RX byte records to `path`, flushing every `flush_bytes` or `flush_interval` s."""
+
+    def __init__(self, path, flush_bytes: int = 64 * 1024, flush_interval: float = 0.5):
+        self.path = path
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+        self.records = 0
+        self._file = open(path, "wb")
+        self._file.write(LOG_HEADER.pack(LOG_MAGIC, time.time()))
+        self._start_ns = time.monotonic_ns()
+        self._buffer = bytearray()
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._flusher = threading.Thread(target=self._flush_loop, daemon=True)
+        self._flusher.start()
+
+    def _append(self, direction, data):
+        offset = time.monotonic_ns() - self._start_ns
+        with self._lock:
+            if self._file is None:
+                return
+            self._buffer += RECORD_HEADER.pack(direction, offset, len(data))
+            self._buffer += data
+            self.records += 1
+            if len(self._buffer) >= self.flush_bytes:
+                self._write_buffer()
+
+    def tx(self, data):
+        self._append(TX, data)
+
+    def rx(self, data):
+        self._append(RX, data)
+
+    def _write_buffer(self):
+        if self._buffer:
+            self._file.write(self._buffer)
+            self._buffer.clear()
+
+    def flush(self):
+        with self._lock:
+            if self._file is None:
+                return
+            self._write_buffer()
+            self._file.flush()
+
+    def _flush_loop(self):
+        while not self._closed.wait(self.flush_interval):
+            self.flush()
+
+    def close(self):
+        self._closed.set()
+        with self._lock:
+            if self._file is None:
+                return
+            self._write_buffer()
+            self._file.close()
+            self._file = None
+
+
+def iter_records(log):
+    """Yield (direction, seconds since start, memoryview of the bytes) from a mapped log.
+
+    A record cut short at the end of the file (the recorder was killed mid-write) ends
+    the iteration.
+    """
+    view = memoryview(log)
+    if len(view) < LOG_HEADER.size or bytes(view[:8]) != LOG_MAGIC:
+        raise ValueError("Not an algopython session log")
+    offset = LOG_HEADER.size
+    end = len(view)
+    while offset + RECORD_HEADER.size <= end:
+        direction, ns, length = RECORD_HEADER.unpack_from(view, offset)
+        offset += RECORD_HEADER.size
+        if offset + length > end:
+            return
+        yield direction, ns / 1e9, view[offset:offset + length]
+        offset += length
+
+
+def sent_commands(data):
+    """(opcode, v2 sequence number or None) of the requests in a chunk of sent bytes.
+
+    v1 requests carry a header-only checksum, so frames are delimited by length only.
+    """
+    commands = []
+    i = 0
+    end = len(data)
+    while i + 3 < end:
+        if data[i] == FRAME_SYNC:
+            commands.append((data[i + 1], None))
+            i += data[i + 2] + 4
+        elif data[i] == FRAME_SYNC_V2 and i + 5 < end:
+            commands.append((data[i + 1], data[i + 2]))
+            i += data[i + 3] + 6
+        else:
+            i += 1
+    return commands
+
+
+class SessionReplay:
+    """Drive a Robot's decoder and dispatcher from a recorded session log."""
+
+    def __init__(self, path, robot: Robot = None):
+        self.path = path
+        self.robot = robot if robot is not None else Robot(name="replay")
+
+    def _expect(self, cmd, sequence=None):
+        robot = self.robot
+        reply_cmd = CMD_REPLY_MAP.get(cmd)
+        if reply_cmd is None:
+            return None
+        future = robot.expect_reply(reply_cmd, cmd, sequence)
+        if cmd == ALGOPYTHON_CMD_GET_STATUS_REQ:
+            future.add_done_callback(self._apply_status)
+        return future
+
+    def _apply_status(self, future):
+        if not future.cancelled() and len(future.result()) >= len(STATUS_FIELDS):
+            self.robot.apply_status(future.result())
+
+    def run(self, realtime: bool = False, speed: float = 1.0):
+        """Replay the whole log and return a summary of what the stack did with it.
+
+        With realtime=True each record is fed at its recorded offset (divided by `speed`).
+        """
+        robot = self.robot
+        robot.link_stats.reset()
+        decoder = FrameDecoder(protocol=PROTOCOL_V2)      # the log may hold either protocol
+        robot.reader_decoder = decoder
+        waiting = []
+        tx_bytes = rx_bytes = frames = 0
+        with open(self.path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as log:
+            started = time.perf_counter()
+            for direction, offset, data in iter_records(log):
+                if realtime:
+                    delay = offset / speed - (time.perf_counter() - started)
+                    if delay > 0:
+                        time.sleep(delay)
+                if direction == TX:
+                    tx_bytes += len(data)
+                    for cmd, sequence in sent_commands(data):
+                        future = self._expect(cmd, sequence)
+                        if future is not None:
+                            waiting.append(future)
+                    continue
+                rx_bytes += len(data)
+                for cmd, payload, seq in decoder.feed(data, offset):
+                    robot.dispatch_frame(cmd, bytes(payload), seq)
+                    frames += 1
+            elapsed = time.perf_counter() - started
+            data = None     # release the last view so the map can close
+        unanswered = 0
+        for future in waiting:
+            if not future.done():
+                robot.cancel_reply(CMD_REPLY_MAP[future.request_cmd], future)
+                unanswered += 1
+        return {
+            "elapsed_s": elapsed,
+            "tx_bytes": tx_bytes,
+            "rx_bytes": rx_bytes,
+            "rx_frames": frames,
+            "rx_frames_per_s": frames / elapsed if elapsed else None,
+            "requests": len(waiting),
+            "unanswered": unanswered,
+            "unsolicited_frames": len(robot.pop_unsolicited_frames()),
+            "discarded_bytes": decoder.discarded_bytes,
+            "bad_checksums": decoder.bad_checksums,
+        }
@@ -0,0 +1,332 @@
+"""Host-side rules that react to status and sensor values.
+
+    engine = RuleEngine()
+    engine.add({'sensor1_value': (30, 60), 'motor1': 0},
+               lambda: playSound(3, 7, is_blocking=False), debounce=0.1, hysteresis=3)
+    engine.add({'led1': 1}, (ALGOPYTHON_CMD_SOUND_STOP_REQ, b""))
+    engine.start()
+
+A rule is a set of conditions on STATUS_FIELDS, each an exact value or an inclusive
+(low, high) range with None for an open end. The rule fires when all of them start to hold,
+again only after one of them stopped holding. With `debounce` the conditions must hold for
+that many seconds first; with `hysteresis` a range condition, once met, holds until the
+value leaves the range widened by that much on both sides.
+
+Values come from the status poller (through subscribe_status) and from a running sensor
+stream (sensorN_value). Per field the engine keeps the sorted end points of every range,
+so a new value is located with one bisect and only conditions whose range it entered or
+left are looked at. Actions never run on the poller or reader thread: a callable runs on
+the engine's worker threads and a (cmd, payload) pair is queued through the robot's
+command queue like any other command.
+"""
+import bisect
+import concurrent.futures
+import heapq
+import itertools
+import threading
+import time
+
+from . import algopython as core
+from .algopython import STATUS_FIELDS, CMD_REPLY_MAP
+
+__all__ = ['RuleEngine', 'Rule']
+
+INF = float("inf")
+
+
+class Condition:
+    __slots__ = ('rule', 'field', 'low', 'high', 'exit_low', 'exit_high', 'inside')
+
+    def __init__(self, rule, field, spec, hysteresis):
+        if isinstance(spec, (tuple, list)):
+            low, high = spec
+        else:
+            low = high = int(spec)
+            hysteresis = 0      # an exact value holds only while it is that value
+        self.rule = rule
+        self.field = field
+        self.low = -INF if low is None else low
+        self.high = INF if high is None else high
+        if self.low > self.high:
+            raise ValueError(f"Empty range for {field}: {spec}")
+        self.exit_low = self.low - hysteresis
+        self.exit_high = self.high + hysteresis
+        self.inside = False
+
+    def enters(self, value):
+        return self.low <= value <= self.high
+
+    def stays(self, value):
+        return self.exit_low <= value <= self.exit_high
+
+
+class Rule:
+    """Conditions, the action they trigger and the rule's firing statistics."""
+
+    def __init__(self, conditions, action, debounce=0.0, hysteresis=0, once=False, name=None):
+        if not conditions:
+            raise ValueError("A rule needs at least one condition")
+        unknown = set(conditions) - set(STATUS_FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown status fields: {sorted(unknown)}")
+        if not callable(action) and (len(action) != 2 or action[0] not in CMD_REPLY_MAP):
+            raise ValueError("Action must be a callable or a (cmd, payload) pair")
+        self.name = name or " and ".join(f"{field}={spec}" for field, spec in conditions.items())
+        self.conditions = [Condition(self, field, spec, hysteresis) for field, spec in conditions.items()]
+        self.action = action
+        self.debounce = debounce
+        self.once = once
+        self.satisfied = 0          # conditions currently holding
+        self.generation = 0         # bumped whenever the rule stops holding; voids pending debounces
+        self.fired = 0
+        self.last_fired = None
+        self.errors = 0
+
+    def __repr__(self):
+        return f"Rule({self.name!r})"
+
+    @property
+    def holds(self):
+        return self.satisfied == len(self.conditions)
+
+
+class FieldIndex:
+    """Sorted range end points of one field and the conditions met in each segment.
+
+    The points split the value axis into segments (the points themselves and the gaps
+    between them) in which no condition's enter or stay range changes.
+    """
+
+    def __init__(self, conditions):
+        self.points = sorted({p for c in conditions for p in (c.low, c.high, c.exit_low, c.exit_high)})
+        points = self.points
+        self.segments = []
+        for k in range(2 * len(points) + 1):
+            if k % 2:
+                value = points[k // 2]
+            elif k == 0:
+                value = points[0] - 1
+            elif k == 2 * len(points):
+                value = points[-1] + 1
+            else:
+                value = (points[k // 2 - 1] + points[k // 2]) / 2
+            self.segments.append((frozenset(c for c in conditions if c.enters(value)),
+                                  frozenset(c for c in conditions if c.stays(value))))
+
+    def segment(self, value):
+        k = bisect.bisect_left(self.points, value)
+        return 2 * k + 1 if k < len(self.points) and self.points[k] == value else 2 * k
+
+
+class RuleEngine:
+    """Evaluates rules against one robot's status and sensor values."""
+
+    def __init__(self, robot=None, workers: int = 4):
+        self.robot = robot if robot is not None else core.default_robot()
+        self.rules = []
+        self.values = {}            # field -> last value seen
+        self.frames = 0             # field updates received
+        self.evaluations = 0        # conditions looked at for those updates
+        self._indexes = {}          # field -> FieldIndex
+        self._segments = {}         # field -> segment of the last value
+        self._lock = threading.RLock()
+        self._workers = workers
+        self._executor = None
+        self._subscription = None
+        self._watch = None
+        self._timers = []           # heap of (due, sequence, rule, generation)
+        self._timer_sequence = itertools.count()
+        self._timer_cond = threading.Condition(self._lock)
+        self._timer_thread = None
+        self._running = False
+
+    # -- rules ---------------------------------------------------------------------------------------------
+    def add(self, conditions, action, debounce: float = 0.0, hysteresis=0, once: bool = False, name: str = None):
+        """Add a rule and return it. Rules already holding fire once the engine runs."""
+        rule = Rule(conditions, action, debounce, hysteresis, once, name)
+        with self._lock:
+            self.rules.append(rule)
+            self._reindex()
+            for condition in rule.conditions:
+                value = self.values.get(condition.field)
+                if value is not None and condition.enters(value):
+                    condition.inside = True
+                    rule.satisfied += 1
+            if self._running and rule.holds:
+                self._rule_met(rule)
+        if self._running:
+            self._resubscribe()
+        return rule
+
+    def remove(self, rule):
+        with self._lock:
+            if rule not in self.rules:
+                return
+            self.rules.remove(rule)
+            rule.generation += 1
+            self._reindex()
+        if self._running:
+            self._resubscribe()
+
+    def _reindex(self):
+        by_field = {}
+        for rule in self.rules:
+            for condition in rule.conditions:
+                by_field.setdefault(condition.field, []).append(condition)
+        self._indexes = {field: FieldIndex(conditions) for field, conditions in by_field.items()}
+        self._segments = {field: index.segment(self.values[field])
+                          for field, index in self._indexes.items() if field in self.values}
+
+    # -- value updates -------------------------------------------------------------------------------------
+    def update(self, field, value):
+        """Feed one field value; normally called from the status and sensor listeners.
+
+        Before start() the rules only keep track of whether they hold; none fires.
+        """
+        value = int(value)
+        with self._lock:
+            self.frames += 1
+            self.values[field] = value
+            index = self._indexes.get(field)
+            if index is None:
+                return
+            segment = index.segment(value)
+            previous = self._segments.get(field)
+            self._segments[field] = segment
+            if segment == previous:
+                return
+            enter, stay = index.segments[segment]
+            if previous is None:
+                candidates = enter | stay
+            else:
+                old_enter, old_stay = index.segments[previous]
+                candidates = (enter ^ old_enter) | (stay ^ old_stay)
+            self.evaluations += len(candidates)
+            for condition in candidates:
+                rule = condition.rule
+                if not condition.inside and condition in enter:
+                    condition.inside = True
+                    rule.satisfied += 1
+                    if rule.holds and self._running:
+                        self._rule_met(rule)
+                elif condition.inside and condition not in stay:
+                    condition.inside = False
+                    if rule.holds:
+                        rule.generation += 1
+                    rule.satisfied -= 1
+
+    def _on_status(self, changes):
+        for field, (_, new) in changes.items():
+            self.update(field, new)
+
+    def _on_sensor(self, port, value):
+        self.update(f"sensor{port}_value", value)
+
+    # -- firing --------------------------------------------------------------------------------------------
+    def _rule_met(self, rule):
+        if rule.debounce > 0:
+            heapq.heappush(self._timers, (time.monotonic() + rule.debounce, next(self._timer_sequence),
+                                          rule, rule.generation))
+            self._timer_cond.notify()
+        else:
+            self._fire(rule)
+
+    def _fire(self, rule):
+        rule.fired += 1
+        rule.last_fired = time.monotonic()
+        if rule.once:
+            self.remove(rule)
+        self._executor.submit(self._dispatch, rule)
+
+    def _dispatch(self, rule):
+        try:
+            if callable(rule.action):
+                rule.action()
+            else:
+                cmd, payload = rule.action
+                self.robot.serial_queue_command(cmd, bytes(payload))
+        except Exception as e:
+            rule.errors += 1
+            print(f"[Error] Rule {rule.name} failed: {e}")
+
+    def _timer_loop(self):
+        with self._lock:
+            while self._running:
+                if not self._timers:
+                    self._timer_cond.wait()
+                    continue
+                due, _, rule, generation = self._timers[0]
+                remaining = due - time.monotonic()
+                if remaining > 0:
+                    self._timer_cond.wait(remaining)
+                    continue
+                heapq.heappop(self._timers)
+                if generation == rule.generation and rule.holds and rule in self.rules:
+                    self._fire(rule)
+
+    # -- lifecycle -----------------------------------------------------------------------------------------
+    def _resubscribe(self):
+        robot = self.robot
+        if self._subscription is not None:
+            robot.unsubscribe_status(self._subscription)
+        self._subscription = robot.subscribe_status(self._on_status, set(self._indexes) or None)
+
+    def start(self):
+        """Seed the values from the current status and start evaluating rules."""
+        robot = self.robot
+        if self._running:
+            return self
+        if not robot.ensure_connection():
+            raise RuntimeError("Serial port is not initialized.")
+        self._executor = concurrent.futures.ThreadPoolExecutor(self._workers, thread_name_prefix="algopython-rules")
+        with self._lock:
+            # Rules met by update() calls before start() only fire now.
+            held = [(rule, rule.generation) for rule in self.rules if rule.holds]
+            self._running = True
+            self._timer_thread = threading.Thread(target=self._timer_loop, daemon=True)
+            self._timer_thread.start()
+            for field in STATUS_FIELDS:
+                self.update(field, getattr(robot.status, field))
+            for rule, generation in held:
+                if rule.generation == generation and rule.holds:
+                    self._rule_met(rule)
+        self._resubscribe()
+        robot.sensor_listeners.append(self._on_sensor)
+        # Keep the poller at its fast rate: rules watch fields no command is waiting on.
+        self._watch = robot.watching_status()
+        self._watch.__enter__()
+        return self
+
+    def stop(self):
+        robot = self.robot
+        if not self._running:
+            return
+        with self._lock:
+            self._running = False
+            self._timers.clear()
+            self._timer_cond.notify_all()
+        self._timer_thread.join()
+        if self._subscription is not None:
+            robot.unsubscribe_status(self._subscription)
+            self._subscription = None
+        if self._on_sensor in robot.sensor_listeners:
+            robot.sensor_listeners.remove(self._on_sensor)
+        self._watch.__exit__(None, None, None)
+        self._watch = None
+        self._executor.shutdown(wait=True)
+        self._executor = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "rules": len(self.rules),
+                "updates": self.frames,
+                "conditions_checked": self.evaluations,
+                "fired": {rule.name: rule.fired for rule in self.rules},
+            }
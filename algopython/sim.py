@@ -0,0 +1,370 @@
+"""Simulated algopython brain for testing and benchmarking without hardware.
+
+SimulatedBrain speaks the same frames as the real board (0xA5, cmd, len, payload,
+checksum) and answers every request in CMD_REPLY_MAP. Motors, LEDs and sound stay busy
+for the duration they were started with, and sensor waits stay armed until the sensor
+value enters the requested range. GET_STATUS returns the usual 10-byte layout.
+
+It also implements protocol v2 (0xA6, cmd, seq, len, payload, CRC-16): it answers HELLO
+and replies to each v2 request in v2 with the request's sequence number. With
+protocol=1 it behaves like current firmware, which ignores HELLO and v2 frames.
+
+The brain can be attached in two ways:
+
+    ser = LoopbackSerial(SimulatedBrain(), latency=0.002, jitter=0.001, loss=0.0, seed=1)
+    algopython_init(connection=ser)
+
+    link = PtyLink(SimulatedBrain())        # POSIX only
+    algopython_init(link.port)
+
+Both take the same impairment settings (latency, jitter, byte loss, byte corruption) and
+draw them from a seeded random generator, so runs are reproducible.
+"""
+import heapq
+import math
+import os
+import random
+import threading
+import time
+
+from .algopython import (CMD_REPLY_MAP, FRAME_SYNC, FRAME_SYNC_V2, PROTOCOL_V1, PROTOCOL_V2,
+                         build_packet_v2, crc16, ALGOPYTHON_CMD_HELLO_REQ,
+                         ALGOPYTHON_CMD_MOVE_REQ, ALGOPYTHON_CMD_LIGHT_REQ, ALGOPYTHON_CMD_PLAY_SOUND_REQ,
+                         ALGOPYTHON_CMD_MOVE_STOP_REQ, ALGOPYTHON_CMD_LIGHT_STOP_REQ,
+                         ALGOPYTHON_CMD_SOUND_STOP_REQ, ALGOPYTHON_CMD_WAIT_SENSOR_REQ,
+                         ALGOPYTHON_CMD_GET_SENSOR_REQ, ALGOPYTHON_CMD_GET_STATUS_REQ)
+
+__all__ = ['SimulatedBrain', 'LoopbackSerial', 'PtyLink']
+
+ACK = b"\x01"
+
+
+def encode_frame(cmd, payload=b""):
+    body = bytes([FRAME_SYNC, cmd, len(payload)]) + bytes(payload)
+    return body + bytes([sum(body) & 0xFF])
+
+
+class SimulatedBrain:
+    """Protocol and timing model of the brain board.
+
+    `sound_duration` is how long every sound plays, in seconds. Sensor values can be set
+    with set_sensor() or produced by `sensor_source(port, now) -> int`. `protocol` is the
+    newest protocol version the brain agrees to and `window` the number of v2 requests it
+    accepts in flight.
+    """
+
+    def __init__(self, sound_duration=1.0, sensor_source=None, clock=time.monotonic, protocol=PROTOCOL_V2,
+                 window=64):
+        self.protocol = protocol
+        self.window = window
+        self.sound_duration = sound_duration
+        self.sensor_source = sensor_source
+        self.clock = clock
+        self.motor_until = [0.0, 0.0, 0.0]
+        self.led_until = [0.0, 0.0]
+        self.sound_until = 0.0
+        self.sensor_values = [0, 0]
+        self.sensor_waits = [None, None]    # (min, max) while armed
+        self.requests = 0
+        self.v2_requests = 0
+        self.bad_frames = 0
+        self._rx = bytearray()
+
+    # -- frame level -------------------------------------------------------------------------------------
+    def receive(self, data):
+        """Feed bytes from the host; returns the bytes the brain sends back."""
+        self._rx.extend(data)
+        out = bytearray()
+        buf = self._rx
+        while True:
+            start = buf.find(FRAME_SYNC)
+            if self.protocol >= PROTOCOL_V2:
+                start_v2 = buf.find(FRAME_SYNC_V2, 0, len(buf) if start < 0 else start)
+                if start_v2 >= 0:
+                    start = start_v2
+            if start < 0:
+                buf.clear()
+                break
+            if start:
+                del buf[:start]
+            if buf[0] == FRAME_SYNC:
+                if len(buf) < 4:
+                    break
+                total = buf[2] + 4
+                if len(buf) < total:
+                    break
+                frame = bytes(buf[:total])
+                # build_packet() sums the header only; accept a whole-frame sum as well.
+                valid = frame[-1] in (sum(frame[:3]) & 0xFF, sum(frame[:-1]) & 0xFF)
+                cmd, seq, payload = frame[1], None, frame[3:-1]
+            else:
+                if len(buf) < 6:
+                    break
+                total = buf[3] + 6
+                if len(buf) < total:
+                    break
+                frame = bytes(buf[:total])
+                valid = crc16(frame[:-2]) == int.from_bytes(frame[-2:], "big")
+                cmd, seq, payload = frame[1], frame[2], frame[4:-2]
+            if not valid:
+                self.bad_frames += 1
+                del buf[:1]
+                continue
+            del buf[:total]
+            reply = self.handle(cmd, payload, seq)
+            if reply is not None:
+                out += reply
+        return bytes(out)
+
+    def handle(self, cmd, payload, seq=None):
+        """Apply one request and return the encoded reply frame (None for unknown commands).
+
+        The reply is a v2 frame carrying `seq` when the request was a v2 frame (seq not None).
+        """
+        reply_cmd = CMD_REPLY_MAP.get(cmd)
+        if reply_cmd is None or (cmd == ALGOPYTHON_CMD_HELLO_REQ and self.protocol < PROTOCOL_V2):
+            return None
+        self.requests += 1
+        if seq is not None:
+            self.v2_requests += 1
+        now = self.clock()
+        self._update_sensors(now)
+        reply = ACK
+        if cmd == ALGOPYTHON_CMD_MOVE_REQ and len(payload) >= 8:
+            until = self._until(now, payload[1], payload[2:6])
+            for i in range(3):
+                if payload[0] & (1 << i):
+                    self.motor_until[i] = until
+        elif cmd == ALGOPYTHON_CMD_LIGHT_REQ and len(payload) >= 10:
+            if payload[0] in (1, 2):
+                self.led_until[payload[0] - 1] = self._until(now, payload[1], payload[2:6])
+        elif cmd == ALGOPYTHON_CMD_PLAY_SOUND_REQ:
+            self.sound_until = now + self.sound_duration
+        elif cmd == ALGOPYTHON_CMD_MOVE_STOP_REQ and payload:
+            for i in range(3):
+                if payload[0] & (1 << i):
+                    self.motor_until[i] = 0.0
+        elif cmd == ALGOPYTHON_CMD_LIGHT_STOP_REQ and payload:
+            if payload[0] in (1, 2):
+                self.led_until[payload[0] - 1] = 0.0
+        elif cmd == ALGOPYTHON_CMD_SOUND_STOP_REQ:
+            self.sound_until = 0.0
+        elif cmd == ALGOPYTHON_CMD_WAIT_SENSOR_REQ and len(payload) >= 3:
+            if payload[0] in (1, 2):
+                self.sensor_waits[payload[0] - 1] = (payload[1], payload[2])
+                self._update_sensors(now)
+        elif cmd == ALGOPYTHON_CMD_GET_SENSOR_REQ and payload:
+            port = payload[0]
+            value = self.sensor_values[port - 1] if port in (1, 2) else 0
+            reply = bytes([port, value & 0xFF])
+        elif cmd == ALGOPYTHON_CMD_GET_STATUS_REQ:
+            reply = self.status_bytes(now)
+        elif cmd == ALGOPYTHON_CMD_HELLO_REQ:
+            offered = payload[0] if payload else PROTOCOL_V1
+            reply = bytes([min(offered, self.protocol), self.window])
+        if seq is not None:
+            return build_packet_v2(reply_cmd, seq, reply)
+        return encode_frame(reply_cmd, reply)
+
+    # -- device state -----------------------------------------------------------------------------------
+    @staticmethod
+    def _until(now, run_type, duration_bytes):
+        if run_type == 1:
+            return math.inf
+        centiseconds = int.from_bytes(bytes(duration_bytes), "big")
+        return now + centiseconds / 100.0
+
+    def _update_sensors(self, now):
+        if self.sensor_source is not None:
+            for port in (1, 2):
+                self.sensor_values[port - 1] = int(self.sensor_source(port, now)) & 0xFF
+        for i, armed in enumerate(self.sensor_waits):
+            if armed is not None and armed[0] <= self.sensor_values[i] <= armed[1]:
+                self.sensor_waits[i] = None
+
+    def set_sensor(self, port, value):
+        self.sensor_values[port - 1] = value & 0xFF
+        self._update_sensors(self.clock())
+
+    def status_bytes(self, now=None):
+        if now is None:
+            now = self.clock()
+        self._update_sensors(now)
+        return bytes([
+            int(self.motor_until[0] > now),
+            int(self.motor_until[1] > now),
+            int(self.motor_until[2] > now),
+            int(self.led_until[0] > now),
+            int(self.led_until[1] > now),
+            int(self.sound_until > now),
+            int(self.sensor_waits[0] is not None),
+            int(self.sensor_waits[1] is not None),
+            self.sensor_values[0],
+            self.sensor_values[1],
+        ])
+
+
+class _Impairments:
+    def __init__(self, latency, jitter, loss, corruption, seed):
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.corruption = corruption
+        self.random = random.Random(seed)
+
+    def delay(self):
+        return self.latency + (self.random.uniform(0, self.jitter) if self.jitter else 0.0)
+
+    def mangle(self, data):
+        if not (self.loss or self.corruption):
+            return bytes(data)
+        rnd = self.random.random
+        out = bytearray()
+        for byte in data:
+            if self.loss and rnd() < self.loss:
+                continue
+            if self.corruption and rnd() < self.corruption:
+                byte ^= 1 << self.random.randrange(8)
+            out.append(byte)
+        return bytes(out)
+
+
+class LoopbackSerial:
+    """pyserial-compatible object wired to a SimulatedBrain.
+
+    `latency` (plus up to `jitter`) seconds apply in each direction. `loss` and
+    `corruption` are per-byte probabilities, applied to both directions. Byte order is
+    preserved, as on a real serial line.
+    """
+
+    def __init__(self, brain=None, latency=0.0, jitter=0.0, loss=0.0, corruption=0.0, seed=None, timeout=0.5):
+        self.brain = brain if brain is not None else SimulatedBrain()
+        self.timeout = timeout
+        self.port = "loop://algopython-sim"
+        self.is_open = True
+        self.bytes_written = 0
+        self.bytes_read = 0
+        self._impair = _Impairments(latency, jitter, loss, corruption, seed)
+        self._cond = threading.Condition()
+        self._events = []           # heap of (deliver_at, seq, direction, bytes)
+        self._seq = 0
+        self._last_delivery = {"tx": 0.0, "rx": 0.0}
+        self._rx = bytearray()
+
+    def __getstate__(self):
+        # Picklable, so it can be handed to a ProcessRobot engine in a spawned child.
+        state = self.__dict__.copy()
+        del state["_cond"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._cond = threading.Condition()
+
+    def _schedule(self, direction, data, now):
+        at = max(now + self._impair.delay(), self._last_delivery[direction])
+        self._last_delivery[direction] = at
+        self._seq += 1
+        heapq.heappush(self._events, (at, self._seq, direction, data))
+
+    def _advance(self):
+        now = time.monotonic()
+        while self._events and self._events[0][0] <= now:
+            at, _, direction, data = heapq.heappop(self._events)
+            if direction == "rx":
+                self._rx += data
+                continue
+            reply = self.brain.receive(data)
+            if reply:
+                self._schedule("rx", self._impair.mangle(reply), at)
+        return now
+
+    def write(self, data):
+        if not self.is_open:
+            raise OSError("Port is closed")
+        data = bytes(data)
+        with self._cond:
+            now = self._advance()
+            self._schedule("tx", self._impair.mangle(data), now)
+            self.bytes_written += len(data)
+            self._cond.notify_all()
+        return len(data)
+
+    def read(self, size=1):
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        with self._cond:
+            while True:
+                now = self._advance()
+                if self._rx or not self.is_open:
+                    data = bytes(self._rx[:size])
+                    del self._rx[:size]
+                    self.bytes_read += len(data)
+                    return data
+                wait = None if deadline is None else deadline - now
+                if wait is not None and wait <= 0:
+                    return b""
+                if self._events:
+                    until_next = self._events[0][0] - now
+                    wait = until_next if wait is None else min(wait, until_next)
+                self._cond.wait(wait)
+
+    @property
+    def in_waiting(self):
+        with self._cond:
+            self._advance()
+            return len(self._rx)
+
+    def reset_input_buffer(self):
+        with self._cond:
+            self._advance()
+            self._rx.clear()
+
+    def flush(self):
+        pass
+
+    def close(self):
+        with self._cond:
+            self.is_open = False
+            self._cond.notify_all()
+
+
+class PtyLink:
+    """Serve a SimulatedBrain on a pseudo-terminal; open `port` like a real device.
+
+    Latency and jitter are added once before each reply burst.
+    """
+
+    def __init__(self, brain=None, latency=0.0, jitter=0.0, loss=0.0, corruption=0.0, seed=None):
+        import tty
+        self.brain = brain if brain is not None else SimulatedBrain()
+        self._impair = _Impairments(latency, jitter, loss, corruption, seed)
+        self._master, slave = os.openpty()
+        tty.setraw(slave)
+        self.port = os.ttyname(slave)
+        self._slave = slave
+        self._running = True
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+
+    def _serve(self):
+        import select
+        while self._running:
+            ready, _, _ = select.select([self._master], [], [], 0.1)
+            if not ready:
+                continue
+            try:
+                data = os.read(self._master, 4096)
+            except OSError:
+                break
+            delay = self._impair.delay()
+            if delay:
+                time.sleep(delay)
+            reply = self.brain.receive(self._impair.mangle(data))
+            if reply:
+                os.write(self._master, self._impair.mangle(reply))
+
+    def close(self):
+        self._running = False
+        self._thread.join()
+        os.close(self._master)
+        os.close(self._slave)
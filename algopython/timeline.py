@@ -0,0 +1,182 @@
+"""Deadline-scheduled move/light/sound sequences.
+
+Chaining blocking calls lets link latency and sleep jitter add up over a show. A
+Timeline instead takes every action at an absolute offset from the start:
+
+    show = Timeline()
+    show.move(0.0, 'AB', 2.0, 8, 1)
+    show.light(0.0, 1, 0.5, 5, 'red')
+    show.playSound(0.5, 3, 7)
+    show.light(1.0, 2, 0.5, 5, 'blue')
+    show.moveStop(2.0, 'AB')
+    report = show.run()
+
+Frames are encoded when the action is added. run() keeps them in a heap ordered by
+deadline, writes each one early by the current estimate of the one-way link latency so
+it reaches the brain on time, and writes actions that share a deadline in a single
+write. The report lists, per action, the planned offset, when it was written and its
+estimated arrival (write time plus half the measured round trip).
+"""
+import concurrent.futures
+import heapq
+import statistics
+import time
+
+from . import algopython as core
+from .algopython import build_packet, CMD_REPLY_MAP
+
+__all__ = ['Timeline']
+
+
+class TimelineEvent:
+    __slots__ = ('at', 'cmd', 'payload', 'packet', 'label', 'sent_at', 'acked_at')
+
+    def __init__(self, at, cmd, payload, label):
+        self.at = at
+        self.cmd = cmd
+        self.payload = bytes(payload)
+        self.packet = build_packet(cmd, self.payload)
+        self.label = label
+        self.sent_at = None
+        self.acked_at = None
+
+    def report(self, start):
+        sent = None if self.sent_at is None else self.sent_at - start
+        rtt = None if self.acked_at is None else self.acked_at - self.sent_at
+        arrival = None if rtt is None else sent + rtt / 2
+        return {
+            "label": self.label,
+            "planned_s": self.at,
+            "sent_s": sent,
+            "rtt_ms": None if rtt is None else rtt * 1000.0,
+            "arrival_s": arrival,
+            "error_ms": None if arrival is None else (arrival - self.at) * 1000.0,
+        }
+
+
+class Timeline:
+    """Actions at absolute offsets (seconds from the start of run()) for one robot."""
+
+    def __init__(self, robot=None):
+        self.robot = robot if robot is not None else core.default_robot()
+        self.events = []
+        self.latency = None     # one-way link latency estimate in seconds, set by run()
+
+    def __len__(self):
+        return len(self.events)
+
+    def add(self, at: float, cmd: int, payload: bytes, label: str = None):
+        if at < 0:
+            raise ValueError("Offset must not be negative")
+        if cmd not in CMD_REPLY_MAP:
+            raise ValueError(f"Unknown command 0x{cmd:02X}")
+        event = TimelineEvent(at, cmd, payload, label or f"0x{cmd:02X}")
+        self.events.append(event)
+        return event
+
+    def move(self, at: float, port, duration: float, power: int, direction: int):
+        _, payload, _ = core.build_move_payload(port, duration, power, direction)
+        return self.add(at, core.ALGOPYTHON_CMD_MOVE_REQ, payload, f"move {port}")
+
+    def moveStop(self, at: float, port):
+        return self.add(at, core.ALGOPYTHON_CMD_MOVE_STOP_REQ, bytes([core.motor_mask(port)]), f"moveStop {port}")
+
+    def light(self, at: float, port: int, duration: float, power: int, color):
+        payload, _ = core.build_light_payload(port, duration, power, color)
+        return self.add(at, core.ALGOPYTHON_CMD_LIGHT_REQ, payload, f"light {port}")
+
+    def lightStop(self, at: float, port: int):
+        if port not in (1, 2):
+            raise ValueError("LED port must be 1 or 2")
+        return self.add(at, core.ALGOPYTHON_CMD_LIGHT_STOP_REQ, bytes([port]), f"lightStop {port}")
+
+    def playSound(self, at: float, sound_id: int, volume: int):
+        payload = core.build_sound_payload(sound_id, volume)
+        return self.add(at, core.ALGOPYTHON_CMD_PLAY_SOUND_REQ, payload, f"playSound {sound_id}")
+
+    def soundStop(self, at: float):
+        return self.add(at, core.ALGOPYTHON_CMD_SOUND_STOP_REQ, b"", "soundStop")
+
+    def calibrate(self, samples: int = 5):
+        """Measure the one-way latency as half the median GET_STATUS round trip."""
+        robot = self.robot
+        rtts = []
+        for _ in range(samples):
+            start = time.perf_counter()
+            if robot.send_packet(core.ALGOPYTHON_CMD_GET_STATUS_REQ, b"", retries=0, verbose=False) is not None:
+                rtts.append(time.perf_counter() - start)
+        self.latency = statistics.median(rtts) / 2 if rtts else 0.0
+        return self.latency
+
+    def _write(self, due):
+        robot = self.robot
+        futures = []
+        for event in due:
+            reply_cmd = CMD_REPLY_MAP[event.cmd]
+            futures.append(robot.expect_reply(reply_cmd, event.cmd))
+        robot.serial_write(b"".join(event.packet for event in due),
+                           min(core.command_priority(event.cmd) for event in due))
+        sent_at = time.perf_counter()
+        for event, future in zip(due, futures):
+            event.sent_at = future.sent_at = sent_at
+            robot.link_stats.record_sent(event.cmd)
+            future.add_done_callback(lambda f, event=event: self._on_ack(event, f))
+        return futures
+
+    def _on_ack(self, event, future):
+        if future.cancelled():
+            return
+        event.acked_at = time.perf_counter()
+        # Follow drifting latency without letting one slow reply dominate.
+        self.latency = 0.8 * self.latency + 0.2 * (event.acked_at - event.sent_at) / 2
+
+    def run(self, lead: float = 0.05, compensate: bool = True, spin: float = 0.001, ack_timeout: float = 1.0):
+        """Play the timeline and return its timing report.
+
+        The start is `lead` seconds after the call so the first actions can be sent early.
+        Each wait sleeps until `spin` seconds before the send time and spins the rest.
+        """
+        robot = self.robot
+        if not robot.ensure_connection():
+            print("[Error] Serial port is not initialized.")
+            return None
+        if compensate:
+            self.calibrate()
+        else:
+            self.latency = 0.0
+
+        for event in self.events:
+            event.sent_at = event.acked_at = None
+        heap = [(event.at, i, event) for i, event in enumerate(self.events)]
+        heapq.heapify(heap)
+        pending = []
+        start = time.perf_counter() + lead
+        while heap:
+            at = heap[0][0]
+            due = []
+            while heap and heap[0][0] == at:
+                due.append(heapq.heappop(heap)[2])
+            send_at = start + at - (self.latency if compensate else 0.0)
+            remaining = send_at - time.perf_counter()
+            if remaining > spin:
+                time.sleep(remaining - spin)
+            while time.perf_counter() < send_at:
+                pass
+            pending.extend(zip(due, self._write(due)))
+
+        deadline = time.monotonic() + ack_timeout
+        for event, future in pending:
+            try:
+                future.result(max(0, deadline - time.monotonic()))
+            except concurrent.futures.TimeoutError:
+                robot.cancel_reply(CMD_REPLY_MAP[event.cmd], future)
+
+        events = [event.report(start) for event in sorted(self.events, key=lambda e: e.at)]
+        errors = [abs(e["error_ms"]) for e in events if e["error_ms"] is not None]
+        return {
+            "latency_ms": self.latency * 1000.0,
+            "events": events,
+            "unacknowledged": sum(1 for e in events if e["error_ms"] is None),
+            "mean_abs_error_ms": statistics.fmean(errors) if errors else None,
+            "max_abs_error_ms": max(errors) if errors else None,
+        }
@@ -0,0 +1,149 @@
+"""Trace where the time of API calls goes, for chrome://tracing or ui.perfetto.dev.
+
+    tracer = robot.start_tracing()
+    ...                                     # drive the robot as usual
+    robot.stop_tracing()
+    tracer.export_chrome("session.trace.json")
+    print(tracer.summary())
+
+Spans are recorded per thread: the high-level calls (move, light, playSound, wait_sensor,
+...), inside them send_packet and its phases (lock_wait, write, delay_after, wait_for_reply)
+and the completion wait (wait_for_idle); queue_wait shows time a command spent in the
+robot's command queue. Instants mark retries, reply timeouts and each frame the reader
+thread receives. Events carrying an opcode show it as args.cmd.
+
+Events go into preallocated arrays (22 bytes each, no object per event); past
+`capacity` the oldest are overwritten. While no tracer is attached to the robot the only
+cost is one attribute check per instrumented call.
+"""
+import array
+import json
+import os
+import threading
+import time
+
+__all__ = ['Tracer']
+
+INSTANT = -1.0      # end time of instant events
+
+
+class Tracer:
+    """Fixed-capacity buffer of spans and instants, timed with time.perf_counter()."""
+
+    def __init__(self, capacity: int = 65536):
+        if capacity < 1:
+            raise ValueError("Capacity must be positive")
+        self.capacity = capacity
+        self.begins = array.array('d', bytes(8 * capacity))
+        self.ends = array.array('d', bytes(8 * capacity))
+        self.names = array.array('H', bytes(2 * capacity))
+        self.threads = array.array('H', bytes(2 * capacity))
+        self.cmds = array.array('h', bytes(2 * capacity))
+        self.count = 0              # events recorded since creation
+        self.origin = time.perf_counter()
+        self.started = time.time()
+        self._name_ids = {}
+        self._name_list = []
+        self._thread_ids = {}       # threading.get_ident() -> small tid
+        self._thread_names = []
+        self._lock = threading.Lock()
+
+    now = staticmethod(time.perf_counter)
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    @property
+    def dropped(self):
+        return max(0, self.count - self.capacity)
+
+    @property
+    def nbytes(self):
+        return self.capacity * 22
+
+    def span(self, name: str, begin: float, end: float = None, cmd: int = -1):
+        """Record a span on the calling thread from `begin` to `end` (default: now)."""
+        if end is None:
+            end = time.perf_counter()
+        ident = threading.get_ident()
+        with self._lock:
+            name_id = self._name_ids.get(name)
+            if name_id is None:
+                name_id = self._name_ids[name] = len(self._name_list)
+                self._name_list.append(name)
+            tid = self._thread_ids.get(ident)
+            if tid is None:
+                tid = self._thread_ids[ident] = len(self._thread_names)
+                self._thread_names.append(threading.current_thread().name)
+            i = self.count % self.capacity
+            self.count += 1
+            self.begins[i] = begin
+            self.ends[i] = end
+            self.names[i] = name_id
+            self.threads[i] = tid
+            self.cmds[i] = cmd
+
+    def instant(self, name: str, cmd: int = -1):
+        self.span(name, time.perf_counter(), INSTANT, cmd)
+
+    def clear(self):
+        with self._lock:
+            self.count = 0
+
+    def _rows(self):
+        with self._lock:
+            capacity = self.capacity
+            rows = []
+            for n in range(max(0, self.count - capacity), self.count):
+                i = n % capacity
+                end = self.ends[i]
+                cmd = self.cmds[i]
+                rows.append((self._name_list[self.names[i]], self.threads[i], self.begins[i],
+                             None if end == INSTANT else end, None if cmd < 0 else cmd))
+            return rows, list(self._thread_names)
+
+    def events(self):
+        """(name, thread name, begin, end or None, cmd or None) for every event, oldest first."""
+        rows, thread_names = self._rows()
+        return [(name, thread_names[tid], begin, end, cmd) for name, tid, begin, end, cmd in rows]
+
+    def export_chrome(self, file):
+        """Write the events as Chrome trace JSON (a path or a text file object).
+
+        Returns the number of events written. Open the file in chrome://tracing or
+        ui.perfetto.dev; times are microseconds since the tracer was created.
+        """
+        if isinstance(file, (str, os.PathLike)):
+            with open(file, "w") as f:
+                return self.export_chrome(f)
+        pid = os.getpid()
+        rows, thread_names = self._rows()
+        events = [{"ph": "M", "name": "thread_name", "pid": pid, "tid": tid, "args": {"name": thread_name}}
+                  for tid, thread_name in enumerate(thread_names)]
+        origin = self.origin
+        for name, tid, begin, end, cmd in rows:
+            event = {"name": name, "pid": pid, "tid": tid,
+                     "ts": round((begin - origin) * 1e6, 3)}
+            if end is None:
+                event["ph"] = "i"
+                event["s"] = "t"
+            else:
+                event["ph"] = "X"
+                event["dur"] = round((end - begin) * 1e6, 3)
+            if cmd is not None:
+                event["args"] = {"cmd": f"0x{cmd:02X}"}
+            events.append(event)
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms",
+                   "otherData": {"started": self.started, "dropped": self.dropped}}, file)
+        return len(rows)
+
+    def summary(self):
+        """Per span name: count, total and mean milliseconds, longest first."""
+        totals = {}
+        for name, _, begin, end, _ in self._rows()[0]:
+            if end is None:
+                continue
+            count, total = totals.get(name, (0, 0.0))
+            totals[name] = (count + 1, total + end - begin)
+        return {name: {"count": count, "total_ms": round(total * 1e3, 3), "mean_ms": round(total * 1e3 / count, 3)}
+                for name, (count, total) in sorted(totals.items(), key=lambda item: -item[1][1])}
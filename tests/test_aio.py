@@ -0,0 +1,20 @@
+import asyncio
+
+from algopython import aio
+from algopython import algopython as core
+from algopython.sim import SimulatedBrain, LoopbackSerial
+
+
+def test_get_sensor_value_reads_the_stream_of_that_port():
+    brain = SimulatedBrain()
+    brain.set_sensor(1, 11)
+    brain.set_sensor(2, 22)
+    assert core.algopython_init(connection=LoopbackSerial(brain, latency=0.002, seed=1))
+    core.start_sensor_stream((1, 2))
+    try:
+        async def read():
+            return [await aio.get_sensor_value(1) for _ in range(100)]
+        assert asyncio.run(read()) == [11] * 100
+    finally:
+        core.stop_sensor_stream()
+        core.close()
@@ -0,0 +1,53 @@
+from algopython.algopython import FrameDecoder, PROTOCOL_V2, build_packet_v2
+from algopython.sim import encode_frame
+
+STATUS_REPLY = encode_frame(0x89, bytes(range(10)))
+STRAY = bytes([0xA5, 0xF0])     # a sync byte followed by a large length byte
+
+
+def frames(decoder, data, now):
+    return [(cmd, bytes(payload)) for cmd, payload, _ in decoder.feed(data, now)]
+
+
+def test_decodes_v1_and_v2_frames():
+    decoder = FrameDecoder(protocol=PROTOCOL_V2)
+    decoded = [(cmd, bytes(payload), seq)
+               for cmd, payload, seq in decoder.feed(STATUS_REPLY + build_packet_v2(0x88, 7, b"\x01\x02"), 0.0)]
+    assert decoded == [(0x89, bytes(range(10)), None), (0x88, b"\x01\x02", 7)]
+
+
+def test_stale_partial_frame_is_dropped_on_next_feed():
+    decoder = FrameDecoder()
+    assert frames(decoder, STRAY, 0.0) == []
+    # The reply arrives after the link was idle: the stray partial frame must not swallow it.
+    assert frames(decoder, STATUS_REPLY, 1.0) == [(0x89, bytes(range(10)))]
+    assert decoder.stale_frames == 1
+    assert decoder.buffered() == 0
+
+
+def test_expire_releases_frames_behind_a_stray_sync_byte():
+    decoder = FrameDecoder()
+    assert frames(decoder, STRAY + STATUS_REPLY, 0.0) == []
+    assert list(decoder.expire(decoder.idle_gap / 2)) == []
+    assert [(cmd, bytes(payload)) for cmd, payload, _ in decoder.expire(1.0)] == [(0x89, bytes(range(10)))]
+    assert decoder.buffered() == 0
+
+
+def test_partial_frame_split_across_feeds_is_kept():
+    decoder = FrameDecoder()
+    assert frames(decoder, STATUS_REPLY[:5], 0.0) == []
+    assert frames(decoder, STATUS_REPLY[5:], 0.001) == [(0x89, bytes(range(10)))]
+    assert decoder.stale_frames == 0
+
+
+
+def test_v2_frames_need_the_v2_protocol():
+    frame = build_packet_v2(0x88, 7, b"\x01\x02")
+    assert frames(FrameDecoder(), frame, 0.0) == []
+    assert frames(FrameDecoder(protocol=PROTOCOL_V2), frame, 0.0) == [(0x88, b"\x01\x02")]
+
+
+def test_stray_v2_sync_byte_does_not_stall_v1_replies():
+    decoder = FrameDecoder()
+    assert frames(decoder, bytes([0xA6, 0x00, 0x00, 0xF0]) + STATUS_REPLY, 0.0) == [(0x89, bytes(range(10)))]
+    assert decoder.buffered() == 0
@@ -0,0 +1,19 @@
+import time
+
+from algopython import algopython as core
+from algopython.sim import SimulatedBrain, LoopbackSerial
+
+
+def test_close_stops_the_poller_before_the_port(capsys):
+    for seed in range(5):
+        robot = core.Robot(connection=LoopbackSerial(SimulatedBrain(), latency=0.002, seed=seed))
+        assert robot.ensure_connection()
+        robot.set_polling_policy(fast_interval=0.001, idle_interval=0.001)
+        robot.serial_thread_start()
+        time.sleep(0.02)
+        robot.close()
+        assert not robot.status_thread.is_alive()
+        assert not robot.reader_thread.is_alive()
+        assert robot.serial_write(core.build_packet(core.ALGOPYTHON_CMD_GET_STATUS_REQ, b"")) is False
+    captured = capsys.readouterr()
+    assert "Error" not in captured.out + captured.err
@@ -0,0 +1,54 @@
+import threading
+import time
+
+from algopython import algopython as core
+from algopython.rules import RuleEngine
+from algopython.sim import SimulatedBrain, LoopbackSerial
+
+
+def test_update_before_start_tracks_rules_without_firing():
+    engine = RuleEngine(robot=core.Robot())
+    rule = engine.add({'sensor1_value': (30, 60), 'motor1': 0}, lambda: None, hysteresis=3)
+    engine.update('sensor1_value', 45)
+    engine.update('motor1', 0)
+    assert rule.holds
+    engine.update('sensor1_value', 62)      # outside the range, inside the hysteresis band
+    assert rule.holds
+    engine.update('motor1', 1)
+    assert not rule.holds
+    engine.update('motor1', 0)
+    engine.update('sensor1_value', 64)
+    assert not rule.holds
+
+
+def test_docstring_rule_rearms_when_the_motor_runs():
+    brain = SimulatedBrain()
+    brain.set_sensor(1, 45)
+    robot = core.Robot(connection=LoopbackSerial(brain, latency=0.002, seed=1))
+    fired = threading.Semaphore(0)
+    engine = RuleEngine(robot)
+    # Fed before start(): tracked, but only fired once the engine runs.
+    engine.update('motor1', 1)
+    rule = engine.add({'sensor1_value': (30, 60), 'motor1': 0}, fired.release, debounce=0.1, hysteresis=3)
+    with engine:
+        robot.set_polling_policy(fast_interval=0.005)
+        assert fired.acquire(timeout=2)
+        robot.move('A', 0.2, 5, 1)
+        assert fired.acquire(timeout=2)
+    robot.close()
+    assert rule.fired == 2
+    assert rule.errors == 0
+
+
+def test_rule_met_before_start_fires_on_start():
+    robot = core.Robot(connection=LoopbackSerial(SimulatedBrain(), latency=0.002, seed=2))
+    fired = threading.Semaphore(0)
+    engine = RuleEngine(robot)
+    rule = engine.add({'sound': 0}, fired.release)
+    engine.update('sound', 0)
+    assert rule.holds and rule.fired == 0
+    with engine:
+        assert fired.acquire(timeout=2)
+        time.sleep(0.05)
+    robot.close()
+    assert rule.fired == 1
@@ -0,0 +1,58 @@
+import asyncio
+import threading
+
+import pytest
+
+from algopython import aio
+from algopython import algopython as core
+from algopython.bench import bench_stop_latency
+from algopython.sim import SimulatedBrain, LoopbackSerial
+
+
+@pytest.fixture(scope="module")
+def brain():
+    brain = SimulatedBrain(sound_duration=0.05)
+    brain.set_sensor(1, 42)
+    assert core.algopython_init(connection=LoopbackSerial(brain, latency=0.002, jitter=0.001, seed=1))
+    yield brain
+    core.close()
+
+
+def test_stop_latency_under_polling_load(brain):
+    results = bench_stop_latency(samples=50, workers=4, fast_interval=0.005)
+    assert results["stop"]["failures"] == 0
+    assert results["stop"]["p99_ms"] <= core.STOP_LATENCY_BOUND * 1000
+
+
+def stopping(stop):
+    def run():
+        while not stop.is_set():
+            core.send_packet(core.ALGOPYTHON_CMD_SOUND_STOP_REQ, b"", verbose=False)
+    return threading.Thread(target=run)
+
+
+def test_stops_do_not_cancel_sensor_reads(brain):
+    stop = threading.Event()
+    stopper = stopping(stop)
+    stopper.start()
+    try:
+        values = [core.get_sensor_value(1) for _ in range(50)]
+    finally:
+        stop.set()
+        stopper.join()
+    assert values == [42] * 50
+
+
+def test_stops_do_not_cancel_aio_sensor_reads(brain):
+    async def read_all():
+        return await asyncio.gather(*(aio.get_sensor_value(1) for _ in range(50)))
+
+    stop = threading.Event()
+    stopper = stopping(stop)
+    stopper.start()
+    try:
+        values = asyncio.run(read_all())
+    finally:
+        stop.set()
+        stopper.join()
+    assert values == [42] * 50
@@ -0,0 +1,14 @@
+from algopython import algopython as core
+from algopython.sim import SimulatedBrain, LoopbackSerial
+
+
+def test_queued_command_records_queue_wait():
+    robot = core.Robot(connection=LoopbackSerial(SimulatedBrain(), latency=0.002, seed=1))
+    assert robot.ensure_connection()
+    tracer = robot.start_tracing()
+    assert robot.serial_queue_command(core.ALGOPYTHON_CMD_SOUND_STOP_REQ, b"") is not None
+    robot.stop_tracing()
+    robot.close()
+    spans = [(name, cmd) for name, _, _, end, cmd in tracer.events() if end is not None]
+    assert ("queue_wait", core.ALGOPYTHON_CMD_SOUND_STOP_REQ) in spans
+    assert ("send_packet", core.ALGOPYTHON_CMD_SOUND_STOP_REQ) in spans